@@ -176,6 +176,29 @@ contract Bookie {
         Bet storage bet = bets[bet_id];
         require(block.number >= bet.exp_blockheight, "cannot settle bet before expiration");
         require(bet.active, "bet has already been settled or invalidated");
+        spendable_balance[owner] += _settle(bet, bet_id, over_wins);
+    }
+
+    // settles many bets in one txn. bets that are already inactive (settled, invalidated, or never existed)
+    // are skipped rather than reverting the whole batch, so a stale entry in the off-chain queue can't block
+    // everything else. the expiration check still reverts, since that means the caller is broken.
+    function settleBets(uint256[] calldata bet_ids, bool[] calldata over_wins) public onlyBookie {
+        require(bet_ids.length == over_wins.length, "bet_ids and over_wins length mismatch");
+        uint256 total_rake = 0;
+        for (uint256 i = 0; i < bet_ids.length; i++) {
+            Bet storage bet = bets[bet_ids[i]];
+            if (!bet.active) {
+                continue;
+            }
+            require(block.number >= bet.exp_blockheight, "cannot settle bet before expiration");
+            total_rake += _settle(bet, bet_ids[i], over_wins[i]);
+        }
+        // one write to the owner's balance per batch instead of one per bet
+        spendable_balance[owner] += total_rake;
+    }
+
+    // pays out the winner and returns the rake; caller is responsible for the checks and for crediting the rake
+    function _settle(Bet storage bet, uint256 bet_id, bool over_wins) internal returns (uint256) {
         locked_balance[bet.over] -= bet.amount;
         locked_balance[bet.under] -= bet.amount;
 
@@ -187,9 +210,9 @@ contract Bookie {
         } else {
             spendable_balance[bet.under] += win_amount;
         }
-        spendable_balance[owner] += rake_amount;
-        bets[bet_id].active = false;
+        bet.active = false;
         emit BetSettled(bet_id, over_wins);
+        return rake_amount;
     }
 
     // if the bet is not settled after INVALIDATION_WINDOW blocks, anyone can invalidate it.
@@ -261,5 +261,143 @@ contract BookieTest is Test {
         bookie.invalidateStaleBet(0);
     }
 
+
+    //// BATCH SETTLEMENT ////
+    function _makeSmallBets(uint256 n) internal {
+        _makeBets(n, 0.1 ether);
+    }
+
+    // n bets of amt each between alice and bob, ids 0..n-1; n * amt has to fit under max_account_balance
+    function _makeBets(uint256 n, uint256 amt) internal {
+        vm.prank(alice);
+        bookie.deposit{value: 1 ether}();
+        vm.prank(bob);
+        bookie.deposit{value: 1 ether}();
+        vm.roll(0);
+        for (uint256 i = 0; i < n; i++) {
+            bookie.makeBet(alice, bob, "BONK", amt, 69, _safety_margin);
+        }
+    }
+
+    function test_SettleBets() public {
+        _makeSmallBets(4);
+        vm.roll(_safety_margin);
+
+        uint256[] memory ids = new uint256[](4);
+        bool[] memory over_wins = new bool[](4);
+        for (uint256 i = 0; i < 4; i++) {
+            ids[i] = i;
+            over_wins[i] = i % 2 == 0;
+        }
+        bookie.settleBets(ids, over_wins);
+
+        // each side won twice; each win pays 0.2 ether minus 2% rake on the 0.2 ether pot
+        uint256 rake_per_bet = (bookie.RAKE_PERCENTAGE() * 2 * 0.1 ether) / bookie.PERCENTAGE_BASIS();
+        uint256 win_per_bet = 0.2 ether - rake_per_bet;
+        assertEq(bookie.getSpendableBalance(alice), 0.6 ether + 2 * win_per_bet);
+        assertEq(bookie.getSpendableBalance(bob), 0.6 ether + 2 * win_per_bet);
+        assertEq(bookie.getLockedBalance(alice), 0 ether);
+        assertEq(bookie.getLockedBalance(bob), 0 ether);
+        assertEq(bookie.getSpendableBalance(owner), 4 * rake_per_bet);
+        for (uint256 i = 0; i < 4; i++) {
+            assertFalse(bookie.getBet(i).active);
+        }
+    }
+
+    function test_SettleBetsSkipsInactive() public {
+        _makeSmallBets(3);
+        vm.roll(_safety_margin);
+        bookie.settleBet(1, true);
+        bookie.bookieInvalidateBet(2);
+        uint256 owner_before = bookie.getSpendableBalance(owner);
+
+        // 1 is settled, 2 is invalidated, 7 never existed: only 0 should get settled, and nothing reverts
+        uint256[] memory ids = new uint256[](4);
+        bool[] memory over_wins = new bool[](4);
+        ids[0] = 0;
+        ids[1] = 1;
+        ids[2] = 2;
+        ids[3] = 7;
+        bookie.settleBets(ids, over_wins);
+
+        uint256 rake_per_bet = (bookie.RAKE_PERCENTAGE() * 2 * 0.1 ether) / bookie.PERCENTAGE_BASIS();
+        assertFalse(bookie.getBet(0).active);
+        assertEq(bookie.getSpendableBalance(owner), owner_before + rake_per_bet);
+        assertEq(bookie.getLockedBalance(alice), 0 ether);
+        assertEq(bookie.getLockedBalance(bob), 0 ether);
+    }
+
+    function test_revertSettleBetsTooSoon() public {
+        _makeSmallBets(2);
+        vm.roll(_safety_margin - 1);
+        uint256[] memory ids = new uint256[](2);
+        bool[] memory over_wins = new bool[](2);
+        ids[1] = 1;
+        vm.expectRevert("cannot settle bet before expiration");
+        bookie.settleBets(ids, over_wins);
+    }
+
+    function test_revertSettleBetsLengthMismatch() public {
+        _makeSmallBets(2);
+        vm.roll(_safety_margin);
+        uint256[] memory ids = new uint256[](2);
+        bool[] memory over_wins = new bool[](1);
+        ids[1] = 1;
+        vm.expectRevert("bet_ids and over_wins length mismatch");
+        bookie.settleBets(ids, over_wins);
+    }
+
+    function test_revertRandoSettlesBets() public {
+        _makeSmallBets(1);
+        vm.roll(_safety_margin);
+        uint256[] memory ids = new uint256[](1);
+        bool[] memory over_wins = new bool[](1);
+        vm.prank(alice);
+        vm.expectRevert("Not bookie");
+        bookie.settleBets(ids, over_wins);
+    }
+
+    // per-bet gas of settleBets at batch sizes 1, 10 and 50 vs the same number of bets settled one settleBet txn
+    // each. every txn's 21k base cost is counted, since that's most of what batching saves. -vv prints the numbers
+    function test_GasSettleBetsVsSettleBet() public {
+        uint256[3] memory sizes = [uint256(1), 10, 50];
+        uint256 total = 2 * (1 + 10 + 50);
+        _makeBets(total, 1 ether / total);
+        vm.roll(_safety_margin);
+
+        uint256 next_id = 0;
+        uint256 prev_batch_per_bet = type(uint256).max;
+        for (uint256 s = 0; s < sizes.length; s++) {
+            uint256 n = sizes[s];
+            uint256 gas_start = gasleft();
+            for (uint256 i = 0; i < n; i++) {
+                bookie.settleBet(next_id + i, true);
+            }
+            uint256 single_per_bet = (gas_start - gasleft()) / n + 21_000;
+            next_id += n;
+
+            uint256[] memory ids = new uint256[](n);
+            bool[] memory over_wins = new bool[](n);
+            for (uint256 i = 0; i < n; i++) {
+                ids[i] = next_id + i;
+                over_wins[i] = true;
+            }
+            next_id += n;
+            gas_start = gasleft();
+            bookie.settleBets(ids, over_wins);
+            uint256 batch_per_bet = (gas_start - gasleft() + 21_000) / n;
+
+            console.log("%s bets: settleBet %s gas/bet, settleBets %s gas/bet", n, single_per_bet, batch_per_bet);
+            // the fixed cost is spread over more bets as batches grow
+            assertLt(batch_per_bet, prev_batch_per_bet);
+            if (n > 1) {
+                assertLt(batch_per_bet, single_per_bet);
+            }
+            prev_batch_per_bet = batch_per_bet;
+        }
+        // the bot sizes settleBets txns at 50k gas per bet (ApiV2.settle_batch_per_bet_gas)
+        assertLt(prev_batch_per_bet, 50_000);
+    }
+
 }
 
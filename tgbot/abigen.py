@@ -0,0 +1,107 @@
+import os
+import sys
+import json
+import types
+import pprint
+import logging
+import importlib
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+ARTIFACT = Path("bookie/out/Bookie.sol/bookie.json")
+BINDINGS = Path(__file__).with_name("bookie_abi.py")
+
+_HEADER = "# generated by `python -m tgbot.abigen` from {source}, don't edit. regenerated when the artifact changes\n"
+
+
+# where the foundry artifact is when running from tgbot/ or from the repo root (the lookup ApiV2 always did),
+# falling back to the repo this package lives in
+def find_artifact() -> Path | None:
+    for base in (Path(os.getcwd()).parent, Path(os.getcwd()), Path(__file__).resolve().parent.parent):
+        if (base / ARTIFACT).exists():
+            return base / ARTIFACT
+    return None
+
+
+# solidity's canonical type for an abi input, with tuples spelled out, e.g. "(address,uint256)[]"
+def _canonical(param: dict) -> str:
+    if param["type"].startswith("tuple"):
+        return "(" + ",".join(_canonical(c) for c in param["components"]) + ")" + param["type"][len("tuple"):]
+    return param["type"]
+
+
+def signature(entry: dict) -> str:
+    return f"{entry['name']}({','.join(_canonical(i) for i in entry.get('inputs', []))})"
+
+
+# the source of the bindings module for the artifact at `path`: the abi, plus the 4-byte selector of every
+# function and the topic of every event, keyed by name (and by full signature, for overloads)
+def generate(path: Path) -> str:
+    from eth_utils import keccak     # only needed here, not to load bindings that already exist
+
+    abi = json.loads(path.read_text()).get("abi")
+    selectors, signatures, topics = {}, {}, {}
+    for entry in abi:
+        if entry.get("type") not in ("function", "event"):
+            continue
+        _sig = signature(entry)
+        _hash = "0x" + keccak(text=_sig).hex()
+        if entry["type"] == "function":
+            selectors[_sig] = _hash[:10]
+            selectors.setdefault(entry["name"], _hash[:10])
+            signatures.setdefault(entry["name"], _sig)
+        else:
+            topics[_sig] = _hash
+            topics.setdefault(entry["name"], _hash)
+    stat = path.stat()
+    return (_HEADER.format(source=path) +
+            f"ARTIFACT_SIZE = {stat.st_size}\n"
+            f"ARTIFACT_MTIME_NS = {stat.st_mtime_ns}\n\n"
+            f"SELECTORS = {pprint.pformat(selectors)}\n\n"
+            f"SIGNATURES = {pprint.pformat(signatures)}\n\n"
+            f"EVENT_TOPICS = {pprint.pformat(topics)}\n\n"
+            f"ABI = {pprint.pformat(abi)}\n")
+
+
+def _is_current(bindings, path: Path) -> bool:
+    stat = path.stat()
+    return (bindings.ARTIFACT_SIZE, bindings.ARTIFACT_MTIME_NS) == (stat.st_size, stat.st_mtime_ns)
+
+
+# the contract bindings (ABI, SELECTORS, SIGNATURES, EVENT_TOPICS). normally that's importing the generated
+# module, which costs a stat of the artifact and no json parsing; if it's missing or older than the artifact it's
+# regenerated (and written back if the package dir is writable). with no artifact around, e.g. a deploy that only
+# ships tgbot/, the generated module is used as is
+def load(artifact: Path | None = None):
+    try:
+        bindings = importlib.import_module(".bookie_abi", __package__)
+    except ImportError:
+        bindings = None
+    path = artifact or find_artifact()
+    if path is None:
+        if bindings is None:
+            raise FileNotFoundError(f"no contract artifact ({ARTIFACT}) or generated bindings ({BINDINGS})")
+        return bindings
+    if bindings is not None and _is_current(bindings, path):
+        return bindings
+
+    logger.warning(f"contract bindings {'are stale' if bindings else 'not generated yet'}, regenerating from {path}")
+    source = generate(path)
+    try:
+        BINDINGS.write_text(source)
+    except OSError as e:
+        logger.warning(f"couldn't write {BINDINGS}, bindings will be regenerated next start too: {e}")
+    module = types.ModuleType(f"{__package__}.bookie_abi")
+    exec(source, module.__dict__)
+    return module
+
+
+# python -m tgbot.abigen [artifact] (run after `forge build`)
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    _path = Path(sys.argv[1]) if len(sys.argv) > 1 else find_artifact()
+    if _path is None:
+        sys.exit("no artifact found, run `forge build` in bookie/ or pass its path")
+    BINDINGS.write_text(generate(_path))
+    print(f"wrote {BINDINGS} from {_path}")
@@ -0,0 +1,69 @@
+import threading
+import logging
+from contextlib import contextmanager, ExitStack
+
+logger = logging.getLogger(__name__)
+
+
+# a lock per key, created on demand and dropped again once nobody holds or waits on it
+class KeyedLocks:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._locks = {}        # key -> [lock, refcount]
+
+    @contextmanager
+    def hold(self, key):
+        with self._lock:
+            entry = self._locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._locks[key]
+
+    # several keys at once, always in sorted order so two callers can't deadlock each other
+    @contextmanager
+    def hold_many(self, keys):
+        with ExitStack() as stack:
+            for key in sorted(set(k for k in keys if k is not None)):
+                stack.enter_context(self.hold(key))
+            yield
+
+
+# decides which concurrent accepts may run at the same time:
+# - a proposal can be claimed by exactly one accept at a time; everyone else gets turned away immediately
+# - checks against a chat's proposals are serialized per chat (short, no network calls held)
+# - balance check + makeBet are serialized per participant, so one user can't over-commit with two parallel accepts
+# accepts that share none of these keys never wait on each other
+class AcceptCoordinator:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._claims = {}           # proposal id -> user id that's accepting it
+        self._chats = KeyedLocks()
+        self._users = KeyedLocks()
+
+    @contextmanager
+    def claim(self, proposal_id: int, user_id: int):
+        with self._lock:
+            claimed = proposal_id not in self._claims
+            if claimed:
+                self._claims[proposal_id] = user_id
+        try:
+            yield claimed
+        finally:
+            if claimed:
+                with self._lock:
+                    del self._claims[proposal_id]
+
+    def is_claimed(self, proposal_id: int) -> bool:
+        return proposal_id in self._claims
+
+    def chat(self, chat_id: int):
+        return self._chats.hold(chat_id)
+
+    def users(self, *user_ids: int):
+        return self._users.hold_many(user_ids)
@@ -5,141 +5,312 @@ from eth_typing import Address
 import requests
 import json
 from json import JSONDecodeError
-import os
 from datetime import datetime, timedelta
 from eth_account.messages import encode_defunct
 from pymongo import MongoClient
-from pymongo.errors import DuplicateKeyError
+from pymongo.errors import DuplicateKeyError, PyMongoError
 import heapq
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pydantic import ValidationError
 import logging
-from web3.exceptions import ContractLogicError, ABIFunctionNotFound, MismatchedABI
+from web3.exceptions import ContractLogicError, ABIFunctionNotFound, MismatchedABI, TransactionNotFound
+from web3.logs import DISCARD
+from . import metrics, tracing, logs, abigen
+from .cmc import CmcClient
+from .views import BetsViewCache
+from .balances import BalanceCache
+from .indexes import ensure_indexes, USERNAME_COLLATION
+from .fees import FeeOracle
+from .txtracker import TxTracker, TxPending
+from .rpc_pool import ProviderPool, PooledProvider, RpcEndpointError
+from .accept import AcceptCoordinator
+from .signer import SignerClient
+from .shards import Shard
+from .lease import Lease, LeaseLost
+from .usercache import UserCache
+from .changefeed import ChangeFeed
+from .journal import WriteBehind
+from .proposals import ProposalStore
+from .stats import StatsBook
+from .pending import PendingTxns
+from .txbuilder import TxBuilder
 
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
-
-# Configure logger
-# c_handler = logging.StreamHandler()
-# f_handler = logging.FileHandler('tgbot_backend_api.log')
-# c_handler.setLevel(logging.DEBUG)
-# f_handler.setLevel(logging.WARNING)
-#
-# c_format = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-# f_format = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-# c_handler.setFormatter(c_format)
-# f_handler.setFormatter(f_format)
-#
-# logger.addHandler(c_handler)
-# logger.addHandler(f_handler)
+# debug records from settlement rounds, logged in full for a sample of rounds (SETTLEMENT_DEBUG_SAMPLE)
+settle_log = logs.SETTLEMENT
 
 
 # using priority queue to store bets because I care about efficient access to the next expiring bet
 # since I will be checking it every few blocks, but I don't care about efficient access to all bets
 class InMemoryBetDb:
+    # the change feed pushes/removes from its own thread while settlement pops from another, so every method that
+    # touches the heap holds this
     def __init__(self):
         self._queue = []
         self._index = 0
+        self._lock = threading.RLock()
+        self.version = 0        # bumped on every push/pop/remove, see snapshot()
 
     def is_empty(self):
         return not self._queue
 
     def peek(self):
-        if self.is_empty():
-            return None
-        return self._queue[0][0]
+        with self._lock:
+            if self.is_empty():
+                return None
+            return self._queue[0][0]
 
     def push(self, bet: Bet):
-        heapq.heappush(self._queue, (bet.expiry, self._index, bet))
-        self._index += 1
+        with self._lock:
+            heapq.heappush(self._queue, (bet.expiry, self._index, bet))
+            self._index += 1
+            self.version += 1
 
     def pop(self):
-        return heapq.heappop(self._queue)[-1]
+        with self._lock:
+            self.version += 1
+            return heapq.heappop(self._queue)[-1]
+
+    # pops the next bet if it expires at or before `block`, atomically with the check
+    def pop_due(self, block: int) -> Bet | None:
+        with self._lock:
+            if self._queue and self._queue[0][0] <= block:
+                self.version += 1
+                return heapq.heappop(self._queue)[-1]
+            return None
+
+    def has(self, bet_id: int) -> bool:
+        with self._lock:
+            return any(item[-1].id == bet_id for item in self._queue)
+
+    # push unless a bet with the same id is already queued; returns whether it pushed
+    def add(self, bet: Bet) -> bool:
+        with self._lock:
+            if self.has(bet.id):
+                return False
+            self.push(bet)
+            return True
+
+    # O(n), only used off the hot path (stale bet sweeps, other replicas' settlements)
+    def remove(self, bet_id: int) -> Bet | None:
+        with self._lock:
+            for i, item in enumerate(self._queue):
+                if item[-1].id == bet_id:
+                    self._queue[i] = self._queue[-1]
+                    self._queue.pop()
+                    heapq.heapify(self._queue)
+                    self.version += 1
+                    return item[-1]
+            return None
+
+    # (version, every bet in the book), taken together under the lock
+    def snapshot(self) -> tuple[int, list[Bet]]:
+        with self._lock:
+            return self.version, [item[-1] for item in self._queue]
+
+    def get_bets_due_before(self, block: int) -> list[Bet]:
+        with self._lock:
+            return [item[-1] for item in self._queue if item[0] <= block]
 
     def get_bets_by_user_id(self, user_id: int) -> list[Bet] | None:
-        return [i[-1] for i in self._queue if i[-1].over_user_id == user_id or i[-1].under_user_id == user_id]
+        with self._lock:
+            return [i[-1] for i in self._queue if i[-1].over_user_id == user_id or i[-1].under_user_id == user_id]
 
     def get_bets_by_chat_id(self, chat_id: int) -> list[Bet] | None:
-        return [item[-1] for item in self._queue if item[-1].chat_created_in == chat_id]
+        with self._lock:
+            return [item[-1] for item in self._queue if item[-1].chat_created_in == chat_id]
 
     def __repr__(self):
-        items = [item[-1] for item in self._queue]
+        with self._lock:
+            items = [item[-1] for item in self._queue]
         return f"PriorityQueue({items})"
 
     def __len__(self):
         return len(self._queue)
 
 
+@metrics.instrument_public_methods
 class ApiV2:
-    def __init__(self, contract_addr: str, rpc_url: str, pk: str, l1_rpc_url: str):
+    # rpc_url/l1_rpc_url may be comma-separated lists; rpc_write_urls (same format) restricts where txns are sent
+    # signer_addr: sign bookie txns through a SigningService instead of with pk (pk may then be None). signer_token
+    # is its shared secret, signer_receipt_timeout how long to wait on our own rpc for a receipt the signer saw
+    # shard: only load (and so only settle) bets from chats this worker owns
+    # replica_id: stable name for this process, keys its change feed resume token (defaults to the hostname)
+    # write_journal/write_flush_*: active_bets writes are buffered and flushed in bulk, see journal.WriteBehind.
+    # durable_writes: flush before returning anything a user will be told about (accepts, settlement rounds)
+    # proposal_journal: where open bet proposals are persisted across restarts (None: memory only)
+    # balance_ttl: how stale a cached contract balance may get for readers that use the cache (the http read api)
+    def __init__(self, contract_addr: str, rpc_url: str, pk: str | None, l1_rpc_url: str,
+                 cmc_rate_per_minute: int = 30, rpc_write_urls: str | None = None, signer_addr: str | None = None,
+                 shard: Shard | None = None, replica_id: str | None = None, write_journal: str | None = None,
+                 write_flush_interval: float = 1.0, write_flush_max_ops: int = 500, durable_writes: bool = True,
+                 proposal_journal: str | None = None, balance_ttl: float = 30.0, signer_token: str | None = None,
+                 signer_receipt_timeout: float = 120.0):
+
+        # the chain side (rpc pools, web3, contract bindings and constants) is network round trips that don't depend
+        # on mongo, so it runs in a thread while the mongo side loads the caches
+        with ThreadPoolExecutor(1, thread_name_prefix="startup") as _startup:
+            _chain = _startup.submit(self._init_chain, contract_addr, rpc_url, pk, l1_rpc_url, rpc_write_urls,
+                                     signer_addr, signer_token, signer_receipt_timeout)
+            client = MongoClient('localhost', 27017, event_listeners=[metrics.mongo_command_listener()])
+            db = client['database']
+            ensure_indexes(db)
+            self.user_db = db.users
+
+            logger.info(f"loaded {self.user_db.estimated_document_count()} users from database.")
+
+            self.active_bets_db = db.active_bets
+            self.leases_db = db.leases              # see lease.Lease; no ttl index on purpose
+            self.bet_writes = WriteBehind(self.active_bets_db, write_journal, write_flush_interval,
+                                          write_flush_max_ops, archive=db.settled_bets)
+            self.bet_writes.replay()                # whatever the last run didn't get to flush
+            self.durable_writes = durable_writes
+            self.shard = shard
+            # users and the bet book are cached in-process; other replicas' writes reach us through the change feed,
+            # which has to be open before the caches are loaded so nothing written in between is missed
+            self.users = UserCache()
+            self._bet_oids = {}                     # mongo _id -> bet id, delete events only carry the _id
+            self._settling = set()                  # ids of bets popped for settlement, see _on_active_bet_change
+            self._unpriceable = set()               # ids of bets the last settlement attempt couldn't price
+            _owner = f"{replica_id or socket.gethostname()}" + (f":{shard.index}" if shard else "")
+            # txns that timed out unmined, reconciled by reconcile_pending. bets with a settlement in there are
+            # kept out of the book meanwhile
+            self.pending = PendingTxns(db.pending_txns, _owner)
+            self._unconfirmed = self.pending.settling_ids()
+            self._reconcile_lock = threading.Lock()
+            self.changes = ChangeFeed(db, {"users": self._on_user_change, "active_bets": self._on_active_bet_change},
+                                      name=f"caches:{_owner}", on_resync=self._resync_caches)
+            self.users.enabled = self.changes.open()
+            logger.info("Loading in-memory bet cache from database...")
+            self.bet_cache = self._load_bet_cache()
+            # open offers, journaled so a restart doesn't drop them; thread-safe on its own
+            self.proposals = ProposalStore(proposal_journal)
+            self.proposals.load()
+            # settled bet archive + leaderboard/pnl aggregates, updated at settlement time
+            self.stats = StatsBook(db)
+            self.accepts = AcceptCoordinator()
+        _chain.result()
 
-        client = MongoClient('localhost', 27017)
-        db = client['database']
-        self.user_db = db.users
-        self.user_db.create_index("id", unique=True)
-
-        logger.info(f"loaded {len(list(self.user_db.find({})))} users from database.")
-
-        self.active_bets_db = db.active_bets
-        logger.info("Loading in-memory bet cache from database...")
-        self.bet_cache = InMemoryBetDb()
-        for bet in self.active_bets_db.find():
-            logger.info(f"loading bet: {bet}")
-            _bet = Bet(**bet)
-            self.bet_cache.push(_bet)
-        logger.info(f"Done: loaded {len(self.bet_cache)} bets from database.")
-        self.pending_bets = []                          # TODO: k: id, v: BetProposal?
+        # only used when user sizes a bet in dollars, doesn't need to be updated often/be super accurate
+        # if settling a bet, this is NOT referenced; the coinmarketcap API is used instead
+        self.eth_price = 1800
+        self.eth_price_last_update = datetime.now()
+        self.eth_price_cache_duration = timedelta(minutes=60)
 
+        self.cmc_base_url = "https://pro-api.coinmarketcap.com"
+        self.cmc_headers = {"Accepts": "application/json", "X-CMC_PRO_API_KEY": "TODO_ADD_API_KEY"}
+        self.cmc = CmcClient(self.cmc_base_url, self.cmc_headers, rate_per_minute=cmc_rate_per_minute)
+
+        # rendered /bets listings; every method below that changes a proposal/bet invalidates the affected views
+        self.bets_views = BetsViewCache(self)
+        # contract balances by user, dropped along with the views whenever one of our bets is created or settled
+        self.balances = BalanceCache(self._read_balances, ttl=balance_ttl)
+
+        # evaluated at scrape time, so they cost nothing on the hot path
+        metrics.BOOK_SIZE.set_function(lambda: len(self.bet_cache))
+        metrics.PENDING_PROPOSALS.set_function(lambda: len(self.proposals))
+        metrics.OLDEST_UNSETTLED_EXPIRY.set_function(lambda: self.bet_cache.peek())
+        if self.users.enabled:
+            self.changes.start()
+        self.bet_writes.start()
+        logger.info("ApiV2 initialized.")
 
-        self.RPC_URL = rpc_url
-        self.l1_RPC_URL = l1_rpc_url
+    def _init_chain(self, contract_addr: str, rpc_url: str, pk: str | None, l1_rpc_url: str,
+                    rpc_write_urls: str | None, signer_addr: str | None, signer_token: str | None,
+                    signer_receipt_timeout: float):
+        _rpc_urls = [u.strip() for u in rpc_url.split(",") if u.strip()]
+        _l1_rpc_urls = [u.strip() for u in l1_rpc_url.split(",") if u.strip()]
+        _write_urls = [u.strip() for u in rpc_write_urls.split(",") if u.strip()] if rpc_write_urls else None
+        self.RPC_URL = _rpc_urls[0]
+        self.l1_RPC_URL = _l1_rpc_urls[0]
+        self.rpc_pool = ProviderPool(_rpc_urls, "l2", write_urls=_write_urls)
+        self.l1_rpc_pool = ProviderPool(_l1_rpc_urls, "l1")
+        # fixed gas limits are only fallbacks for when estimate_gas fails, see FeeOracle.gas_limit
         self.accept_gas = 400_000
         self.deposit_gas = 400_000
         self.settle_gas = 150_000
+        self.invalidate_gas = 150_000
+        # settleBets(): fixed overhead + per-bet cost (a single settleBet is ~40k in the gas report), capped per txn
+        self.settle_batch_base_gas = 60_000
+        self.settle_batch_per_bet_gas = 50_000
+        # on top of the cached per-bet estimate: it may have been taken with bets that were cheaper to settle
+        self.settle_batch_item_margin = 10_000
+        self.settle_batch_gas_budget = 3_000_000
 
         if self.RPC_URL.__contains__("arbitrum"):
-            self.accept_gas = self.deposit_gas = self.settle_gas = 1_000_000
+            self.accept_gas = self.deposit_gas = self.settle_gas = self.invalidate_gas = 1_000_000
+            # arbitrum gas units include the l1 calldata charge, so be generous per bet too
+            self.settle_batch_base_gas = 1_000_000
+            self.settle_batch_per_bet_gas = 150_000
+            self.settle_batch_gas_budget = 20_000_000
 
 
-        w3 = Web3(Web3.HTTPProvider(self.RPC_URL))
+        w3 = Web3(PooledProvider(self.rpc_pool))
+        w3.middleware_onion.add(metrics.web3_metrics_middleware, "metrics")
         if w3 is None or not w3.is_connected():
             raise ConnectionError("Failed to connect to web3 provider.")
+        self.rpc_pool.start_health_checks()
+        self.l1_rpc_pool.start_health_checks()
 
         self.w3 = w3
-        self.account = self.w3.eth.account.from_key(pk)
+        self.fees = FeeOracle(self.w3)
+        self._tx_trackers = {}
+        self._tx_trackers_lock = threading.Lock()
+        if signer_addr:
+            # the signer owns the key and the nonce sequence; it stands in for both the account and its tracker
+            self.account = SignerClient(signer_addr, self.w3, token=signer_token,
+                                        receipt_timeout=signer_receipt_timeout)
+            self._tx_trackers[self.account.address] = self.account
+        else:
+            self.account = self.w3.eth.account.from_key(pk)
         contract_addr = Address(bytes.fromhex(contract_addr[2:]))
 
+        # abi + selectors from the generated bindings module instead of parsing the foundry artifact every start
+        self.bindings = abigen.load()
+        self.contract_instance = self.w3.eth.contract(address=contract_addr, abi=self.bindings.ABI)
+
+        _constants = self._read_constants()
+        self.block_safety_margin = _constants["BLOCK_SAFETY_MARGIN"]
+        self.max_bet_size = _constants["max_bet_size"]
+        self.max_account_balance = _constants["max_account_balance"]
+        self.release_version = _constants["RELEASE_VERSION"]
+        self.invalidation_window = _constants["INVALIDATION_WINDOW"]
+        self.rake_percentage = _constants["RAKE_PERCENTAGE"]
+        self.percentage_basis = _constants["PERCENTAGE_BASIS"]
+        # makeBet/settleBet(s) txns are encoded from the cached selectors instead of through contract_instance
+        self.txs = TxBuilder(self.w3, self.fees, self.bindings, self.contract_instance.address, self.account.address,
+                             chain_id=self.w3.eth.chain_id)
+
+    # every uint256 constant the bot needs from the contract, read in one batched eth_call (straight from the
+    # precomputed selectors) instead of a round trip each; falls back to one call at a time if the batch fails
+    _CONSTANTS = ("BLOCK_SAFETY_MARGIN", "max_bet_size", "max_account_balance", "RELEASE_VERSION",
+                  "INVALIDATION_WINDOW", "RAKE_PERCENTAGE", "PERCENTAGE_BASIS")
+
+    def _read_constants(self) -> dict[str, int]:
+        _to = self.contract_instance.address
+        payload = [{"jsonrpc": "2.0", "id": i, "method": "eth_call",
+                    "params": [{"to": _to, "data": self.bindings.SELECTORS[name]}, "latest"]}
+                   for i, name in enumerate(self._CONSTANTS)]
         try:
-            abi_path = os.path.join("/".join(os.getcwd().split('/')[:-1]), "bookie/out/Bookie.sol/bookie.json")
-            with open(abi_path, "r") as file:
-                abi = json.loads(file.read()).get('abi')
-        except FileNotFoundError:
-            abi_path = os.path.join("/".join(os.getcwd().split('/')), "bookie/out/Bookie.sol/bookie.json")
-            with open(abi_path, "r") as file:
-                abi = json.loads(file.read()).get('abi')
-
-        self.contract_instance = self.w3.eth.contract(address=contract_addr, abi=abi)
-
-        def try_setup_call(fn):
+            with metrics.outbound("l2_rpc", "eth_call_batch"):
+                results = self.rpc_pool.request_raw(payload, "eth_call")
+            values = {self._CONSTANTS[r["id"]]: int(r["result"], 16) for r in results if r.get("result")}
+            if len(values) == len(self._CONSTANTS):
+                return values
+            logger.warning(f"batched constant read came back incomplete: {results}")
+        except (RpcEndpointError, TypeError, ValueError, KeyError, AttributeError) as e:
+            logger.warning(f"batched constant read failed, reading one at a time: {e}")
+
+        values = {}
+        for name in self._CONSTANTS:
             try:
-                return fn.call()
+                values[name] = getattr(self.contract_instance.functions, name)().call()
             except (ContractLogicError, ABIFunctionNotFound, MismatchedABI):
                 logger.critical("failed to call contract function required for proper setup")
                 raise
-
-        self.block_safety_margin = try_setup_call(self.contract_instance.functions.BLOCK_SAFETY_MARGIN())
-        self.max_bet_size = try_setup_call(self.contract_instance.functions.max_bet_size())
-        self.max_account_balance = try_setup_call(self.contract_instance.functions.max_account_balance())
-        self.release_version = try_setup_call(self.contract_instance.functions.RELEASE_VERSION())
-
-        # only used when user sizes a bet in dollars, doesn't need to be updated often/be super accurate
-        # if settling a bet, this is NOT referenced; the coinmarketcap API is used instead
-        self.eth_price = 1800
-        self.eth_price_last_update = datetime.now()
-        self.eth_price_cache_duration = timedelta(minutes=60)
-
-        self.cmc_base_url = "https://pro-api.coinmarketcap.com"
-        self.cmc_headers = {"Accepts": "application/json", "X-CMC_PRO_API_KEY": "TODO_ADD_API_KEY"}
-        logger.info("ApiV2 initialized.")
+        return values
 
     @staticmethod
     def get_txn_error(rpc_url: str, tx_hash: str):
@@ -150,7 +321,8 @@ class ApiV2:
             "params": [tx_hash],
             "id": 1,
         }
-        response = requests.post(rpc_url, headers=headers, data=json.dumps(data))
+        with metrics.outbound("l2_rpc", "debug_traceTransaction"):
+            response = requests.post(rpc_url, headers=headers, data=json.dumps(data))
         try:
             return_value = response.json().get('result').get('returnValue')
             error_hex = return_value[138:]   # strip irrelevant bytes. TODO: make this more robust
@@ -268,26 +440,21 @@ class ApiV2:
         return _token
 
     def get_l1_block_number(self):
-        base_url = self.l1_RPC_URL
-        headers = {"Content-Type": "application/json"}
-        data = {"jsonrpc": "2.0", "method": "eth_blockNumber", "params": [], "id": 1}
-        response = requests.post(base_url, headers=headers, data=json.dumps(data))
-        if response.ok:
-            return int(response.json().get('result'), 16)
-        else:
+        try:
+            with metrics.outbound("l1_rpc", "eth_blockNumber"):
+                response = self.l1_rpc_pool.request("eth_blockNumber", [])
+            return int(response.get('result'), 16)
+        except (RpcEndpointError, TypeError, ValueError):
             return None
 
     # returns a list of possible tokens from an ambiguous slug like "SUI"
     def get_tokens_from_expr(self, expr: str) -> list[Token] | None:
         logger.debug(f"getting tokens from expr: {expr}")
-        _headers = self.cmc_headers
 
         # first, try by slug (full name in the cmc url). If it works, just return that token in a single-element list
         _params = {"slug": expr.lower()}
-        response = requests.get(f"{self.cmc_base_url}/v2/cryptocurrency/quotes/latest",
-                                headers=_headers, params=_params)
-        if response.ok:
-            data = response.json()
+        data = self.cmc.quotes_latest(_params, "slug")
+        if data is not None:
             if data.get('status').get('error_code') == 0:
                 if len(data.get('data')) == 1:
                     raw_token = list(data.get('data').values())[0]
@@ -300,13 +467,11 @@ class ApiV2:
         # if that didn't work, for whatever reason, try by symbol, and return a
         # ... list of possible matches to handle client-side
         _params = {"symbol": expr}
-        response = requests.get(f"{self.cmc_base_url}/v2/cryptocurrency/quotes/latest",
-                                headers=_headers, params=_params)
-        if not response.ok:
+        data = self.cmc.quotes_latest(_params, "symbol")
+        if data is None:
             logger.error("requests error")
             return None
 
-        data = response.json()
         if data.get('status').get('error_code') != 0:
             logger.warning(f"cmc api returned error: {data.get('status').get('error_message')}")
 
@@ -330,20 +495,16 @@ class ApiV2:
     # returns a token object from an ID, assumes exact match
     # TODO: store tokens in db and try that first
     def get_token_by_id(self, _id: int) -> Token | None:
-        _headers = self.cmc_headers
-        _params = {"id": _id}
-        response = requests.get(f"{self.cmc_base_url}/v2/cryptocurrency/quotes/latest",
-                                headers=_headers, params=_params)
-        return self.parse_cmc_token_data(response.json().get('data').get(str(_id)))
+        raw_token = self.cmc.quote_by_id(_id)
+        if raw_token is None:
+            logger.warning(f"cmc api returned no data for id: {_id}")
+            return None
+        return self.parse_cmc_token_data(raw_token)
 
     def get_token_price(self, tkn: Token) -> float | None:
-        _headers = self.cmc_headers
-        _params = {"id": tkn.id}
-        response = requests.get(f"{self.cmc_base_url}/v2/cryptocurrency/quotes/latest",
-                                headers=_headers, params=_params)
         try:
-            return float(response.json().get('data').get(str(tkn.id)).get('quote').get('USD').get('price'))
-        except (AttributeError, JSONDecodeError, TypeError):
+            return float(self.cmc.quote_by_id(tkn.id).get('quote').get('USD').get('price'))
+        except (AttributeError, TypeError):
             logger.error(f"couldn't fetch token price! (token={tkn})")
             return None
 
@@ -351,16 +512,22 @@ class ApiV2:
     def request_bet(self, chat_id: int, user_id: int, over: bool, offer_valid_till: str,
                     value_expr: str, bet_expiration: str, price: float,
                     token: Token, counterparty=None) -> RequestBetResponse:
-        logger.info(f"requesting bet with params: {locals()}")
+        logger.debug("requesting bet in chat %s by user %s: %s %s %s, %s, expires %s, counterparty %s",
+                     chat_id, user_id, "over" if over else "under", token, price, value_expr, bet_expiration,
+                     counterparty)
         # check if eth price is stale, if so, update; in case request is in dollars
         current_time = datetime.now()
         if current_time - self.eth_price_last_update > self.eth_price_cache_duration:
+            metrics.CACHE_LOOKUPS.inc(cache="eth_price", result="miss")
             try:
                 logger.debug("updating eth price")
-                req = requests.get("https://api.coingecko.com/api/v3/simple/price?ids=ethereum&vs_currencies=usd")
+                with metrics.outbound("coingecko", "simple_price"):
+                    req = requests.get("https://api.coingecko.com/api/v3/simple/price?ids=ethereum&vs_currencies=usd")
                 self.eth_price = float(req.json().get('ethereum').get('usd'))
             except (AttributeError, JSONDecodeError, TypeError):
                 logger.warning(f"failed to update eth price, using old value of ${self.eth_price}")
+        else:
+            metrics.CACHE_LOOKUPS.inc(cache="eth_price", result="hit")
 
         # CHECKS:
         # -1. user needs to have a wallet and be verified
@@ -439,44 +606,107 @@ class ApiV2:
         if amt_wei > self.max_bet_size:
             return RequestBetResponse(success=False, error_msg=f"bet size too large! (max={self.max_bet_size})")
 
-        # get the next available id
-        current_ids = set([bet.id for bet in self.pending_bets])
-        smol_numbers = set(range(0, 100_000))   # TODO: this is a hack, fix this
-        _id = min(list(smol_numbers - current_ids))
-
+        # the store hands out the lowest free id and records the proposal under one lock
         try:
-            _bet_prop = BetProposal(id=_id, chat_created_in=chat_id, created_at=_created_at, valid_till=_valid_till,
-                                    created_by=user_id, counterparty=_counterparty_id, creator_over=over, amount=amt_wei,
-                                    expiry=block_exp, price=_price, token=token, str_exp=bet_expiration)
+            _bet_prop = self.proposals.create(
+                lambda _id: BetProposal(id=_id, chat_created_in=chat_id, created_at=_created_at,
+                                        valid_till=_valid_till, created_by=user_id, counterparty=_counterparty_id,
+                                        creator_over=over, amount=amt_wei, expiry=block_exp, price=_price,
+                                        token=token, str_exp=bet_expiration))
         except ValidationError as e:
             logger.error(f"failed to instantiate a bet proposal: pydantic validation error: {e}")
             return RequestBetResponse(success=False, error_msg="unknown validation error ): "
                                                                "it's probably not your fault")
-
-        self.pending_bets.append(_bet_prop)
-        logger.info(f"successfully added bet proposal: {_bet_prop}")
+        self.bets_views.invalidate(chat_id, (user_id, _counterparty_id))
+        logger.info("added bet proposal %s in chat %s", _bet_prop.id, chat_id, extra={"proposal": _bet_prop.id})
         return RequestBetResponse(success=True, bet_proposal=_bet_prop, error_msg=None)
 
-    # removes a bet request from pending list and returns True if successful
-    def rm_bet_request(self, bet_id: int):
-        try:
-            for bet in self.pending_bets:
-                if bet.id == bet_id:
-                    self.pending_bets.remove(bet)
-                    logger.info(f"successfully removed bet proposal: {bet}")
+    def _load_bet_cache(self) -> InMemoryBetDb:
+        bet_cache = InMemoryBetDb()
+        for bet in self.active_bets_db.find():
+            if self.shard is not None and not self.shard.owns(bet.get("chat_created_in")):
+                continue
+            if bet.get("id") in self._unconfirmed:
+                continue
+            _bet = Bet(**bet)
+            bet_cache.push(_bet)
+            self._bet_oids[bet["_id"]] = _bet.id
+        logger.info(f"Done: loaded {len(bet_cache)} bets from database" + (f" for {self.shard}." if self.shard else "."))
+        return bet_cache
+
+    # a replica that just became settlement leader may be missing bets other replicas created since it started
+    def reload_bet_cache(self):
+        # or our own buffered writes would be missing from the reload
+        if not self.bet_writes.flush():
+            logger.error("reloading the bet cache without our own unflushed writes, they're still buffered")
+        self.bet_cache = self._load_bet_cache()
+        self.bets_views.clear()
+
+    #### CHANGE FEED ####
+    # writes by other processes, applied to our caches (see changefeed.py). our own writes come through here as
+    # well; by then the caches already reflect them, so applying them again changes nothing
+
+    def _on_user_change(self, change: dict):
+        doc = change.get("fullDocument")
+        user_id = doc.get("id") if doc else self.users.id_for_oid(change["documentKey"]["_id"])
+        if user_id is None:
+            return                              # deleted, and never cached here
+        self.users.invalidate(user_id, doc.get("user_name") if doc else None)
+        self.bets_views.invalidate_user(user_id)
+        self.balances.invalidate(user_id)
+
+    def _on_active_bet_change(self, change: dict):
+        oid = change["documentKey"]["_id"]
+        if change["operationType"] == "delete":
+            # settled or swept by another replica (or by us, in which case it's already gone)
+            bet_id = self._bet_oids.pop(oid, None)
+            _bet = self.bet_cache.remove(bet_id) if bet_id is not None else None
+            if _bet is not None:
+                self.bets_views.invalidate(_bet.chat_created_in, (_bet.over_user_id, _bet.under_user_id))
+                self.balances.invalidate(_bet.over_user_id, _bet.under_user_id)
+            return
+        # re-read instead of trusting the event: a feed resuming after a restart replays events for bets that may
+        # have been settled since, and those must not come back into the book
+        doc = self.active_bets_db.find_one({"_id": oid})
+        if doc is None:
+            return
+        _bet = Bet(**doc)
+        self._bet_oids[oid] = _bet.id
+        if self.shard is not None and not self.shard.owns(_bet.chat_created_in):
+            return
+        if _bet.id in self._settling or _bet.id in self._unconfirmed:
+            return
+        if change["operationType"] == "insert":
+            if not self.bet_cache.add(_bet):
+                return
+        else:
+            self.bet_cache.remove(_bet.id)
+            self.bet_cache.push(_bet)
+        self.bets_views.invalidate(_bet.chat_created_in, (_bet.over_user_id, _bet.under_user_id))
+        self.balances.invalidate(_bet.over_user_id, _bet.under_user_id)
+
+    # the feed fell too far behind to patch the caches event by event
+    def _resync_caches(self):
+        self.users.clear()
+        self._bet_oids.clear()
+        self.reload_bet_cache()
+
+    # removes a bet request from pending list and returns True if this call is the one that removed it
+    # reason: "removed" or "expired", as recorded in the proposal journal
+    def rm_bet_request(self, bet_id: int, reason: str = "removed"):
+        bet = self.proposals.remove(bet_id, reason)
+        if bet is not None:
+            self.bets_views.invalidate(bet.chat_created_in, (bet.created_by, bet.counterparty))
+            logger.info(f"successfully removed bet proposal ({reason}): {bet}")
             return True
-        except IndexError:
-            logger.critical("FAILED TO DROP PENDING BET REQUEST")
-            return False
+        logger.warning(f"bet proposal {bet_id} wasn't in the pending list (already accepted or purged?)")
+        return False
 
     def get_bet_proposals_by_chat_id(self, chat_id: int) -> list[BetProposal]:
-        return [bet for bet in self.pending_bets if bet.chat_created_in == chat_id]
+        return self.proposals.by_chat(chat_id)
 
     def get_bet_proposal_by_id(self, bet_id: int) -> BetProposal | None:
-        try:
-            return [bet for bet in self.pending_bets if bet.id == bet_id][0]
-        except IndexError:
-            return None
+        return self.proposals.get(bet_id)
 
     # side effect: purges expired bets!!!!!
     def get_bets_by_chat_id(self, chat_id: int) -> BetList:
@@ -485,23 +715,18 @@ class ApiV2:
         for bet in pending_bets:
             if bet.valid_till < datetime.now():
                 logger.info(f"purged expired bet proposal: id: {bet.id}")
-                self.rm_bet_request(bet.id)
+                self.rm_bet_request(bet.id, "expired")
 
         return BetList(active=active_bets, pending=pending_bets)
 
     # side effect: purges expired bets!!!!!
     def get_bets_by_user_id(self, user_id: int) -> BetList:
         active_bets = self.bet_cache.get_bets_by_user_id(user_id)
-        pending_bets_by_user = [bet for bet in self.pending_bets if bet.created_by == user_id]
-        _found_bet_ids = [bet.id for bet in pending_bets_by_user]
-        pending_bets_by_counterparty = [bet for bet in self.pending_bets
-                                        if bet.counterparty is not None and bet.counterparty == user_id
-                                        and bet.id not in _found_bet_ids]
-        pending_bets = pending_bets_by_user + pending_bets_by_counterparty
+        pending_bets = self.proposals.by_user(user_id)
         for bet in pending_bets:
             if bet.valid_till < datetime.now():
                 logger.info(f"purged expired bet proposal: id: {bet.id}")
-                self.rm_bet_request(bet.id)
+                self.rm_bet_request(bet.id, "expired")
 
         return BetList(active=active_bets, pending=pending_bets)
 
@@ -512,6 +737,9 @@ class ApiV2:
         if existing_user is None:
             try:
                 res = self.user_db.insert_one(new_user.dict())
+                self.users.invalidate(new_user.id, new_user.user_name)
+                self.bets_views.invalidate_user(new_user.id)
+                self.balances.invalidate(new_user.id)
                 logger.info(f"created unverified user {new_user.user_name} with id {res.inserted_id}")
                 _text_1 = "Congrats! We've added you to the system. Follow this link to verify your account:\n"
                 _text_2 = f"https://pvpbet.vercel.app/?{new_user.user_name}"
@@ -535,6 +763,9 @@ class ApiV2:
     def deactivate_user_by_id(self, user_id: int) -> str:
         try:
             res = self.user_db.delete_one({"id": user_id})
+            self.users.invalidate(user_id)
+            self.bets_views.invalidate_user(user_id)
+            self.balances.invalidate(user_id)
             if res.deleted_count == 0:
                 logger.info("user tried deleting nonexistent account")
                 return "You don't have an account yet! Run /setup to create one"
@@ -565,6 +796,7 @@ class ApiV2:
             query = {"id": user_id}
             new_values = {"$set": {"verified": True}}
             self.user_db.update_one(query, new_values)
+            self.users.invalidate(user_id)
             logger.debug(f"verified user {new_user.user_name} with id {user_id}, updated db record")
             return True, "🤑 Congrats! We've verified your wallet; you're all ready to start betting! 🤑"
         else:
@@ -577,14 +809,7 @@ class ApiV2:
         if type(user_id) != int:
             _err_msg = "CRITICAL: user_id is not an int, you are passing in a raw user object, which is not allowed"
             raise TypeError(_err_msg)
-        query = self.user_db.find_one({"id": user_id})
-        if query is None:
-            return None
-        try:
-            return User(**query)
-        except ValidationError:
-            logger.warning(f"failed to get user with id {user_id} from db")
-            return None
+        return self.users.get_by_id(user_id, lambda _id: self.user_db.find_one({"id": _id}))
 
     def get_user_by_username(self, user_name: str):
         if type(user_name) is int:
@@ -592,33 +817,102 @@ class ApiV2:
             return None
         if user_name[0] == "@":
             user_name = user_name[1:]
-        query = self.user_db.find_one({"user_name": user_name})
-        try:
-            return User(**query)
-        except (ValidationError, TypeError):
-            logger.warning(f"failed to get user with username {user_name} from db")
-            return None
+        return self.users.get_by_name(
+            user_name, lambda _name: self.user_db.find_one({"user_name": _name}, collation=USERNAME_COLLATION))
 
-    # returns available, locked in WEI
+    # returns available, locked in WEI. always read from the chain (this is what accepts are checked against), and
+    # the balance cache is refreshed with the result
     def get_user_balance_by_id(self, user_id: int):
-        _user_addr = self.get_user_by_id(user_id).wallet_addr
-        _avail = self.contract_instance.functions.getSpendableBalance(_user_addr).call()
-        _locked = self.contract_instance.functions.getLockedBalance(_user_addr).call()
-
+        _avail, _locked = self.balances.refresh(user_id)
         return _avail, _locked
 
-    def transact(self, transaction, _account):
-        logger.info(f"requesting txn signature with account {_account.address}")
-        nonce = self.w3.eth.get_transaction_count(_account.address)
-        # gas_estimate = self.contract_instance.functions.deposit().estimate_gas()
-        # print(gas_estimate) # danger: will fail txn if called like this with no deposit value!
-        transaction.update({"nonce": nonce})
-
-        signed_txn = _account.sign_transaction(transaction)
-        result = self.w3.eth.send_raw_transaction(signed_txn.rawTransaction)
+    # both balances in one batched eth_call, like _read_constants; None if there's no such user
+    _BALANCE_FNS = ("getSpendableBalance", "getLockedBalance")
 
-        tx_receipt = self.w3.eth.wait_for_transaction_receipt(result)
-        return tx_receipt
+    def _read_balances(self, user_id: int) -> tuple[int, int] | None:
+        _user = self.get_user_by_id(user_id)
+        if _user is None:
+            return None
+        _user_addr = _user.wallet_addr
+        payload = [{"jsonrpc": "2.0", "id": i, "method": "eth_call",
+                    "params": [{"to": self.contract_instance.address, "data": self.txs.calldata(fn, _user_addr)},
+                               "latest"]}
+                   for i, fn in enumerate(self._BALANCE_FNS)]
+        try:
+            with metrics.outbound("l2_rpc", "eth_call_batch"):
+                results = {r["id"]: r.get("result") for r in self.rpc_pool.request_raw(payload, "eth_call")}
+            if results.get(0) and results.get(1):
+                return int(results[0], 16), int(results[1], 16)
+            logger.warning(f"batched balance read came back incomplete: {results}")
+        except (RpcEndpointError, TypeError, ValueError, KeyError, AttributeError) as e:
+            logger.warning(f"batched balance read failed, reading one at a time: {e}")
+
+        return (self.contract_instance.functions.getSpendableBalance(_user_addr).call(),
+                self.contract_instance.functions.getLockedBalance(_user_addr).call())
+
+    # nonce-tracked per signing account, so resubmissions of stuck txns reuse the right nonce
+    def _tracker(self, _account) -> TxTracker:
+        with self._tx_trackers_lock:
+            tracker = self._tx_trackers.get(_account.address)
+            if tracker is None:
+                tracker = self._tx_trackers[_account.address] = TxTracker(self.w3, _account, self.fees)
+            return tracker
+
+    # leader-only txns (settlement) pass the lease as `fence`: it's re-verified against mongo right before sending,
+    # and the signing service (if any) refuses txns carrying an outdated fencing token. raises LeaseLost
+    def _fence_kwargs(self, tracker, fence: Lease | None) -> dict:
+        if fence is None:
+            return {}
+        token = fence.verify()
+        return {"fence": (fence.name, token)} if isinstance(tracker, SignerClient) else {}
+
+    # returns the receipt of whichever version of the txn actually got mined (see TxTracker)
+    def transact(self, transaction, _account, fn_name: str = "unknown", fence: Lease | None = None):
+        logger.debug("requesting %s txn signature with account %s", fn_name, _account.address)
+        tracker = self._tracker(_account)
+        return tracker.send(transaction, fn_name, **self._fence_kwargs(tracker, fence))
+
+    # signs and sends several txns back to back with consecutive nonces, then waits for all the receipts,
+    # so n txns cost one round of mining instead of n. one outcome per txn: its receipt, None if it couldn't be sent,
+    # or its TxPending if it went out but wasn't seen mined
+    def transact_many(self, transactions: list, _account, fn_name: str = "unknown",
+                      fence: Lease | None = None) -> list:
+        logger.debug("requesting %d pipelined %s txn signatures with account %s", len(transactions), fn_name,
+                     _account.address)
+        tracker = self._tracker(_account)
+        return tracker.send_many(transactions, fn_name, **self._fence_kwargs(tracker, fence))
+
+    # reads the on-chain `active` flag for many bets with a single json-rpc batch request.
+    # ids missing from the result couldn't be read and should be treated as unknown
+    def get_onchain_bet_active_flags(self, bet_ids: list[int]) -> dict[int, bool]:
+        if not bet_ids:
+            return {}
+        _to = self.contract_instance.address
+        payload = [{"jsonrpc": "2.0", "id": i, "method": "eth_call",
+                    "params": [{"to": _to, "data": self.contract_instance.encodeABI(fn_name="getBet", args=[bet_id])},
+                               "latest"]}
+                   for i, bet_id in enumerate(bet_ids)]
+        try:
+            with metrics.outbound("l2_rpc", "eth_call_batch"):
+                results = self.rpc_pool.request_raw(payload, "eth_call")
+        except RpcEndpointError as e:
+            logger.error(f"batched getBet call failed: {e}")
+            return {}
+        if not isinstance(results, list):
+            logger.error(f"rpc doesn't support batched requests? got: {results}")
+            return {}
+
+        flags = {}
+        for result in results:
+            if result.get('result') is None:
+                continue
+            try:
+                (_bet,) = self.w3.codec.decode(["(address,address,string,uint256,uint256,uint256,bool)"],
+                                               HexBytes(result['result']))
+                flags[bet_ids[result['id']]] = _bet[-1]
+            except (ValueError, IndexError, TypeError):
+                logger.warning(f"couldn't decode getBet result: {result}")
+        return flags
 
     # def get_bet_count(self):
     #     return self.contract_instance.functions.bet_count().call()
@@ -630,13 +924,11 @@ class ApiV2:
     def test_deposit(self, account=None):
         _account = account if account is not None else self.account
 
-        transaction = self.contract_instance.functions.deposit().build_transaction({
-            'value': self.w3.to_wei(1, 'ether'),
-            'gas': self.deposit_gas,
-            'gasPrice': self.w3.to_wei('1', 'gwei')
-        })
+        _fn = self.contract_instance.functions.deposit()
+        transaction = _fn.build_transaction(self.fees.tx_params("deposit", _fn, _account.address, self.deposit_gas,
+                                                                value=self.w3.to_wei(1, 'ether')))
 
-        tx_receipt = self.transact(transaction, _account)
+        tx_receipt = self.transact(transaction, _account, fn_name="deposit")
         tx_hash = tx_receipt.get("transactionHash").hex()
         _err = self.get_txn_error(self.RPC_URL, tx_hash)
         if _err is not None:
@@ -652,216 +944,641 @@ class ApiV2:
         except ValidationError:
             return AcceptBetResponse(success=False, error_msg="invalid user id")
 
-        # then, get the bet request from the pending list:
-        bet_req = self.get_bet_proposal_by_id(bet_id)
-        if bet_req is None:
-            return AcceptBetResponse(success=False, error_msg="invalid bet id, try running \"/bets offered\""
-                                                              "to see valid offers")
-
-        # next, run checks. if error, return error
-        # TODO: check if bet was already accepted
-        # 0. check if chat is correct
-        if bet_req.chat_created_in != chat_id:
-            _msg = f"this bet (id:{bet_req.id}) wasn't offered in this chat!"
-            return AcceptBetResponse(success=False, error_msg=_msg)
-
-        # 1. if counterparty specified, make sure it's the caller, and if it's open to anyone, set it to the caller:
-        if bet_req.counterparty is not None:
-            if bet_req.counterparty != caller_id:
-                _msg = f"this bet (id:{bet_req.id}) wasn't offered to you!"
+        # only one accept per proposal gets past here; a second /accept of the same id is turned away immediately
+        # instead of queueing up behind a makeBet txn that's about to consume the offer anyway
+        with self.accepts.claim(bet_id, caller_id) as claimed:
+            if not claimed:
+                _msg = f"someone is already accepting this bet (id:{bet_id}), hang on a sec"
                 return AcceptBetResponse(success=False, error_msg=_msg)
-        else:
-            bet_req.counterparty = caller_id
-
-        # 2. the offer is still valid (and remove the bet from pending if it's not):
-        if bet_req.valid_till < datetime.now():
-            self.rm_bet_request(bet_req.id)
-            _msg = f"this bet offer (id:{bet_req.id}) has expired! (removed from list of open offers)"
-            return AcceptBetResponse(success=False, error_msg=_msg)
-
-        # 3. the caller has enough funds to accept the bet:
-        _avail, _locked = self.get_user_balance_by_id(caller_id)
-        if self.w3.to_wei(_avail, 'ether') < bet_req.amount:
-            _msg_1 = f"insufficient funds! (id:{bet_req.id})"
-            _msg_2 = f"funds available: {round(self.to_eth(_avail), 4)}"
-            _msg_3 = f"funds required: {round(self.to_eth(bet_req.amount), 4)}"
-            return AcceptBetResponse(success=False, error_msg="\n".join((_msg_1, _msg_2, _msg_3)))
-
-        # 4. the caller has a verified wallet:
-        if not caller.verified:
-            _msg = f"you need to verify your wallet before you can accept bets!"
-            return AcceptBetResponse(success=False, error_msg=_msg)
-
-        # once checks are passed, form the transaction and send it (abi fn signature below for reference)
-        # fn makeBet(address _over, address _under, string calldata _sym, uint256 _amt, uint256 _price, uint256 _exp)
-        _over_user_id = bet_req.created_by if bet_req.creator_over else bet_req.counterparty
-        _under_user_id = bet_req.counterparty if bet_req.creator_over else bet_req.created_by
+            return self._accept_claimed(caller, chat_id, bet_id)
+
+    # /take: accepts the best open offer (to anyone) in this chat on the other side of `over`, for `token`, expiring
+    # within half a day of `bet_expiration`, at a strike no worse than `price` for the taker. candidates come from
+    # the proposal order book best-first; one somebody else is already accepting is skipped for the next best
+    def take_bet(self, caller_id: int, chat_id: int, token: Token, over: bool, price: float,
+                 bet_expiration: str) -> AcceptBetResponse:
         try:
-            _over = self.get_user_by_id(_over_user_id).wallet_addr
+            caller = self.get_user_by_id(caller_id)
         except ValidationError:
-            _msg = f"error: failed to find wallet addr for user {_over_user_id}"
-            return AcceptBetResponse(success=False, error_msg=_msg)
+            return AcceptBetResponse(success=False, error_msg="invalid user id")
+        if caller is None:
+            return AcceptBetResponse(success=False, error_msg="you need to run /setup <wallet addr> first!")
+
+        current_block = self.get_l1_block_number()
+        if current_block is None:
+            logger.error("failed to fetch current block number!")
+            return AcceptBetResponse(success=False, error_msg="failed to fetch current block number!")
         try:
-            _under = self.get_user_by_id(_under_user_id).wallet_addr
-        except ValidationError:
-            _msg = f"error: failed to find wallet addr for user {_under_user_id}"
-            return AcceptBetResponse(success=False, error_msg=_msg)
-
-        _token = str(bet_req.token.id)
-        _amt = bet_req.amount
-        _price = bet_req.price
-        _exp = bet_req.expiry
-
-        txn = self.contract_instance.functions.makeBet(_over, _under, _token, _amt, _price, _exp).build_transaction({
-            'from': self.account.address,
-            'gas': self.accept_gas,         # max gas used in tests was ~250k, but since gas is free on l2, fuck it
-            'gasPrice': self.w3.to_wei('3', 'gwei')
-        })
-
-        # remove the bet from the pending list *before* sending the txn
-        # this way, if pending list de-sync's with some weird runtime error,
-        # it's only missing pending bets rather than having duplicates
-        if not self.rm_bet_request(bet_req.id):
-            return AcceptBetResponse(success=False, error_msg="unknown error, couldn't remove bet from pending list")
-
-        # TODO: signing server signing server signing server!
-        tx_receipt = self.transact(txn, self.account)
+            block_exp = self.parse_date_expr(current_block, bet_expiration)
+            _limit = self.w3.to_wei(price, 'ether')
+        except (ValueError, TypeError):
+            return AcceptBetResponse(success=False, error_msg="invalid price or expiration!")
+
+        for bet_id in self.proposals.matches(chat_id, token.id, over, block_exp, _limit, taker_id=caller_id):
+            with self.accepts.claim(bet_id, caller_id) as claimed:
+                if not claimed or self.get_bet_proposal_by_id(bet_id) is None:
+                    continue
+                logger.info("user %s is taking proposal %s", caller_id, bet_id, extra={"proposal": bet_id})
+                return self._accept_claimed(caller, chat_id, bet_id)
+
+        _side = "over" if over else "under"
+        _msg = f"no open offer to take {_side} ${price} on {token.symbol} around {bet_expiration} from now, " \
+               f"try \"/bets offered\" or post your own with /bet"
+        return AcceptBetResponse(success=False, error_msg=_msg)
+
+    # the rest of accept_bet, run while holding the claim on bet_id. the proposal in the pending list is never
+    # mutated here (it may be re-appended on failure, and other threads read it), all derived state is local
+    def _accept_claimed(self, caller: User, chat_id: int, bet_id: int) -> AcceptBetResponse:
+        caller_id = caller.id
+        with self.accepts.chat(chat_id):
+            # then, get the bet request from the pending list:
+            bet_req = self.get_bet_proposal_by_id(bet_id)
+            if bet_req is None:
+                return AcceptBetResponse(success=False, error_msg="invalid bet id, try running \"/bets offered\""
+                                                                  "to see valid offers")
+
+            # next, run checks. if error, return error
+            # 0. check if chat is correct
+            if bet_req.chat_created_in != chat_id:
+                _msg = f"this bet (id:{bet_req.id}) wasn't offered in this chat!"
+                return AcceptBetResponse(success=False, error_msg=_msg)
+
+            # 1. if counterparty specified, make sure it's the caller, and if it's open to anyone, the caller takes it:
+            if bet_req.counterparty is not None and bet_req.counterparty != caller_id:
+                _msg = f"this bet (id:{bet_req.id}) wasn't offered to you!"
+                return AcceptBetResponse(success=False, error_msg=_msg)
+            _counterparty_id = caller_id
+
+            # 2. the offer is still valid (and remove the bet from pending if it's not):
+            if bet_req.valid_till < datetime.now():
+                self.rm_bet_request(bet_req.id, "expired")
+                _msg = f"this bet offer (id:{bet_req.id}) has expired! (removed from list of open offers)"
+                return AcceptBetResponse(success=False, error_msg=_msg)
+
+        # balance checks and makeBet are serialized per participant: two accepts touching the same user would
+        # otherwise both pass the balance check and the second would revert on-chain
+        with self.accepts.users(bet_req.created_by, _counterparty_id):
+            # 3. both sides can cover the bet (all in wei); the creator's funds may have moved since they offered it,
+            # and makeBet would only revert on it:
+            for _user_id in (caller_id, bet_req.created_by):
+                _avail, _locked = self.get_user_balance_by_id(_user_id)
+                if _avail < bet_req.amount:
+                    _msg_1 = f"insufficient funds! (id:{bet_req.id})" if _user_id == caller_id else \
+                        f"the creator of this bet can't cover it any more! (id:{bet_req.id})"
+                    _msg_2 = f"funds available: {round(self.to_eth(_avail), 4)}"
+                    _msg_3 = f"funds required: {round(self.to_eth(bet_req.amount), 4)}"
+                    return AcceptBetResponse(success=False, error_msg="\n".join((_msg_1, _msg_2, _msg_3)))
+
+            # 4. the caller has a verified wallet:
+            if not caller.verified:
+                _msg = f"you need to verify your wallet before you can accept bets!"
+                return AcceptBetResponse(success=False, error_msg=_msg)
+
+            # once checks are passed, form the transaction and send it (abi fn signature below for reference)
+            # fn makeBet(address _over, address _under, string calldata _sym, uint256 _amt, uint256 _price, uint256 _exp)
+            _over_user_id = bet_req.created_by if bet_req.creator_over else _counterparty_id
+            _under_user_id = _counterparty_id if bet_req.creator_over else bet_req.created_by
+            try:
+                _over = self.get_user_by_id(_over_user_id).wallet_addr
+            except ValidationError:
+                _msg = f"error: failed to find wallet addr for user {_over_user_id}"
+                return AcceptBetResponse(success=False, error_msg=_msg)
+            try:
+                _under = self.get_user_by_id(_under_user_id).wallet_addr
+            except ValidationError:
+                _msg = f"error: failed to find wallet addr for user {_under_user_id}"
+                return AcceptBetResponse(success=False, error_msg=_msg)
+
+            _token = str(bet_req.token.id)
+            _amt = bet_req.amount
+            _price = bet_req.price
+            _exp = bet_req.expiry
+
+            with tracing.span("build_transaction", fn="makeBet"):
+                txn = self.txs.build(self.txs.make_bet(_over, _under, _token, _amt, _price, _exp), "makeBet",
+                                     self.accept_gas)
+
+            # remove the bet from the pending list *before* sending the txn
+            # this way, if pending list de-sync's with some weird runtime error,
+            # it's only missing pending bets rather than having duplicates
+            with self.accepts.chat(chat_id):
+                if self.proposals.claim(bet_req.id, caller_id) is None:
+                    return AcceptBetResponse(success=False, error_msg="this offer is no longer open (id:"
+                                                                      f"{bet_req.id}), it was withdrawn or expired")
+                self.bets_views.invalidate(bet_req.chat_created_in, (bet_req.created_by, bet_req.counterparty))
+
+            # everything the bet needs except what comes from the receipt (its id and creation hash)
+            _fields = dict(chat_created_in=chat_id, created_at=int(bet_req.created_at.timestamp()),
+                           over_user_id=_over_user_id, under_user_id=_under_user_id, token=_token,
+                           amount=str(_amt), price=str(_price), expiry=_exp)
+            try:
+                tx_receipt = self.transact(txn, self.account, fn_name="makeBet")
+            except TxPending as e:
+                # the txn may still land, so the offer stays claimed (putting it back is how you get duplicate
+                # bets); reconcile_pending makes the bet, or reopens the offer, once it knows which
+                logger.error(f"makeBet for proposal {bet_req.id} still unmined after all fee bumps")
+                try:
+                    self.pending.add(e, "makeBet", proposal_id=bet_req.id, bet=_fields)
+                except PyMongoError as journal_error:
+                    logger.error(f"couldn't journal makeBet txn {e.hashes[-1]}: {journal_error}")
+                    self.proposals.remove(bet_req.id)
+                    return AcceptBetResponse(success=False, tx_hash=e.hashes[-1],
+                                             error_msg="transaction is taking too long to confirm, check /bets in a "
+                                                       "few minutes")
+                return AcceptBetResponse(success=False, tx_hash=e.hashes[-1],
+                                         error_msg="transaction is taking too long to confirm, you'll get a message "
+                                                   "here once it's through")
+            except Exception:
+                # the txn may or may not have gone out; with nothing to look for later, the offer stays off the list
+                self.proposals.remove(bet_req.id)
+                raise
+
+        return self._finish_accept(bet_req.id, _fields, tx_receipt)
+
+    # bookkeeping once a makeBet for a claimed proposal is mined, right away or via reconcile_pending
+    def _finish_accept(self, proposal_id: int, fields: dict, tx_receipt) -> AcceptBetResponse:
         tx_hash = tx_receipt.get('transactionHash').hex()
-        _bet_id = None
+        chat_id = fields["chat_created_in"]
+        _participants = (fields["over_user_id"], fields["under_user_id"])
         # if the txn succeeds, we have to do a bunch of bookkeeping
         if tx_receipt.status:
-            _unix_time = int(bet_req.created_at.timestamp())
+            self.proposals.accepted(proposal_id)
             # TODO: low-prio get rest of info from the emitted event
             # _bet_id will always be unique because it's coming straight from the contract
             _bet_id = int(tx_receipt.get('logs')[0].get('data')[:32].hex(), 16)
-            bet = Bet(id=_bet_id, chat_created_in=chat_id, created_at=_unix_time, over_user_id=_over_user_id,
-                      under_user_id=_under_user_id, token=_token, amount=str(_amt), price=str(_price), expiry=_exp,
-                      creation_hash=tx_hash)
+            bet = Bet(id=_bet_id, creation_hash=tx_hash, **fields)
 
             # add the bet to the database and in-memory list
-            self.active_bets_db.insert_one(bet.dict())
-            self.bet_cache.push(bet)
-
-            return AcceptBetResponse(success=True, tx_hash=tx_hash, bet=bet, error_msg=None)
+            self.bet_writes.upsert(bet.dict())
+            _saved = self._flush_durable(f"bet {_bet_id}")
+            # add, not push: the change feed may have seen the insert first
+            self.bet_cache.add(bet)
+            self.bets_views.invalidate(chat_id, _participants)
+            self.balances.invalidate(*_participants)
+
+            # the bet exists either way; it's only other replicas (and a restart without the journal) that won't
+            # see it until the retried flush goes through
+            _msg = None if _saved else "the bet is on-chain, but saving it to the bot's database is delayed"
+            return AcceptBetResponse(success=True, tx_hash=tx_hash, bet=bet, error_msg=_msg)
         else:
-            # add the bet back to the pending list if the txn fails
-            self.pending_bets.append(bet_req)
             _revert_msg = self.get_txn_error(self.RPC_URL, tx_hash)
             _deleted_req_msg = ""
             if _revert_msg is None:
                 _revert_msg = "unknown error"
+            if _revert_msg == "bet expiration too soon":
+                _deleted_req_msg = "(removed from list of open offers)"
+                self.proposals.remove(proposal_id, "expired")
             else:
-                if _revert_msg == "bet expiration too soon":
-                    removed = self.rm_bet_request(bet_req.id)
-                    if removed:
-                        _deleted_req_msg = "(removed from list of open offers)"
-                    else:
-                        logger.warning("couldn't remove bet from pending list, hushing notification to user")
+                # add the (untouched) bet back to the pending list if the txn fails; we still hold the claim, so
+                # nobody can have accepted it in the meantime
+                with self.accepts.chat(chat_id):
+                    self.proposals.release(proposal_id)
+                self.bets_views.invalidate(chat_id, _participants)
             logger.warning(f"txn failed! tx_hash: {tx_hash}. reason={_revert_msg}")
             _msg = f"transaction failed: {_revert_msg} {_deleted_req_msg}"
             return AcceptBetResponse(success=False, tx_hash=tx_hash, error_msg=_msg)
 
-    def settle_bet(self, bet: Bet) -> SettleBetResponse:
-        # function settleBet(uint256 bet_id, bool over_wins) public onlyBookie {
+    # resolves the settlement price for a bet. returns (over_wins, token, current_price), or an error response
+    def _price_bet(self, bet: Bet) -> tuple[bool, Token, float] | SettleBetResponse:
         bet_price = self.to_eth(int(bet.price))         # to_eth just converts from 1e18, this unit is in $
         token_type = bet.token_type
 
         if token_type != "cmc_int_id_v0":
             # currently only one resolver hence return early, in the future, can use elif/match
             logger.error("invalid token price resolver invoked!")
-            return SettleBetResponse(success=False, error_msg="Invalid token type: No matching resolver!")
+            return SettleBetResponse(success=False, bet=bet, error_msg="Invalid token type: No matching resolver!")
 
         # TODO: (very low prio) if token id refuses to match after N tries, invalidate the bet
         # low prio because bettors can just mutually agree to invalidate as per the contract
         _token = self.get_token_by_id(int(bet.token))
         if _token is None:
             logger.warning("get_token_by_id returned None!")
-            return SettleBetResponse(success=False, error_msg="Invalid token id: No matching token!")
+            return SettleBetResponse(success=False, bet=bet, error_msg="Invalid token id: No matching token!")
         current_price = self.get_token_price(_token)
         if current_price is None:
             logger.warning("get_token_price returned None!")
-            return SettleBetResponse(success=False, error_msg=f"error resolving price for token: {_token}")
+            return SettleBetResponse(success=False, bet=bet, error_msg=f"error resolving price for token: {_token}")
 
         _over_wins = False
         if bet_price < current_price:
             _over_wins = True
+        return _over_wins, _token, current_price
+
+    # formats the message to be delivered to the chat once a bet is settled
+    def _settled_msg(self, bet: Bet, _over_wins: bool, _token: Token, current_price: float) -> str:
+        _winner_id = bet.over_user_id if _over_wins else bet.under_user_id
+        _winner_name = self.get_user_by_id(_winner_id).user_name
+        _loser_id = bet.under_user_id if _over_wins else bet.over_user_id
+        _loser_name = self.get_user_by_id(_loser_id).user_name
+        _winner_side = "over" if _over_wins else "under"
+        _timestamp = datetime.fromtimestamp(bet.created_at).strftime("%d/%m/%Y, %H:%M")
+        _msg_ln_1 = f"🎉 @{_winner_name} has vanquished @{_loser_name}! 🎉\n"
+        _msg_ln_2 = f"@{_winner_name} bet {round(self.to_eth(int(bet.amount)), 4)}ETH on {_timestamp} that {_token.symbol} would trade "
+        _msg_ln_3 = f"{_winner_side} ${round(self.to_eth(int(bet.price)), 4)}, (now ${round(current_price, 4)}) and @{_loser_name} took the other side."
+        return _msg_ln_1 + _msg_ln_2 + _msg_ln_3
+
+    def settle_bet(self, bet: Bet, fence: Lease | None = None) -> SettleBetResponse:
+        # function settleBet(uint256 bet_id, bool over_wins) public onlyBookie {
+        _priced = self._price_bet(bet)
+        if isinstance(_priced, SettleBetResponse):
+            return _priced
+        _over_wins, _token, current_price = _priced
 
-        txn = self.contract_instance.functions.settleBet(bet.id, _over_wins).build_transaction({
-            'from': self.account.address,
-            'gas': self.settle_gas,                     # settling took max 40k in tests, but I really want to be cautious
-            'gasPrice': self.w3.to_wei('3', 'gwei')
-        })
-        tx_receipt = self.transact(txn, self.account)
+        with tracing.span("build_transaction", fn="settleBet"):
+            txn = self.txs.build(self.txs.settle_bet(bet.id, _over_wins), "settleBet", self.settle_gas)
+        try:
+            tx_receipt = self.transact(txn, self.account, fn_name="settleBet", fence=fence)
+        except TxPending as e:
+            return self._journal_settlement(e, "settleBet", [(bet, *_priced)])[0]
         tx_hash = tx_receipt.get('transactionHash').hex()
         if tx_receipt.status:
-            # format the message to be delivered
-            _winner_id = bet.over_user_id if _over_wins else bet.under_user_id
-            _winner_name = self.get_user_by_id(_winner_id).user_name
-            _loser_id = bet.under_user_id if _over_wins else bet.over_user_id
-            _loser_name = self.get_user_by_id(_loser_id).user_name
-            _winner_side = "over" if _over_wins else "under"
-            _timestamp = datetime.fromtimestamp(bet.created_at).strftime("%d/%m/%Y, %H:%M")
-            _msg_ln_1 = f"🎉 @{_winner_name} has vanquished @{_loser_name}! 🎉\n"
-            _msg_ln_2 = f"@{_winner_name} bet {round(self.to_eth(int(bet.amount)), 4)}ETH on {_timestamp} that {_token.symbol} would trade "
-            _msg_ln_3 = f"{_winner_side} ${round(self.to_eth(int(bet.price)), 4)}, (now ${round(current_price, 4)}) and @{_loser_name} took the other side."
-            _msg = _msg_ln_1 + _msg_ln_2 + _msg_ln_3
-
             # return the result to the client
-            return SettleBetResponse(success=True, tx_hash=tx_hash, error_msg=None,
-                                     success_msg=_msg, bet=bet)
+            return self._settled_responses([(bet, *_priced)], tx_receipt)[0]
         else:
-            logger.warning(f"settle txn failed! (id:{bet.id})")
+            logger.warning("settle txn failed! (id:%s)", bet.id, extra={"bet_id": bet.id, "tx_hash": tx_hash})
             _msg = f"settle txn failed! (id:{bet.id})"
             _reason = ApiV2.get_txn_error(self.RPC_URL, tx_hash)
             if _reason is not None and _reason.__contains__("bet has already been settled or invalidated"):
                 # succes=true with an error message is uh... not great
                 # but technically the bet was settled... in this case, don't push a message to the client
-                return SettleBetResponse(success=True, tx_hash=tx_hash, bet=bet,
-                                         error_msg=_reason, over_wins=_over_wins)
+                return SettleBetResponse(success=True, tx_hash=tx_hash, bet=bet, error_msg=_reason)
             return SettleBetResponse(success=False, tx_hash=tx_hash, bet=bet, error_msg=_msg)
 
-    # memory/db sync happens here, based on result of settle_bet, not in settle_bet itself
-    def settle_outstanding(self) -> list[SettleBetResponse]:
-        settled = False
+    # splits priced bets into chunks whose settleBets() gas stays under the per-txn budget
+    def _chunk_by_gas(self, priced: list) -> list[list]:
+        _per_chunk = max(1, (self.settle_batch_gas_budget - self.settle_batch_base_gas) // self.settle_batch_per_bet_gas)
+        return [priced[i:i + _per_chunk] for i in range(0, len(priced), _per_chunk)]
+
+    # settles many due bets with as few settleBets() txns as the gas budget allows.
+    # responses come back in the same order as the input bets. `responses` (bet id -> response) is filled in as bets
+    # are resolved, so a caller can still tell which ones were settled if this raises
+    def settle_bets_batch(self, bets: list[Bet], fence: Lease | None = None,
+                          responses: dict | None = None) -> list[SettleBetResponse]:
+        responses = responses if responses is not None else {}
+        priced = []
+        for bet in bets:
+            _priced = self._price_bet(bet)
+            if isinstance(_priced, SettleBetResponse):
+                settle_log.debug("couldn't price bet %s: %s", bet.id, _priced.error_msg)
+                responses[bet.id] = _priced
+                self._unpriceable.add(bet.id)
+            else:
+                priced.append((bet, *_priced))
+                self._unpriceable.discard(bet.id)
+
+        try:
+            self._settle_chunks(priced, responses, fence)
+        except LeaseLost as e:
+            # another replica is the leader now; whatever didn't go out here is re-queued and becomes its job
+            logger.warning(f"stopped settling mid-batch: {e}")
+            for bet in bets:
+                responses.setdefault(bet.id, SettleBetResponse(success=False, bet=bet,
+                                                               error_msg="lost the settlement lease"))
+        except Exception as e:
+            # an rpc error, a txn that couldn't be built or sent...: what was settled before it stays settled, the
+            # rest comes back as failed and gets re-queued
+            logger.exception(f"settling stopped mid-batch after {len(responses)}/{len(bets)} bets: {e}")
+            for bet in bets:
+                responses.setdefault(bet.id, SettleBetResponse(success=False, bet=bet,
+                                                               error_msg=f"settlement failed: {e}"))
+
+        return [responses[bet.id] for bet in bets]
+
+    def _settle_chunks(self, priced: list, responses: dict, fence: Lease | None):
+        for chunk in self._chunk_by_gas(priced):
+            _ids = [bet.id for bet, _, _, _ in chunk]
+            _over_wins = [over_wins for _, over_wins, _, _ in chunk]
+            settle_log.debug("settleBets chunk: %s", list(zip(_ids, _over_wins, [p for _, _, _, p in chunk])))
+            with tracing.span("build_transaction", fn="settleBets", size=len(chunk)):
+                _fallback_gas = self.settle_batch_base_gas + self.settle_batch_per_bet_gas * len(chunk)
+                txn = self.txs.build(self.txs.settle_bets(_ids, _over_wins), "settleBets", _fallback_gas,
+                                     items=len(chunk), item_margin=self.settle_batch_item_margin)
+            try:
+                tx_receipt = self.transact(txn, self.account, fn_name="settleBets", fence=fence)
+            except TxPending as e:
+                for resp in self._journal_settlement(e, "settleBets", chunk):
+                    responses[resp.bet.id] = resp
+                continue
+            tx_hash = tx_receipt.get('transactionHash').hex()
+
+            if not tx_receipt.status:
+                # one bad bet reverts the whole chunk; fall back to settling individually so the rest still go through
+                logger.warning(f"settleBets txn failed ({tx_hash}), "
+                               f"reason={self.get_txn_error(self.RPC_URL, tx_hash)}; settling {len(chunk)} bets one by one")
+                for bet, _, _, _ in chunk:
+                    responses[bet.id] = self.settle_bet(bet, fence)
+                continue
+
+            _settled = self._settled_responses(chunk, tx_receipt)
+            for resp in _settled:
+                responses[resp.bet.id] = resp
+            logger.info("settled %d/%d bets in one txn (%s)", sum(r.over_wins is not None for r in _settled),
+                        len(chunk), tx_hash)
+
+    # responses for (bet, over_wins, token, price) entries settled by a mined settleBet/settleBets txn
+    def _settled_responses(self, priced: list, tx_receipt) -> list[SettleBetResponse]:
+        tx_hash = tx_receipt.get('transactionHash').hex()
+        # bets that were already inactive are skipped by the contract and don't emit BetSettled
+        _settled_ids = {e['args']['_bet_id'] for e in
+                        self.contract_instance.events.BetSettled().process_receipt(tx_receipt, errors=DISCARD)}
+        responses = []
+        for bet, over_wins, _token, current_price in priced:
+            if bet.id in _settled_ids:
+                _msg = self._settled_msg(bet, over_wins, _token, current_price)
+                responses.append(SettleBetResponse(success=True, tx_hash=tx_hash, error_msg=None, success_msg=_msg,
+                                                   bet=bet, over_wins=over_wins, settle_price=current_price))
+            else:
+                # already settled counts as settled, but no chat message
+                responses.append(SettleBetResponse(success=True, tx_hash=tx_hash, bet=bet,
+                                                   error_msg="bet has already been settled or invalidated"))
+        return responses
+
+    # a settlement txn that timed out unmined: its bets are journaled and kept out of the book (neither settled nor
+    # re-queued) until reconcile_pending knows what happened to it. if even the journal write fails, they come back
+    # as failed and get re-queued; settling one twice only reverts as already settled
+    def _journal_settlement(self, pending: TxPending, fn_name: str, priced: list) -> list[SettleBetResponse]:
+        logger.error(f"{fn_name} for {len(priced)} bets still unmined after all fee bumps")
+        _hash = pending.hashes[-1]
+        try:
+            self.pending.add(pending, fn_name, bets=[
+                {"bet": bet.dict(), "over_wins": over_wins, "token": _token.dict(), "settle_price": current_price}
+                for bet, over_wins, _token, current_price in priced])
+        except PyMongoError as e:
+            logger.error(f"couldn't journal {fn_name} txn {_hash}: {e}")
+            return [SettleBetResponse(success=False, bet=bet, tx_hash=_hash, error_msg=f"{fn_name} txn unmined")
+                    for bet, *_ in priced]
+        self._unconfirmed.update(bet.id for bet, *_ in priced)
+        return [SettleBetResponse(success=False, pending=True, bet=bet, tx_hash=_hash,
+                                  error_msg=f"{fn_name} txn not mined yet, will reconcile")
+                for bet, *_ in priced]
+
+    # memory/db sync happens here, based on result of settle_bets_batch, not in the settle methods themselves.
+    # with several replicas, only the holder of `fence` (the settlement lease) gets txns out
+    def settle_outstanding(self, fence: Lease | None = None) -> list[SettleBetResponse]:
         current_block = self.get_l1_block_number()
         if current_block is None:
             logger.error("couldn't get current block number!")
-            settled = True
-        responses = []
-        failures = []
-        while not settled:
-            # peek at the next bet to settle
-            next_expiration = self.bet_cache.peek()
-
-            # if nothing left to settle as of current block, we're done
-            if next_expiration is None:
-                settled = True
-                break
-            if next_expiration > current_block:
-                settled = True
-                break
-
-            # otherwise, pop the bet off the queue, and try to settle it
-            _bet_to_settle = self.bet_cache.pop()
-            resp = self.settle_bet(_bet_to_settle)
+            return []
 
-            # if the txn fails for some reason, re-queue the bet (after trying other eligible bets)
-            if not resp.success:
-                logger.error(f"error settling bet (id:{_bet_to_settle.id})! {resp.error_msg}")
-                failures.append(_bet_to_settle)
-            else:
-                # if the txn succeeds, drop the bet from the database
-                self.active_bets_db.delete_one({'id': _bet_to_settle.id})
-                if resp.error_msg:
-                    logger.warning(f"settle_bet(bet id:{_bet_to_settle.id}) returned {resp.error_msg}")
-                logger.debug(f"dropped bet (id: {_bet_to_settle.id}) from active bets db after successful settle")
+        # pop everything that's due as of the current block
+        due = []
+        while (_bet := self.bet_cache.pop_due(current_block)) is not None:
+            due.append(_bet)
+        if not due:
+            return []
 
-            responses.append(resp)
+        self._settling.update(b.id for b in due)
+        resolved = {}
+        try:
+            with settle_log.run():
+                settle_log.debug("settling %d due bets at block %d: %s", len(due), current_block, [b.id for b in due])
+                return self._apply_settlements(due, current_block, fence, resolved)
+        except Exception:
+            # popped bets must not fall out of the book: anything without a confirmed (or journaled, see
+            # _journal_settlement) settlement goes back in (add, not push: failures may have been re-queued already)
+            _requeue = [b for b in due if b.id not in resolved
+                        or not (resolved[b.id].success or resolved[b.id].pending)]
+            for bet in _requeue:
+                self.bet_cache.add(bet)
+            logger.error(f"settlement round failed, re-queued {len(_requeue)}/{len(due)} bets")
+            raise
+        finally:
+            self._settling.difference_update(b.id for b in due)
+
+    def _apply_settlements(self, due: list[Bet], current_block: int, fence: Lease | None,
+                           resolved: dict) -> list[SettleBetResponse]:
+        responses = self.settle_bets_batch(due, fence, resolved)
+        failures = []
+        for resp in responses:
+            # a txn that's still out there is reconcile_pending's to finish
+            if resp.pending:
+                logger.warning("settlement of bet (id:%s) not mined yet (%s)", resp.bet.id, resp.tx_hash,
+                               extra={"bet_id": resp.bet.id})
+            # if the txn fails for some reason, re-queue the bet (after trying other eligible bets)
+            elif not resp.success:
+                logger.error("error settling bet (id:%s)! %s", resp.bet.id, resp.error_msg,
+                             extra={"bet_id": resp.bet.id})
+                failures.append(resp.bet)
 
         # re-queue the bets which failed to settle
         for fail in failures:
             self.bet_cache.push(fail)
-            logger.debug("re-queued bet (id: {_bet_to_settle.id}) after failed settle")
+            settle_log.debug("re-queued bet (id: %s) after failed settle", fail.id)
 
+        self._record_settlements([resp for resp in responses if resp.success], current_block)
         return responses
-        # need to check if error is due to already settled bet, and remove it if so
+
+    # drops settled bets from the database (all of them in one write) and archives them for /stats.
+    # current_block is only for the settlement lag metric
+    def _record_settlements(self, settled: list[SettleBetResponse], current_block: int | None):
+        archived = []
+        for resp in settled:
+            _bet_to_settle = resp.bet
+            self.bet_writes.delete(_bet_to_settle.id)
+            self.bets_views.invalidate(_bet_to_settle.chat_created_in,
+                                       (_bet_to_settle.over_user_id, _bet_to_settle.under_user_id))
+            self.balances.invalidate(_bet_to_settle.over_user_id, _bet_to_settle.under_user_id)
+            if current_block is not None:
+                metrics.SETTLEMENT_LAG_BLOCKS.observe(max(current_block - _bet_to_settle.expiry, 0))
+            if resp.over_wins is not None:
+                archived.append(SettledBet(
+                    bet=_bet_to_settle, over_wins=resp.over_wins, settle_price=resp.settle_price,
+                    tx_hash=resp.tx_hash, settled_at=datetime.utcnow(),
+                    rake=str(self.rake_percentage * 2 * int(_bet_to_settle.amount) // self.percentage_basis)))
+            if resp.error_msg:
+                logger.warning("settle_bet(bet id:%s) returned %s", _bet_to_settle.id, resp.error_msg)
+            settle_log.debug("dropped bet (id: %s) from active bets db after successful settle", _bet_to_settle.id)
+
+        self._flush_durable(f"dropping {len(settled)} settled bets")
+        # the bets are settled on-chain either way; losing their stats is unfortunate, not fatal
+        try:
+            self.stats.record(archived)
+        except PyMongoError as e:
+            logger.error(f"failed to archive {len(archived)} settled bets: {e}")
+
+    #### UNMINED TXNS ####
+    # makeBet/settleBet(s) txns the tracker gave up waiting on (see _journal_settlement, _accept_claimed). each
+    # round looks for a receipt under any of the hashes broadcast for it; once the nonce is used up by something
+    # else without one, the txn was dropped. returns (chat id, message) for the chats that were told to wait.
+    # runs on every replica, each for its own journal entries
+    def reconcile_pending(self) -> list[tuple[int, str]]:
+        if not self._reconcile_lock.acquire(blocking=False):
+            return []
+        try:
+            messages = []
+            for doc in self.pending.mine():
+                done, tx_receipt = self._pending_receipt(doc)
+                if not done:
+                    continue
+                if doc["fn"] == "makeBet":
+                    messages += self._reconcile_accept(doc, tx_receipt)
+                elif doc["fn"] == "invalidateStaleBet":
+                    messages += self._reconcile_invalidation(doc, tx_receipt)
+                else:
+                    messages += self._reconcile_settlement(doc, tx_receipt)
+                self.pending.resolve(doc["_id"])
+            return messages
+        finally:
+            self._reconcile_lock.release()
+
+    # (True, receipt) once mined, (True, None) once dropped, (False, None) while it may still land
+    def _pending_receipt(self, doc: dict) -> tuple[bool, object]:
+        # the nonce is read first: if it's used up and none of our versions has a receipt after that, none ever will
+        _nonce_used = doc["nonce"] is not None and \
+            self.w3.eth.get_transaction_count(self.account.address) > doc["nonce"]
+        for tx_hash in reversed(doc["hashes"]):
+            try:
+                tx_receipt = self.w3.eth.get_transaction_receipt(tx_hash)
+            except TransactionNotFound:
+                continue
+            if tx_receipt is not None:
+                return True, tx_receipt
+        return _nonce_used, None
+
+    def _reconcile_accept(self, doc: dict, tx_receipt) -> list[tuple[int, str]]:
+        proposal_id = doc["proposal_id"]
+        chat_id = doc["bet"]["chat_created_in"]
+        if tx_receipt is None:
+            logger.warning(f"makeBet txn {doc['_id']} for proposal {proposal_id} was dropped")
+            with self.accepts.chat(chat_id):
+                reopened = self.proposals.release(proposal_id)
+            self.bets_views.invalidate(chat_id, (doc["bet"]["over_user_id"], doc["bet"]["under_user_id"]))
+            _reopened = " and the offer is open again" if reopened is not None else ""
+            return [(chat_id, f"the transaction accepting bet offer (id:{proposal_id}) was dropped{_reopened}")]
+        resp = self._finish_accept(proposal_id, doc["bet"], tx_receipt)
+        if resp.success:
+            logger.info(f"makeBet txn for proposal {proposal_id} was mined late, bet {resp.bet.id} is on the book")
+            return [(chat_id, f"bet offer (id:{proposal_id}) was accepted after all, it's bet (id:{resp.bet.id}) "
+                              f"now.\n txn hash: {resp.tx_hash}")]
+        return [(chat_id, f"accepting bet offer (id:{proposal_id}) failed: {resp.error_msg}")]
+
+    def _reconcile_settlement(self, doc: dict, tx_receipt) -> list[tuple[int, str]]:
+        priced = [(Bet(**b["bet"]), b["over_wins"], Token(**b["token"]), b["settle_price"]) for b in doc["bets"]]
+        self._unconfirmed.difference_update(bet.id for bet, *_ in priced)
+        if tx_receipt is None or not tx_receipt.status:
+            # back in the book for the next round; one that got settled some other way meanwhile comes back from
+            # that as already settled
+            logger.warning(f"{doc['fn']} txn {doc['_id']} was {'dropped' if tx_receipt is None else 'reverted'}, "
+                           f"re-queueing {len(priced)} bets")
+            for bet, *_ in priced:
+                self.bet_cache.add(bet)
+            return []
+        responses = self._settled_responses(priced, tx_receipt)
+        self._record_settlements(responses, self.get_l1_block_number())
+        logger.info(f"{doc['fn']} txn {doc['_id']} was mined late, settled {len(responses)} bets")
+        return [(resp.bet.chat_created_in, resp.success_msg) for resp in responses if resp.success_msg]
+
+    def _reconcile_invalidation(self, doc: dict, tx_receipt) -> list[tuple[int, str]]:
+        bets = [Bet(**b["bet"]) for b in doc["bets"]]
+        self._unconfirmed.difference_update(bet.id for bet in bets)
+        if tx_receipt is None or not tx_receipt.status:
+            # back in the book; the next sweep tries again if it's still unpriceable by then
+            _what = "dropped" if tx_receipt is None else "reverted"
+            logger.warning(f"invalidateStaleBet txn {doc['_id']} was {_what}, re-queueing {len(bets)} bets")
+            for bet in bets:
+                self.bet_cache.add(bet)
+            return []
+        tx_hash = tx_receipt.get('transactionHash').hex()
+        for bet in bets:
+            self._drop_active_bet(bet)
+        self._flush_durable(f"dropping {len(bets)} late-invalidated bets")
+        logger.info(f"invalidateStaleBet txn {doc['_id']} was mined late, invalidated {len(bets)} bets")
+        return [(bet.chat_created_in, self._invalidated_msg(bet, tx_hash)) for bet in bets]
+
+    def _invalidated_msg(self, bet: Bet, tx_hash: str) -> str:
+        return f"bet (id:{bet.id}) couldn't be priced for {self.invalidation_window} blocks after expiry, " \
+               f"so it was invalidated and both sides' funds were unlocked.\n txn hash: {tx_hash}"
+
+    # bets that are past exp_blockheight + INVALIDATION_WINDOW and still can't be priced will never settle;
+    # invalidate them on-chain (returns both sides' funds) and stop retrying them every settlement round
+    def sweep_stale_bets(self, fence: Lease | None = None) -> list[InvalidateBetResponse]:
+        current_block = self.get_l1_block_number()
+        if current_block is None:
+            logger.error("couldn't get current block number!")
+            return []
+
+        # every bet this far past expiry was just tried (and re-queued) by settlement, which records the ones it
+        # couldn't price; asking coinmarketcap again here would only burn rate-limited credits on the same answer
+        stale = [bet for bet in self.bet_cache.get_bets_due_before(current_block - self.invalidation_window)
+                 if bet.id in self._unpriceable]
+        if not stale:
+            return []
+
+        responses = []
+        _flags = self.get_onchain_bet_active_flags([bet.id for bet in stale])
+        to_invalidate = []
+        for bet in stale:
+            _active = _flags.get(bet.id)
+            if _active is None:
+                logger.warning(f"couldn't read on-chain state for stale bet (id:{bet.id}), skipping this sweep")
+            elif not _active:
+                # already settled/invalidated elsewhere, only the local bookkeeping is stale
+                self._drop_active_bet(bet)
+                responses.append(InvalidateBetResponse(success=True, bet=bet, error_msg="bet was already inactive"))
+            else:
+                to_invalidate.append(bet)
+
+        txns = []
+        for bet in to_invalidate:
+            with tracing.span("build_transaction", fn="invalidateStaleBet"):
+                txns.append(self.txs.build(self.txs.invalidate_stale_bet(bet.id), "invalidateStaleBet",
+                                           self.invalidate_gas))
+        try:
+            outcomes = self.transact_many(txns, self.account, fn_name="invalidateStaleBet", fence=fence)
+        except LeaseLost as e:
+            logger.warning(f"skipping stale bet invalidation: {e}")
+            outcomes = [None] * len(txns)
+        except Exception as e:
+            # nothing to tell which bet a stuck txn was for, so they all get retried next sweep; invalidating one
+            # that did go through just reverts as inactive
+            logger.exception(f"stale bet invalidation failed: {e}")
+            outcomes = [None] * len(txns)
+        for bet, outcome in zip(to_invalidate, outcomes):
+            if outcome is None:
+                responses.append(InvalidateBetResponse(success=False, bet=bet, error_msg="txn couldn't be sent"))
+            elif isinstance(outcome, TxPending):
+                responses.append(self._journal_invalidation(outcome, bet))
+            elif outcome.status:
+                tx_hash = outcome.get('transactionHash').hex()
+                self._drop_active_bet(bet)
+                responses.append(InvalidateBetResponse(success=True, bet=bet, tx_hash=tx_hash,
+                                                       success_msg=self._invalidated_msg(bet, tx_hash)))
+            else:
+                tx_hash = outcome.get('transactionHash').hex()
+                _reason = self.get_txn_error(self.RPC_URL, tx_hash)
+                logger.warning(f"invalidateStaleBet txn failed! (id:{bet.id}) reason={_reason}")
+                responses.append(InvalidateBetResponse(success=False, bet=bet, tx_hash=tx_hash, error_msg=_reason))
+
+        logger.info(f"swept {len([r for r in responses if r.success])}/{len(stale)} stale bets")
+        self._flush_durable(f"dropping {len(stale)} swept bets")
+        return responses
+
+    # like _journal_settlement: the bet leaves the book until reconcile_pending knows whether it was invalidated
+    def _journal_invalidation(self, pending: TxPending, bet: Bet) -> InvalidateBetResponse:
+        logger.error(f"invalidateStaleBet for bet {bet.id} still unmined after all fee bumps")
+        _hash = pending.hashes[-1] if pending.hashes else None
+        try:
+            self.pending.add(pending, "invalidateStaleBet", bets=[{"bet": bet.dict()}])
+        except PyMongoError as e:
+            logger.error(f"couldn't journal invalidateStaleBet txn {_hash}: {e}")
+            return InvalidateBetResponse(success=False, bet=bet, tx_hash=_hash,
+                                         error_msg="invalidateStaleBet txn unmined")
+        self._unconfirmed.add(bet.id)
+        self.bet_cache.remove(bet.id)
+        return InvalidateBetResponse(success=False, pending=True, bet=bet, tx_hash=_hash,
+                                     error_msg="invalidateStaleBet txn not mined yet, will reconcile")
+
+    # with durable_writes, bet writes are flushed before what they're about is reported. a failed flush stays
+    # buffered and journaled and is retried in the background, so this only says whether it's in mongo yet
+    def _flush_durable(self, what: str) -> bool:
+        if not self.durable_writes or self.bet_writes.flush():
+            return True
+        logger.error(f"{what}: not in mongo yet, flush failed (retrying in the background)")
+        return False
+
+    def _drop_active_bet(self, bet: Bet):
+        self._unpriceable.discard(bet.id)
+        self.bet_cache.remove(bet.id)
+        self.bet_writes.delete(bet.id)
+        self.bets_views.invalidate(bet.chat_created_in, (bet.over_user_id, bet.under_user_id))
+        self.balances.invalidate(bet.over_user_id, bet.under_user_id)
@@ -0,0 +1,61 @@
+import time
+import threading
+from collections import OrderedDict
+from . import metrics
+
+
+# contract balances (spendable, locked; wei) by user id, for readers that can live with a few seconds of staleness
+# (the http read api). our own accepts/settlements drop the affected users right away; deposits and withdrawals go
+# straight to the contract, so those only show up once an entry is `ttl` old. the bot's own checks (/balance, the
+# accept path) always read the chain and refresh the entry with what they got
+class BalanceCache:
+    # read(user_id) -> (spendable, locked), or None if there's no such user
+    def __init__(self, read, ttl: float = 30.0, max_size: int = 10_000):
+        self.read = read
+        self.ttl = ttl
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # user id -> (spendable, locked, monotonic time read), lru order
+        self._epoch = 0                 # bumped on every invalidation; a read that raced one isn't stored
+
+    # the cached balances if they're fresh, without ever going to the chain
+    def peek(self, user_id: int) -> tuple[int, int] | None:
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or time.monotonic() - entry[2] > self.ttl:
+                return None
+            self._entries.move_to_end(user_id)
+            return entry[0], entry[1]
+
+    def get(self, user_id: int) -> tuple[int, int] | None:
+        cached = self.peek(user_id)
+        if cached is not None:
+            metrics.CACHE_LOOKUPS.inc(cache="balances", result="hit")
+            return cached
+        metrics.CACHE_LOOKUPS.inc(cache="balances", result="miss")
+        return self.refresh(user_id)
+
+    # always reads the chain. the result is stored unless an invalidation happened while it was being read: that
+    # read may predate the accept/settlement that invalidated it
+    def refresh(self, user_id: int) -> tuple[int, int] | None:
+        with self._lock:
+            epoch = self._epoch
+        balances = self.read(user_id)
+        if balances is not None:
+            self.put(user_id, *balances, epoch=epoch)
+        return balances
+
+    def put(self, user_id: int, spendable: int, locked: int, epoch: int | None = None):
+        with self._lock:
+            if epoch is not None and epoch != self._epoch:
+                return
+            self._entries[user_id] = (spendable, locked, time.monotonic())
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, *user_ids):
+        with self._lock:
+            self._epoch += 1
+            for user_id in user_ids:
+                self._entries.pop(user_id, None)
@@ -0,0 +1,115 @@
+import os
+import sys
+import time
+import signal
+import argparse
+import statistics
+import subprocess
+import requests
+from pathlib import Path
+
+# startup benchmark. everything runs in fresh interpreters, since a warm import cache is exactly what a restart
+# doesn't have:
+#   imports    time to import tgbot.apiv2 / tgbot.main, plus the most expensive imports under tgbot.main
+#   bindings   loading the contract abi from the generated bindings vs parsing the foundry artifact
+#   e2e        (--e2e) process start -> first update answered, against a fake telegram; needs the usual .env
+#              (mongo, rpc, contract) since the bot starts for real
+#
+#   python -m tgbot.bench_startup [--runs 5] [--e2e]
+
+REPO = Path(__file__).resolve().parent.parent
+
+
+def _python(code: str) -> str:
+    out = subprocess.run([sys.executable, "-c", code], cwd=REPO, capture_output=True, text=True, check=True)
+    return out.stdout.strip()
+
+
+def _timed(code: str, runs: int) -> float:
+    _code = f"import time\n_t = time.perf_counter()\n{code}\nprint(time.perf_counter() - _t)"
+    return statistics.median(float(_python(_code)) for _ in range(runs))
+
+
+def bench_imports(runs: int):
+    for module in ("tgbot.apiv2", "tgbot.main"):
+        print(f"import {module:<24} {_timed(f'import {module}', runs) * 1000:8.1f} ms")
+
+    # -X importtime lines: "import time: <self us> | <cumulative us> | <name>"
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", "import tgbot.main"], cwd=REPO,
+                         capture_output=True, text=True, check=True)
+    rows = []
+    for line in out.stderr.splitlines():
+        parts = line.removeprefix("import time:").split("|")
+        # nested imports are indented under their parent
+        if len(parts) == 3 and parts[1].strip().isdigit() and not parts[2][1:].startswith(" "):
+            rows.append((int(parts[1]), parts[2].strip()))
+    print("slowest top-level imports under tgbot.main:")
+    for cumulative, name in sorted(rows, reverse=True)[:10]:
+        print(f"  {name:<32} {cumulative / 1000:8.1f} ms")
+
+
+def bench_bindings(runs: int):
+    from . import abigen
+    artifact = abigen.find_artifact()
+    if artifact is None and not abigen.BINDINGS.exists():
+        print("bindings: no artifact or generated bindings, skipping (run `forge build` in bookie/)")
+        return
+    if artifact is not None:
+        _parse = f"import json\nabi = json.loads(open({str(artifact)!r}).read())['abi']"
+        print(f"abi from artifact ({artifact.stat().st_size // 1024} KiB)  {_timed(_parse, runs) * 1000:8.1f} ms")
+        if not abigen.BINDINGS.exists():
+            abigen.BINDINGS.write_text(abigen.generate(artifact))
+    print(f"abi from generated bindings      {_timed('from tgbot import abigen; abigen.load()', runs) * 1000:8.1f} ms")
+
+
+def bench_e2e(runs: int, port: int):
+    from .fake_telegram import FakeTelegram
+    fake = FakeTelegram(port=port).start()
+    webhook_port = port + 1
+    env = {**os.environ, "BOT_MODE": "webhook", "TG_BASE_URL": fake.base_url, "METRICS_PORT": "0",
+           "WEBHOOK_LISTEN": "127.0.0.1", "WEBHOOK_PORT": str(webhook_port), "WEBHOOK_PATH": "/telegram",
+           "WEBHOOK_URL": f"http://127.0.0.1:{webhook_port}/telegram", "LOG_FILE": ""}
+    samples = []
+    try:
+        for i in range(runs):
+            fake.webhook_url = None
+            seen = len(fake.sent)
+            _t = time.perf_counter()
+            bot = subprocess.Popen([sys.executable, "-m", "tgbot.main"], cwd=REPO, env=env,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                while fake.webhook_url is None:
+                    if bot.poll() is not None:
+                        raise RuntimeError(f"bot exited with {bot.returncode} during startup")
+                    time.sleep(0.005)
+                # the webhook gets registered just before the receiver starts listening
+                while True:
+                    try:
+                        fake.push_command("/start", chat_id=1, user_id=1, username="bench", chat_type="private")
+                        break
+                    except requests.ConnectionError:
+                        time.sleep(0.005)
+                if len(fake.wait_for_messages(seen + 1, timeout=60)) <= seen:
+                    raise RuntimeError("bot didn't answer /start within 60s")
+                samples.append(time.perf_counter() - _t)
+                print(f"run {i + 1}: first update answered after {samples[-1]:.3f}s")
+            finally:
+                bot.send_signal(signal.SIGINT)
+                bot.wait(timeout=30)
+    finally:
+        fake.stop()
+    if samples:
+        print(f"time to first handled update: median {statistics.median(samples):.3f}s over {len(samples)} runs")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="startup benchmark")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--e2e", action="store_true", help="also start the bot for real and time the first reply")
+    parser.add_argument("--port", type=int, default=8091, help="fake telegram port (the bot's webhook uses +1)")
+    args = parser.parse_args()
+
+    bench_imports(args.runs)
+    bench_bindings(args.runs)
+    if args.e2e:
+        bench_e2e(args.runs, args.port)
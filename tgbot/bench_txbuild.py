@@ -0,0 +1,82 @@
+import time
+import argparse
+from web3 import Web3
+from web3.providers.base import BaseProvider
+from . import abigen
+from .fees import FeeOracle
+from .txbuilder import TxBuilder
+
+# txn building benchmark: contract_instance.functions.X(...).build_transaction() (the old path) vs TxBuilder,
+# for makeBet and settleBet. runs offline against a provider that only counts what it's asked, with the fee and
+# gas caches warm, so the numbers are the per-txn cost on the accept/settle hot path
+#
+#   python -m tgbot.bench_txbuild [--n 2000]
+
+_OVER = "0x" + "11" * 20
+_UNDER = "0x" + "22" * 20
+_CONTRACT = Web3.to_checksum_address("0x" + "33" * 20)
+_SENDER = Web3.to_checksum_address("0x" + "44" * 20)
+
+
+class _CountingProvider(BaseProvider):
+    _results = {"eth_chainId": "0x2105", "eth_estimateGas": "0x30d40", "eth_maxPriorityFeePerGas": hex(10**6),
+                "eth_getBlockByNumber": {"number": "0x1", "baseFeePerGas": hex(10**8)}}
+
+    def __init__(self):
+        self.calls = {}
+
+    def make_request(self, method, params):
+        self.calls[method] = self.calls.get(method, 0) + 1
+        return {"jsonrpc": "2.0", "id": 0, "result": self._results.get(method)}
+
+    def is_connected(self, show_traceback: bool = False) -> bool:
+        return True
+
+
+def _run(label: str, build, n: int, provider: _CountingProvider) -> dict:
+    build()                                         # warm up (and check it works at all)
+    provider.calls.clear()
+    _t = time.perf_counter()
+    for _ in range(n):
+        txn = build()
+    _elapsed = time.perf_counter() - _t
+    _rpc = sum(provider.calls.values()) / n
+    print(f"  {label:<22} {_elapsed / n * 1e6:9.1f} us/txn   {_rpc:.2f} rpc calls/txn {dict(provider.calls) or ''}")
+    return txn
+
+
+def main(n: int):
+    provider = _CountingProvider()
+    w3 = Web3(provider)
+    bindings = abigen.load()
+    contract = w3.eth.contract(address=_CONTRACT, abi=bindings.ABI)
+    # fetched once from the fake provider, then cached for good
+    fees = FeeOracle(w3, ttl=float("inf"))
+    fees.fee_params()
+    builder = TxBuilder(w3, fees, bindings, _CONTRACT, _SENDER, chain_id=0x2105)
+
+    cases = {
+        "makeBet": ((_OVER, _UNDER, "1", 10**17, 70_000 * 10**18, 19_000_000), builder.make_bet, 400_000),
+        "settleBet": ((12345, True), builder.settle_bet, 150_000),
+    }
+    for fn_name, (args, encode, fallback_gas) in cases.items():
+        print(f"{fn_name} x{n}:")
+
+        def _old():
+            _fn = contract.functions[fn_name](*args)
+            return _fn.build_transaction(fees.tx_params(fn_name, _fn, _SENDER, fallback_gas))
+
+        def _new():
+            return builder.build(encode(*args), fn_name, fallback_gas)
+
+        old = _run("build_transaction", _old, n, provider)
+        new = _run("TxBuilder", _new, n, provider)
+        assert old["data"] == new["data"], f"calldata differs for {fn_name}"
+        _same = ("to", "gas", "chainId", "value", "maxFeePerGas")
+        assert {k: old[k] for k in _same} == {k: new[k] for k in _same}, f"txn fields differ for {fn_name}"
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="txn building benchmark")
+    parser.add_argument("--n", type=int, default=2000)
+    main(parser.parse_args().n)
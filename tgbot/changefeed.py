@@ -0,0 +1,156 @@
+import time
+import logging
+import threading
+from datetime import datetime
+from pymongo.errors import OperationFailure, PyMongoError
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+CHANGE_EVENTS = metrics.REGISTRY.counter("pvpbet_change_events_total", "change stream events applied to in-process "
+                                         "caches", ("collection", "op"))
+CHANGE_LAG = metrics.REGISTRY.gauge("pvpbet_change_feed_lag_seconds",
+                                    "seconds between a write and its change event being applied here")
+RESYNCS = metrics.REGISTRY.counter("pvpbet_change_feed_resyncs_total", "full cache reloads after missing change events")
+
+# server error codes: $changeStream on a standalone mongod, and resume tokens that fell off the oplog
+_UNSUPPORTED = (40573,)
+_HISTORY_LOST = (260, 280, 286)     # InvalidResumeToken, ChangeStreamFatalError, ChangeStreamHistoryLost
+# events after which the stream can't continue and caches can't be patched up one event at a time
+_FATAL_OPS = ("drop", "rename", "dropDatabase", "invalidate")
+
+
+# one change stream over a set of collections, each event handed to that collection's handler on a background
+# thread. every replica runs its own feed, so writes made by any process (other replicas, shards, the signer,
+# a migration script) reach every process's caches. the resume token is checkpointed in mongo under `name`, so a
+# restarted replica picks up where it left off instead of missing whatever happened while it was down; if the
+# token is too old (or the stream dies for good) on_resync() is called to rebuild the caches from scratch
+class ChangeFeed:
+    def __init__(self, db, handlers: dict, name: str, on_resync=None, checkpoint_interval: float = 5.0,
+                 retry_delay: float = 1.0):
+        self.db = db
+        self.handlers = handlers            # collection name -> fn(change event)
+        self.name = name
+        self.on_resync = on_resync
+        self.checkpoint_interval = checkpoint_interval
+        self.retry_delay = retry_delay
+        self.tokens = db.stream_resume_tokens
+        self._stream = None
+        self._token = None
+        self._saved_token = None
+        self._saved_at = 0.0
+        self._thread = None
+        self._stop = threading.Event()
+
+    def _watch(self, resume_after):
+        pipeline = [{"$match": {"ns.coll": {"$in": list(self.handlers)}}}]
+        # updateLookup: handlers get the document as it is now, not just the changed fields
+        return self.db.watch(pipeline, full_document="updateLookup", resume_after=resume_after,
+                             max_await_time_ms=1000)
+
+    # opens the stream and returns whether change streams are available (they need a replica set). call this
+    # before loading whatever the handlers keep coherent: every write from here on is delivered to them
+    def open(self) -> bool:
+        stored = self.tokens.find_one({"_id": self.name})
+        token = stored.get("token") if stored else None
+        try:
+            self._stream = self._watch(token)
+        except OperationFailure as e:
+            if e.code in _UNSUPPORTED:
+                logger.warning(f"change streams unavailable ({e}), caches of shared data are disabled")
+                return False
+            if token is None or e.code not in _HISTORY_LOST:
+                raise
+            logger.warning(f"change feed {self.name} can't resume from its stored token ({e}), starting from now")
+            self._stream = self._watch(None)
+        self._token = self._stream.resume_token
+        logger.info(f"change feed {self.name} open on {list(self.handlers)}" + (" (resumed)" if token else ""))
+        return True
+
+    def _apply(self, change: dict):
+        op = change["operationType"]
+        collection = change.get("ns", {}).get("coll")
+        if op in _FATAL_OPS:
+            raise OperationFailure(f"{op} event on {collection}", code=280)
+        try:
+            self.handlers[collection](change)
+        except Exception:
+            # one event we can't make sense of mustn't stop every later one from being applied
+            logger.exception(f"change feed {self.name}: handler for {collection} failed on {op} event")
+        CHANGE_EVENTS.inc(collection=collection, op=op)
+        if "clusterTime" in change:
+            CHANGE_LAG.set(max(time.time() - change["clusterTime"].time, 0))
+
+    def _checkpoint(self, force: bool = False):
+        if self._token is None or self._token == self._saved_token:
+            return
+        if not force and time.monotonic() - self._saved_at < self.checkpoint_interval:
+            return
+        self.tokens.update_one({"_id": self.name}, {"$set": {"token": self._token, "updated_at": datetime.utcnow()}},
+                               upsert=True)
+        self._saved_token = self._token
+        self._saved_at = time.monotonic()
+
+    def _close(self):
+        if self._stream is not None:
+            try:
+                self._stream.close()
+            except PyMongoError:
+                pass
+            self._stream = None
+
+    def _resync(self, reason):
+        logger.error(f"change feed {self.name} missed events ({reason}), reloading caches")
+        RESYNCS.inc()
+        self._close()
+        self._token = None
+        # reopen before reloading, so nothing written during the reload is missed
+        self._stream = self._watch(None)
+        self._token = self._stream.resume_token
+        if self.on_resync is not None:
+            self.on_resync()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                if self._stream is None:
+                    self._stream = self._watch(self._token)
+                change = self._stream.try_next()
+                if change is not None:
+                    self._apply(change)
+                # advances even without events (post-batch token), so a quiet feed doesn't resume from far back
+                self._token = self._stream.resume_token
+                self._checkpoint()
+            except OperationFailure as e:
+                if e.code in _HISTORY_LOST:
+                    try:
+                        self._resync(e)
+                    except PyMongoError:
+                        logger.exception(f"change feed {self.name} failed to resync, retrying")
+                        self._close()
+                        self._stop.wait(self.retry_delay)
+                else:
+                    logger.warning(f"change feed {self.name} failed ({e}), reopening")
+                    self._close()
+                    self._stop.wait(self.retry_delay)
+            except PyMongoError as e:
+                # the driver already retried once; keep trying from the last token we got
+                logger.warning(f"change feed {self.name} interrupted ({e}), reopening")
+                self._close()
+                self._stop.wait(self.retry_delay)
+        self._checkpoint(force=True)
+        self._close()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name=f"change-feed-{self.name}", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        else:
+            self._close()
@@ -0,0 +1,189 @@
+import time
+import threading
+import logging
+import requests
+from json import JSONDecodeError
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+# classic token bucket; refills continuously at rate_per_minute / 60 tokens per second
+class TokenBucket:
+    def __init__(self, rate_per_minute: float, burst: int | None = None):
+        self.rate = rate_per_minute / 60
+        self.capacity = burst if burst is not None else max(1, int(rate_per_minute // 6))
+        self._tokens = float(self.capacity)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    # non-blocking: takes a token and returns 0, or returns how many seconds until one is available
+    # (lets async callers wait with asyncio.sleep instead of blocking the event loop)
+    def try_acquire(self) -> float:
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+    # returns True once a token was taken, False if that would take longer than timeout
+    def acquire(self, timeout: float | None = None) -> bool:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return True
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    # called when the server tells us we're over the limit anyway; forces callers to wait for a refill
+    def drain(self):
+        with self._lock:
+            self._tokens = 0
+            self._last = time.monotonic()
+
+    # the server told us exactly how long to back off (e.g. telegram's retry_after): no token before then
+    def pause(self, seconds: float):
+        with self._lock:
+            self._tokens = min(self._tokens, 1 - seconds * self.rate)
+            self._last = time.monotonic()
+
+
+# identical calls that overlap in time share the first caller's result instead of each going out
+class SingleFlight:
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+        if not leader:
+            metrics.CACHE_LOOKUPS.inc(cache="cmc_singleflight", result="hit")
+            call.done.wait()
+        else:
+            metrics.CACHE_LOOKUPS.inc(cache="cmc_singleflight", result="miss")
+            try:
+                call.result = fn()
+            except Exception as e:
+                call.error = e
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+
+class _IdBatch:
+    def __init__(self):
+        self.ids = set()
+        self.done = threading.Event()
+        self.result = {}
+
+
+# thin wrapper around the /v2/cryptocurrency/quotes/latest endpoint (the only one we use)
+# - rate limited to the plan's per-minute allowance, so bursts queue up here instead of getting 429'd
+# - identical in-flight requests are coalesced
+# - single-id lookups arriving within batch_window are merged into one multi-id call
+class CmcClient:
+    def __init__(self, base_url: str, headers: dict, rate_per_minute: float = 30, burst: int | None = None,
+                 batch_window: float = 0.025, max_batch: int = 100, limiter_timeout: float = 10.0):
+        self.base_url = base_url
+        self.headers = headers
+        self.bucket = TokenBucket(rate_per_minute, burst)
+        self.limiter_timeout = limiter_timeout
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self._flights = SingleFlight()
+        self._batch_lock = threading.Lock()
+        self._batch = None
+
+    # returns the decoded json body, or None if the request failed/was rate limited
+    def quotes_latest(self, params: dict, op: str) -> dict | None:
+        key = tuple(sorted((k, str(v)) for k, v in params.items()))
+        return self._flights.do(key, lambda: self._request(params, op))
+
+    def _request(self, params: dict, op: str) -> dict | None:
+        if not self.bucket.acquire(self.limiter_timeout):
+            logger.warning(f"cmc rate limiter timed out after {self.limiter_timeout}s (op={op})")
+            metrics.OUTBOUND_ERRORS.inc(target="cmc", op=op)
+            return None
+        try:
+            with metrics.outbound("cmc", op):
+                response = requests.get(f"{self.base_url}/v2/cryptocurrency/quotes/latest",
+                                        headers=self.headers, params=params)
+        except requests.RequestException as e:
+            logger.error(f"cmc request failed: {e}")
+            return None
+        if response.status_code == 429:
+            logger.warning("cmc returned 429, draining rate limiter")
+            self.bucket.drain()
+        try:
+            data = response.json()
+            _status = data.get('status') or {}
+            metrics.CMC_CREDITS.inc(_status.get('credit_count') or 0, endpoint="quotes_latest")
+        except (JSONDecodeError, AttributeError, ValueError):
+            metrics.OUTBOUND_ERRORS.inc(target="cmc", op=op)
+            return None
+        if not response.ok or _status.get('error_code'):
+            metrics.OUTBOUND_ERRORS.inc(target="cmc", op=op)
+            if not response.ok:
+                logger.debug(f"cmc returned {response.status_code}: {_status.get('error_message')}")
+                return None
+        return data
+
+    # raw token dict for a cmc id, or None. concurrent callers get merged into one multi-id request
+    def quote_by_id(self, _id: int) -> dict | None:
+        with self._batch_lock:
+            batch = self._batch
+            leader = batch is None
+            if leader:
+                batch = self._batch = _IdBatch()
+            batch.ids.add(int(_id))
+            if len(batch.ids) >= self.max_batch:
+                self._batch = None
+
+        if leader:
+            time.sleep(self.batch_window)
+            with self._batch_lock:
+                if self._batch is batch:
+                    self._batch = None
+            try:
+                batch.result = self._fetch_ids(sorted(batch.ids))
+            finally:
+                batch.done.set()
+        else:
+            batch.done.wait()
+        return batch.result.get(str(_id))
+
+    def _fetch_ids(self, ids: list[int]) -> dict:
+        data = self.quotes_latest({"id": ",".join(str(i) for i in ids)}, "id")
+        if data is not None and data.get('data') is not None:
+            return data.get('data')
+        if len(ids) == 1:
+            return {}
+        # cmc rejects the whole request if any single id is bad, so fall back to asking one by one
+        logger.debug(f"batched id lookup failed for {len(ids)} ids, retrying individually")
+        result = {}
+        for i in ids:
+            _data = self.quotes_latest({"id": str(i)}, "id")
+            if _data is not None and _data.get('data') is not None:
+                result.update(_data.get('data'))
+        return result
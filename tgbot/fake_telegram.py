@@ -0,0 +1,178 @@
+import sys
+import json
+import time
+import itertools
+import threading
+import logging
+import argparse
+import requests
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+logger = logging.getLogger(__name__)
+
+
+# ptb sends bot api params form-encoded, with everything but plain strings json-encoded
+def _decode_params(body: bytes, content_type: str) -> dict:
+    if not body:
+        return {}
+    if content_type.startswith("application/json"):
+        return json.loads(body)
+    params = {}
+    for k, v in parse_qs(body.decode("utf-8")).items():
+        try:
+            params[k] = json.loads(v[0])
+        except ValueError:
+            params[k] = v[0]
+    return params
+
+
+# a stand-in for api.telegram.org for local/webhook testing. point the bot at it with TG_BASE_URL (see main.py);
+# it records every bot api call (so tests can look at what the bot sent) and pushes updates to whatever
+# webhook the bot registered, the same way telegram would
+class FakeTelegram:
+    def __init__(self, port: int = 8081, addr: str = "127.0.0.1", bot_username: str = "pvpbet_test_bot"):
+        self.addr = addr
+        self.port = port
+        self.bot_user = {"id": 1, "is_bot": True, "first_name": "pvpbet", "username": bot_username}
+        self.calls = []                 # (method, params) for every bot api request
+        self.failed = []                # (method, params) for requests answered with a scripted error
+        self._failures = []             # (method, error code, description, parameters), see fail_next
+        self.webhook_url = None
+        self.secret = None
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._cond = threading.Condition()
+        self._server = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.addr}:{self.port}/bot"
+
+    @property
+    def sent(self) -> list[dict]:
+        with self._cond:
+            return [params for method, params in self.calls if method == "sendMessage"]
+
+    #### BOT API SIDE ####
+    # the next `method` call gets this error instead of a result, e.g. a flood wait:
+    # fail_next("sendMessage", 429, "Too Many Requests: retry after 3", retry_after=3)
+    def fail_next(self, method: str, error_code: int, description: str, **parameters):
+        with self._cond:
+            self._failures.append((method, error_code, description, parameters))
+
+    def _scripted_failure(self, method: str, params: dict) -> tuple[int, dict] | None:
+        with self._cond:
+            for i, (_method, error_code, description, parameters) in enumerate(self._failures):
+                if _method == method:
+                    del self._failures[i]
+                    self.failed.append((method, params))
+                    return error_code, {"ok": False, "error_code": error_code, "description": description,
+                                        "parameters": parameters}
+        return None
+
+    def _handle(self, method: str, params: dict):
+        with self._cond:
+            self.calls.append((method, params))
+            self._cond.notify_all()
+        match method:
+            case "getMe":
+                return self.bot_user
+            case "setWebhook":
+                self.webhook_url = params.get("url")
+                self.secret = params.get("secret_token")
+                return True
+            case "deleteWebhook":
+                self.webhook_url = None
+                return True
+            case "sendMessage":
+                return {"message_id": next(self._message_ids), "date": int(time.time()), "from": self.bot_user,
+                        "chat": {"id": params.get("chat_id"), "type": "group"}, "text": params.get("text")}
+            case _:
+                return True
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                # /bot<token>/<method>
+                method = self.path.rstrip("/").rsplit("/", 1)[-1]
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                params = _decode_params(body, self.headers.get("Content-Type", ""))
+                status, response = fake._scripted_failure(method, params) or \
+                    (200, {"ok": True, "result": fake._handle(method, params)})
+                payload = json.dumps(response).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = do_POST
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self._server = ThreadingHTTPServer((self.addr, self.port), self._handler())
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="fake-telegram", daemon=True).start()
+        logger.info(f"fake telegram listening on {self.base_url}")
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server = None
+
+    #### UPDATE SIDE ####
+    def push_command(self, text: str, chat_id: int, user_id: int, username: str | None = None,
+                     chat_type: str = "group") -> requests.Response:
+        if self.webhook_url is None:
+            raise RuntimeError("bot hasn't registered a webhook yet")
+        command = text.split()[0]
+        update = {
+            "update_id": next(self._update_ids),
+            "message": {
+                "message_id": next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": chat_type},
+                "from": {"id": user_id, "is_bot": False, "first_name": username or str(user_id),
+                         "username": username},
+                "text": text,
+                "entities": [{"type": "bot_command", "offset": 0, "length": len(command)}] if text.startswith("/")
+                else [],
+            },
+        }
+        headers = {"X-Telegram-Bot-Api-Secret-Token": self.secret} if self.secret else {}
+        return requests.post(self.webhook_url, json=update, headers=headers, timeout=10)
+
+    # blocks until the bot has sent at least n messages in total; returns them
+    def wait_for_messages(self, n: int, timeout: float = 10.0) -> list[dict]:
+        with self._cond:
+            self._cond.wait_for(lambda: sum(m == "sendMessage" for m, _ in self.calls) >= n, timeout=timeout)
+        return self.sent
+
+
+# interactive: run this, start the bot with TG_BASE_URL=<printed url> BOT_MODE=webhook, then type commands
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="fake telegram bot api + update sender")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--chat-id", type=int, default=-1)
+    parser.add_argument("--user-id", type=int, default=1)
+    parser.add_argument("--username", default="Alice")
+    args = parser.parse_args()
+
+    fake = FakeTelegram(port=args.port).start()
+    print(f"TG_BASE_URL={fake.base_url}")
+    seen = 0
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        print(f"-> {fake.push_command(line.strip(), args.chat_id, args.user_id, args.username).status_code}")
+        for msg in fake.wait_for_messages(seen + 1)[seen:]:
+            print(f"<- [{msg.get('chat_id')}] {msg.get('text')}")
+        seen = len(fake.sent)
@@ -0,0 +1,106 @@
+import time
+import threading
+import logging
+from collections import deque
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+BASE_FEE = metrics.REGISTRY.gauge("pvpbet_base_fee_wei", "latest observed base fee per gas")
+PRIORITY_FEE = metrics.REGISTRY.gauge("pvpbet_priority_fee_wei", "priority fee per gas we're currently offering")
+
+
+# eip-1559 fee and gas-limit source for every bookie txn.
+# fees: base fee from the latest block + the node's suggested tip, cached for `ttl` seconds (about a block)
+# gas limits: estimate_gas per contract function, cached for `estimate_ttl` and padded by `gas_headroom`
+class FeeOracle:
+    def __init__(self, w3, ttl: float = 2.0, base_fee_multiplier: float = 2.0, min_priority_fee: int = 0,
+                 max_fee_cap: int | None = None, gas_headroom: float = 1.3, estimate_ttl: float = 600.0,
+                 history: int = 20):
+        self.w3 = w3
+        self.ttl = ttl
+        self.base_fee_multiplier = base_fee_multiplier
+        self.min_priority_fee = min_priority_fee
+        self.max_fee_cap = max_fee_cap
+        self.gas_headroom = gas_headroom
+        self.estimate_ttl = estimate_ttl
+        self.history = deque(maxlen=history)      # (block number, base fee, priority fee)
+        self._lock = threading.Lock()
+        self._fees = None
+        self._fees_at = 0.0
+        self._estimates = {}
+
+    #### FEES ####
+    def _refresh_fees(self) -> dict:
+        block = self.w3.eth.get_block("latest")
+        base_fee = block.get("baseFeePerGas")
+        if base_fee is None:
+            # pre-london chain (or a devnet started that way), fall back to a legacy gas price
+            return {"gasPrice": self.w3.eth.gas_price}
+
+        try:
+            priority_fee = self.w3.eth.max_priority_fee
+        except ValueError:
+            # not every node implements eth_maxPriorityFeePerGas
+            priority_fee = 0
+        priority_fee = max(priority_fee, self.min_priority_fee)
+        max_fee = int(base_fee * self.base_fee_multiplier) + priority_fee
+        if self.max_fee_cap is not None and max_fee > self.max_fee_cap:
+            logger.warning(f"max fee {max_fee} above cap {self.max_fee_cap}, capping (txn may sit in the mempool)")
+            max_fee = self.max_fee_cap
+            priority_fee = min(priority_fee, max_fee)
+
+        self.history.append((block.get("number"), base_fee, priority_fee))
+        BASE_FEE.set(base_fee)
+        PRIORITY_FEE.set(priority_fee)
+        return {"maxFeePerGas": max_fee, "maxPriorityFeePerGas": priority_fee}
+
+    def fee_params(self) -> dict:
+        with self._lock:
+            now = time.monotonic()
+            if self._fees is None or now - self._fees_at > self.ttl:
+                metrics.CACHE_LOOKUPS.inc(cache="fees", result="miss")
+                self._fees = self._refresh_fees()
+                self._fees_at = now
+            else:
+                metrics.CACHE_LOOKUPS.inc(cache="fees", result="hit")
+            return dict(self._fees)
+
+    #### GAS LIMITS ####
+    # estimate is a zero-arg callable (usually contract_fn.estimate_gas bound to the real args). if the estimate
+    # fails (e.g. the call would revert right now) the last good estimate is used, then the fixed fallback
+    def gas_limit(self, key: str, estimate, fallback: int) -> int:
+        now = time.monotonic()
+        cached = self._estimates.get(key)
+        if cached is not None and now - cached[1] <= self.estimate_ttl:
+            metrics.CACHE_LOOKUPS.inc(cache="gas_estimate", result="hit")
+            return cached[0]
+
+        metrics.CACHE_LOOKUPS.inc(cache="gas_estimate", result="miss")
+        try:
+            limit = int(estimate() * self.gas_headroom)
+        except Exception as e:
+            _limit = cached[0] if cached is not None else fallback
+            logger.warning(f"gas estimate for {key} failed ({e}), using {_limit}")
+            return _limit
+        self._estimates[key] = (limit, now)
+        return limit
+
+    # for calls whose gas grows with the number of items (settleBets over n bets). the estimate is cached per item,
+    # under (key, n rounded up to a power of two), so a batch is never sent with the limit measured for a smaller
+    # one; item_margin is added per item on top, for items costing more than the ones the estimate was taken with
+    def batch_gas_limit(self, key: str, n: int, estimate, fallback: int, item_margin: int = 0) -> int:
+        _bucket = 1 << (n - 1).bit_length()
+        _fallback_per_item = -(-fallback // n)
+        per_item = self.gas_limit(f"{key}:{_bucket}", lambda: -(-estimate() // n), _fallback_per_item)
+        return (per_item + item_margin) * n
+
+    # everything build_transaction needs so web3 doesn't go and fetch fees/gas itself
+    def tx_params(self, key: str, contract_fn, sender: str, fallback_gas: int, value: int = 0) -> dict:
+        _call = {"from": sender}
+        if value:
+            _call["value"] = value
+        params = dict(_call)
+        params["gas"] = self.gas_limit(key, lambda: contract_fn.estimate_gas(_call), fallback_gas)
+        params.update(self.fee_params())
+        return params
@@ -0,0 +1,219 @@
+import time
+import asyncio
+import logging
+import itertools
+import threading
+from bisect import bisect_right
+from collections import OrderedDict
+from datetime import datetime
+import uvicorn
+from fastapi import FastAPI, Request, Query
+from fastapi.responses import ORJSONResponse, Response
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+REQUESTS = metrics.REGISTRY.counter("pvpbet_http_api_requests_total", "read api requests by route and outcome",
+                                    ("route", "result"))
+
+# etags are "<process epoch>-<listing generation>": generations restart with the process, the epoch tells them apart
+_EPOCH = f"{time.time_ns():x}"
+_GENERATIONS = itertools.count(1)
+
+
+# one filtered listing of the bet book or the open offers, sorted by (expiry block, id), which is also the cursor.
+# built from a snapshot of the index and kept until the index's version moves (or, for offers, until the first
+# one in it lapses), so polling an unchanged book is a dict lookup
+class _Listing:
+    __slots__ = ("source", "version", "keys", "items", "stale_at", "generation")
+
+    def __init__(self, source, version: int):
+        self.source = source            # the index object, ApiV2.reload_bet_cache swaps in a new one
+        self.version = version
+        self.keys = []
+        self.items = {}                 # key -> json-ready dict
+        self.stale_at = None            # soonest valid_till among the offers in it
+        self.generation = next(_GENERATIONS)
+
+    @property
+    def etag(self) -> str:
+        return f'"{_EPOCH}-{self.generation}"'
+
+    def page(self, cursor: tuple | None, limit: int) -> dict:
+        start = bisect_right(self.keys, cursor) if cursor is not None else 0
+        keys = self.keys[start:start + limit]
+        _next = keys[-1] if start + limit < len(self.keys) else None
+        return {"items": [self.items[k] for k in keys], "total": len(self.keys),
+                "next_cursor": f"{_next[0]}.{_next[1]}" if _next is not None else None}
+
+
+# listings per (kind, chat, user) filter over the in-process indexes: ApiV2.bet_cache for active bets and
+# ApiV2.proposals for open offers. a worker in a sharded deployment only has its own chats in those
+class BookIndex:
+    def __init__(self, api, max_listings: int = 256):
+        self.api = api
+        self.max_listings = max_listings
+        self._lock = threading.Lock()
+        self._listings = OrderedDict()
+
+    def _source(self, kind: str):
+        return self.api.bet_cache if kind == "bets" else self.api.proposals
+
+    # the listing if it's still current; never copies or sorts anything, so it's fine to call from the event loop
+    def cached(self, kind: str, chat_id: int | None = None, user_id: int | None = None) -> _Listing | None:
+        source = self._source(kind)
+        with self._lock:
+            listing = self._listings.get((kind, chat_id, user_id))
+            if listing is None or listing.source is not source or listing.version != source.version:
+                return None
+            if listing.stale_at is not None and listing.stale_at < datetime.now():
+                return None
+            self._listings.move_to_end((kind, chat_id, user_id))
+            return listing
+
+    def build(self, kind: str, chat_id: int | None = None, user_id: int | None = None) -> _Listing:
+        source = self._source(kind)
+        version, entries = source.snapshot()
+        listing = _Listing(source, version)
+        _now = datetime.now()
+        for entry in entries:
+            if chat_id is not None and entry.chat_created_in != chat_id:
+                continue
+            if kind == "bets":
+                if user_id is not None and user_id not in (entry.over_user_id, entry.under_user_id):
+                    continue
+            else:
+                if user_id is not None and user_id not in (entry.created_by, entry.counterparty):
+                    continue
+                # lapsed offers stay in the store until something purges them, they're not open any more though
+                if entry.valid_till < _now:
+                    continue
+                if listing.stale_at is None or entry.valid_till < listing.stale_at:
+                    listing.stale_at = entry.valid_till
+            listing.items[(entry.expiry, entry.id)] = _json_ready(entry)
+        listing.keys = sorted(listing.items)
+
+        with self._lock:
+            self._listings[(kind, chat_id, user_id)] = listing
+            self._listings.move_to_end((kind, chat_id, user_id))
+            while len(self._listings) > self.max_listings:
+                self._listings.popitem(last=False)
+        return listing
+
+    # a rebuild copies and sorts the whole index, so that part runs off the event loop
+    async def listing(self, kind: str, chat_id: int | None = None, user_id: int | None = None) -> _Listing:
+        return self.cached(kind, chat_id, user_id) or await asyncio.to_thread(self.build, kind, chat_id, user_id)
+
+
+# wei amounts as strings, like Bet already stores them: they don't fit orjson's 64 bit ints (or javascript's 53)
+def _json_ready(entry) -> dict:
+    d = entry.dict()
+    for field in ("amount", "price"):
+        d[field] = str(d[field])
+    return d
+
+
+def _parse_cursor(cursor: str | None) -> tuple | None:
+    if cursor is None:
+        return None
+    _expiry, _id = cursor.split(".")
+    return int(_expiry), int(_id)
+
+
+def _not_modified(request: Request, etag: str) -> bool:
+    _header = request.headers.get("if-none-match")
+    if _header is None:
+        return False
+    return any(t.strip().removeprefix("W/") in (etag, "*") for t in _header.split(","))
+
+
+def _respond(route: str, request: Request, etag: str, body) -> Response:
+    if _not_modified(request, etag):
+        REQUESTS.inc(route=route, result="not_modified")
+        return Response(status_code=304, headers={"ETag": etag})
+    REQUESTS.inc(route=route, result="ok")
+    return ORJSONResponse(body() if callable(body) else body, headers={"ETag": etag, "Cache-Control": "no-cache"})
+
+
+def _error(route: str, status: int, result: str, detail: str) -> Response:
+    REQUESTS.inc(route=route, result=result)
+    return ORJSONResponse({"detail": detail}, status_code=status)
+
+
+# read-only view of the book for the frontend and dashboards. amounts and prices are wei, as strings (like in mongo);
+# list endpoints page by `cursor` (the next_cursor of the previous page) and every 200 carries an etag, so a
+# client polling with If-None-Match gets a 304 without anything being serialized
+def make_app(api, max_page: int = 200) -> FastAPI:
+    index = BookIndex(api)
+    app = FastAPI(title="pvpbet read api", default_response_class=ORJSONResponse, docs_url=None, redoc_url=None)
+
+    async def _list(route: str, kind: str, request: Request, chat_id, user_id, cursor, limit) -> Response:
+        try:
+            _cursor = _parse_cursor(cursor)
+        except ValueError:
+            return _error(route, 400, "bad_request", "cursor should be the next_cursor of a previous page")
+        listing = await index.listing(kind, chat_id, user_id)
+        return _respond(route, request, listing.etag, lambda: listing.page(_cursor, limit))
+
+    @app.get("/healthz")
+    async def healthz():
+        return {"ok": True}
+
+    @app.get("/v1/bets")
+    async def bets(request: Request, chat_id: int | None = None, user_id: int | None = None,
+                   cursor: str | None = None, limit: int = Query(50, ge=1, le=max_page)):
+        return await _list("bets", "bets", request, chat_id, user_id, cursor, limit)
+
+    @app.get("/v1/proposals")
+    async def proposals(request: Request, chat_id: int | None = None, user_id: int | None = None,
+                        cursor: str | None = None, limit: int = Query(50, ge=1, le=max_page)):
+        return await _list("proposals", "proposals", request, chat_id, user_id, cursor, limit)
+
+    # everything a user has on the book: active bets on either side, and open offers they made or were named in
+    @app.get("/v1/users/{user_id}/positions")
+    async def positions(request: Request, user_id: int):
+        active = await index.listing("bets", user_id=user_id)
+        offered = await index.listing("proposals", user_id=user_id)
+        _etag = f'"{_EPOCH}-{active.generation}-{offered.generation}"'
+        return _respond("positions", request, _etag, lambda: {
+            "user_id": user_id, "active": [active.items[k] for k in active.keys],
+            "offered": [offered.items[k] for k in offered.keys]})
+
+    # from ApiV2.balances: up to its ttl stale, except around our own accepts/settlements which drop it
+    @app.get("/v1/users/{user_id}/balance")
+    async def balance(request: Request, user_id: int):
+        balances = api.balances.peek(user_id)
+        if balances is None:
+            balances = await asyncio.to_thread(api.balances.get, user_id)
+        if balances is None:
+            return _error("balance", 404, "not_found", f"no user with id {user_id}")
+        _spendable, _locked = balances
+        return _respond("balance", request, f'"{_spendable:x}.{_locked:x}"', {
+            "user_id": user_id, "spendable": str(_spendable), "locked": str(_locked)})
+
+    return app
+
+
+# uvicorn would otherwise take over SIGINT/SIGTERM; the bot owns those and stops the server from its own shutdown
+class _Server(uvicorn.Server):
+    def install_signal_handlers(self):
+        pass
+
+
+# the api served from the bot's own event loop: start() from post_init, stop() from post_stop
+class ReadApi:
+    def __init__(self, api, host: str, port: int, max_page: int = 200):
+        self.app = make_app(api, max_page)
+        self.server = _Server(uvicorn.Config(self.app, host=host, port=port, log_config=None, access_log=False,
+                                             lifespan="off"))
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self.server.serve())
+        logger.info(f"read api listening on http://{self.server.config.host}:{self.server.config.port}")
+
+    async def stop(self):
+        if self._task is not None:
+            self.server.should_exit = True
+            await self._task
+            self._task = None
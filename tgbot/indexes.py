@@ -0,0 +1,69 @@
+import logging
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.collation import Collation, CollationStrength
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger(__name__)
+
+# telegram usernames are case-insensitive, so lookups are too. queries must pass this same collation
+# (see ApiV2.get_user_by_username) or mongo won't consider the index
+USERNAME_COLLATION = Collation(locale="en", strength=CollationStrength.SECONDARY)
+
+# every index the bot relies on, per collection. names are pinned so re-running at startup is a no-op,
+# and "id_1" matches what the old `create_index("id", unique=True)` call produced on existing deployments
+INDEXES = {
+    "users": [
+        IndexModel([("id", ASCENDING)], name="id_1", unique=True),
+        IndexModel([("user_name", ASCENDING)], name="user_name_ci", collation=USERNAME_COLLATION),
+        IndexModel([("wallet_addr", ASCENDING), ("verified", ASCENDING)], name="wallet_addr_verified"),
+    ],
+    "active_bets": [
+        IndexModel([("id", ASCENDING)], name="id_1", unique=True),
+        IndexModel([("chat_created_in", ASCENDING), ("expiry", ASCENDING)], name="chat_expiry"),
+        IndexModel([("over_user_id", ASCENDING)], name="over_user_id"),
+        IndexModel([("under_user_id", ASCENDING)], name="under_user_id"),
+    ],
+    "settled_bets": [
+        IndexModel([("id", ASCENDING)], name="id_1", unique=True),
+    ],
+    # unmined txns awaiting reconciliation (see pending.PendingTxns)
+    "pending_txns": [
+        IndexModel([("owner", ASCENDING), ("sent_at", ASCENDING)], name="owner_sent_at"),
+    ],
+    # leaderboards (see stats.StatsBook)
+    "user_stats": [
+        IndexModel([("net_pnl", DESCENDING)], name="net_pnl"),
+    ],
+    "chat_user_stats": [
+        IndexModel([("chat_id", ASCENDING), ("net_pnl", DESCENDING)], name="chat_net_pnl"),
+    ],
+}
+
+
+def ensure_indexes(db, indexes: dict = None):
+    indexes = INDEXES if indexes is None else indexes
+    for collection, models in indexes.items():
+        try:
+            created = db[collection].create_indexes(models)
+            logger.info(f"ensured indexes on {collection}: {created}")
+        except OperationFailure as e:
+            # most likely an index with the same keys but different options already exists; needs a manual drop
+            logger.critical(f"failed to create indexes on {collection}: {e}")
+            raise
+
+
+# all stage names in the winning plan of an explain() result, outermost first
+def winning_plan_stages(explain: dict) -> list[str]:
+    plan = explain.get("queryPlanner", {}).get("winningPlan", {})
+    # mongo 7+ (sbe) nests the classic-looking plan under queryPlan
+    plan = plan.get("queryPlan", plan)
+    stages = []
+    while plan:
+        stages.append(plan.get("stage"))
+        plan = plan.get("inputStage") or (plan.get("inputStages") or [None])[0]
+    return stages
+
+
+def uses_index(explain: dict) -> bool:
+    stages = winning_plan_stages(explain)
+    return "IXSCAN" in stages or "IDHACK" in stages or "EXPRESS_IXSCAN" in stages
@@ -0,0 +1,184 @@
+import os
+import json
+import logging
+import threading
+from pathlib import Path
+from pymongo import ReplaceOne, DeleteOne
+from pymongo.errors import PyMongoError
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+BUFFERED = metrics.REGISTRY.gauge("pvpbet_write_behind_buffered", "bet writes waiting to be flushed to mongo")
+FLUSHES = metrics.REGISTRY.counter("pvpbet_write_behind_flushes_total", "write-behind flushes by result", ("result",))
+FLUSH_OPS = metrics.REGISTRY.histogram("pvpbet_write_behind_flush_ops", "writes per write-behind flush",
+                                       buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000))
+
+
+# write-behind for one collection of documents keyed by "id" (active_bets). upsert()/delete() only append to a
+# local journal and a buffer; flush() sends everything buffered as one unordered bulk_write. the buffer keeps
+# only the latest write per id, so the order inside a batch doesn't matter and an upsert followed by a delete
+# (a bet settled before the flush) is a single delete. every write is idempotent (replace-by-id with upsert,
+# delete-by-id), so replaying the journal after a crash can't undo anything this process wrote, however much of it
+# had been flushed. it can undo what other replicas wrote since: a bet we journaled may have been settled (and
+# deleted) by the settlement leader while we were down. so replay checks `archive`, the collection documents go to
+# once they're gone for good (settled_bets), and turns upserts of anything in there into deletes. a bet that comes
+# back some other way (swept as stale, say) is only a stale entry in the book, and the next settlement round drops
+# it as already settled
+#
+# the journal is a json-lines file; each flush seals it (renames it to <path>.<n>) and starts a new one, and a
+# sealed segment is deleted once a flush that covered it succeeds. journal_path=None keeps the buffer in memory
+# only, which is only crash-safe if every write is flushed before anyone relies on it
+class WriteBehind:
+    def __init__(self, collection, journal_path: str | None = None, interval: float = 1.0, max_ops: int = 500,
+                 archive=None):
+        self.collection = collection
+        self.archive = archive
+        self.journal_path = Path(journal_path) if journal_path else None
+        self.interval = interval
+        self.max_ops = max_ops
+        self._lock = threading.Lock()           # buffer + journal file
+        self._flush_lock = threading.Lock()     # one flush at a time, so batches land in order
+        self._pending = {}                      # id -> ("upsert", doc) | ("delete", None)
+        self._sealed = []                       # sealed segments whose writes aren't known to be in mongo yet
+        self._segment = 0
+        self._journal = None
+        self._wake = threading.Event()
+        self._thread = None
+        BUFFERED.set_function(lambda: len(self._pending))
+
+    #### JOURNAL ####
+
+    def _segments(self) -> list[Path]:
+        if self.journal_path is None:
+            return []
+        _sealed = self.journal_path.parent.glob(self.journal_path.name + ".*")
+        return sorted((p for p in _sealed if p.suffix[1:].isdigit()), key=lambda p: int(p.suffix[1:]))
+
+    # caller holds _lock
+    def _append(self, record: dict):
+        if self.journal_path is None:
+            return
+        if self._journal is None:
+            self._journal = open(self.journal_path, "a", encoding="utf-8")
+        self._journal.write(json.dumps(record) + "\n")
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+
+    # caller holds _lock. returns every sealed segment, including the one just sealed
+    def _seal(self) -> list[Path]:
+        if self.journal_path is None:
+            return []
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        if self.journal_path.exists():
+            self._segment += 1
+            sealed = self.journal_path.with_name(f"{self.journal_path.name}.{self._segment}")
+            self.journal_path.rename(sealed)
+            self._sealed.append(sealed)
+        return list(self._sealed)
+
+    # applies whatever a previous run journaled but may not have flushed. call once, before anything reads the
+    # collection; returns how many writes were replayed
+    def replay(self) -> int:
+        if self.journal_path is None:
+            return 0
+        files = self._segments() + ([self.journal_path] if self.journal_path.exists() else [])
+        if files:
+            self._segment = max([int(p.suffix[1:]) for p in files if p != self.journal_path] + [0])
+        ops = {}
+        for path in files:
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # torn write at the end of the file from the crash; that write was never acknowledged
+                        logger.warning(f"skipping unreadable journal line in {path}: {line!r}")
+                        continue
+                    ops[record["id"]] = (record["op"], record.get("doc"))
+        if ops and self.archive is not None:
+            _upserts = [_id for _id, (op, _) in ops.items() if op == "upsert"]
+            _gone = {doc["id"] for doc in self.archive.find({"id": {"$in": _upserts}}, {"id": 1})}
+            if _gone:
+                logger.warning(f"not replaying upserts of {len(_gone)} archived documents: {sorted(_gone)}")
+            for _id in _gone:
+                ops[_id] = ("delete", None)
+        if ops:
+            logger.warning(f"replaying {len(ops)} journaled writes from {len(files)} file(s)")
+            self._write(ops)
+        for path in files:
+            path.unlink()
+        return len(ops)
+
+    #### BUFFER ####
+
+    def _record(self, _id, op: str, doc: dict | None):
+        with self._lock:
+            self._append({"op": op, "id": _id, "doc": doc})
+            self._pending[_id] = (op, doc)
+            full = len(self._pending) >= self.max_ops
+        if full:
+            self._wake.set()
+
+    def upsert(self, doc: dict):
+        doc = {k: v for k, v in doc.items() if k != "_id"}
+        self._record(doc["id"], "upsert", doc)
+
+    def delete(self, _id):
+        self._record(_id, "delete", None)
+
+    def _write(self, ops: dict):
+        requests = [ReplaceOne({"id": _id}, doc, upsert=True) if op == "upsert" else DeleteOne({"id": _id})
+                    for _id, (op, doc) in ops.items()]
+        self.collection.bulk_write(requests, ordered=False)
+        FLUSH_OPS.observe(len(requests))
+
+    # returns whether everything buffered when it was called is now in mongo. on failure the writes stay
+    # buffered (and journaled) for the next flush
+    def flush(self) -> bool:
+        with self._flush_lock:
+            with self._lock:
+                ops, self._pending = self._pending, {}
+                sealed = self._seal()
+            if ops:
+                try:
+                    self._write(ops)
+                except PyMongoError as e:
+                    FLUSHES.inc(result="error")
+                    logger.error(f"write-behind flush of {len(ops)} writes failed, will retry: {e}")
+                    with self._lock:
+                        # anything written since supersedes what failed
+                        for _id, op in ops.items():
+                            self._pending.setdefault(_id, op)
+                    return False
+                FLUSHES.inc(result="ok")
+            with self._lock:
+                for path in sealed:
+                    path.unlink(missing_ok=True)
+                    self._sealed.remove(path)
+            return True
+
+    def start(self):
+        if self._thread is not None:
+            return
+
+        def _loop():
+            while True:
+                self._wake.wait(self.interval)
+                self._wake.clear()
+                try:
+                    self.flush()
+                except Exception:
+                    logger.exception("write-behind flush failed")
+
+        self._thread = threading.Thread(target=_loop, name="write-behind", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
@@ -0,0 +1,108 @@
+import os
+import time
+import uuid
+import socket
+import logging
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+LEASE_HELD = metrics.REGISTRY.gauge("pvpbet_lease_held", "1 while this process holds the lease", ("lease",))
+LEASE_TOKEN = metrics.REGISTRY.gauge("pvpbet_lease_fencing_token", "fencing token of the lease as last seen",
+                                     ("lease",))
+
+
+class LeaseLost(Exception):
+    pass
+
+
+# a named lease in mongo: {_id: name, holder, token, expires_at}. expiry is always computed from the server's clock
+# ($$NOW), so replicas with skewed clocks still agree on who holds it. every change of holder increments `token`
+# (the fencing token), which is why there's deliberately no ttl index on this collection: deleting an expired
+# lease would reset the counter
+class Lease:
+    def __init__(self, collection, name: str, ttl: float = 10.0, holder: str | None = None):
+        self.collection = collection
+        self.name = name
+        self.ttl = ttl
+        self.holder = holder or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.token = None
+        self._valid_until = 0.0         # local monotonic deadline; never trust the lease past it even if mongo is slow
+
+    def _expiry(self):
+        return {"$add": ["$$NOW", int(self.ttl * 1000)]}
+
+    def _held(self, token: int, started: float):
+        if self.token != token:
+            logger.warning(f"{self.holder} acquired lease {self.name} (fencing token {token})")
+        self.token = token
+        # measured from before the request went out, so this errs on the side of giving the lease up early
+        self._valid_until = started + self.ttl
+        LEASE_HELD.set(1, lease=self.name)
+        LEASE_TOKEN.set(token, lease=self.name)
+
+    def _lost(self):
+        if self.token is not None:
+            logger.warning(f"{self.holder} lost lease {self.name} (fencing token {self.token})")
+        self.token = None
+        self._valid_until = 0.0
+        LEASE_HELD.set(0, lease=self.name)
+
+    # renews the lease if we hold it, takes it over if it's free or expired. returns whether we hold it now
+    def acquire_or_renew(self) -> bool:
+        started = time.monotonic()
+        if self.token is not None:
+            renewed = self.collection.update_one({"_id": self.name, "holder": self.holder, "token": self.token},
+                                                 [{"$set": {"expires_at": self._expiry()}}])
+            if renewed.matched_count:
+                self._held(self.token, started)
+                return True
+            self._lost()
+
+        # one upsert that only changes anything if the lease is missing or expired (a missing expires_at is null,
+        # which sorts before any date). all three fields are computed from the document as it was before the update
+        free = {"$lt": ["$expires_at", "$$NOW"]}
+        try:
+            doc = self.collection.find_one_and_update(
+                {"_id": self.name},
+                [{"$set": {
+                    "token": {"$cond": [free, {"$add": [{"$ifNull": ["$token", 0]}, 1]}, "$token"]},
+                    "holder": {"$cond": [free, self.holder, "$holder"]},
+                    "expires_at": {"$cond": [free, self._expiry(), "$expires_at"]},
+                }}],
+                upsert=True, return_document=ReturnDocument.AFTER)
+        except DuplicateKeyError:
+            # two replicas raced to create the very first lease document; the other one won
+            doc = None
+        if doc is not None and doc.get("holder") == self.holder:
+            self._held(doc["token"], started)
+            return True
+        LEASE_HELD.set(0, lease=self.name)
+        return False
+
+    # cheap local check, good enough for deciding whether to start a settlement round
+    def is_held(self) -> bool:
+        return self.token is not None and time.monotonic() < self._valid_until
+
+    # round-trip check right before doing something only the leader may do; raises LeaseLost
+    def verify(self) -> int:
+        token = self.token
+        if not self.is_held():
+            raise LeaseLost(f"lease {self.name} not held (or not renewed in time)")
+        current = self.collection.count_documents({"_id": self.name, "holder": self.holder, "token": token,
+                                                   "$expr": {"$gt": ["$expires_at", "$$NOW"]}}, limit=1)
+        if not current:
+            self._lost()
+            raise LeaseLost(f"lease {self.name} was taken over (our fencing token {token} is stale)")
+        return token
+
+    # on clean shutdown: expire it now so a standby doesn't have to wait out the ttl
+    def release(self):
+        if self.token is None:
+            return
+        self.collection.update_one({"_id": self.name, "holder": self.holder, "token": self.token},
+                                   [{"$set": {"expires_at": "$$NOW"}}])
+        logger.info(f"released lease {self.name}")
+        self._lost()
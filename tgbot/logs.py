@@ -0,0 +1,128 @@
+import json
+import queue
+import random
+import atexit
+import logging
+import contextvars
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from . import metrics
+
+DEFAULT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+# telegram's http client logs every getUpdates/sendMessage at info
+DEFAULT_LEVELS = "httpx=WARNING"
+
+DROPPED = metrics.REGISTRY.counter("pvpbet_log_records_dropped_total", "log records dropped because the log queue was full")
+QUEUED = metrics.REGISTRY.gauge("pvpbet_log_queue_depth", "log records waiting for the log writer thread")
+
+# attributes every LogRecord has; anything else on a record came in through `extra=`
+_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "taskName"}
+
+
+# puts records on the queue untouched. the stdlib QueueHandler formats the message (and the traceback) on the
+# caller's thread so records can be pickled; ours never leave the process, so all of the formatting happens on
+# the writer thread instead. that means logging calls should pass args (logger.info("x=%s", x)) rather than
+# f-strings, and args shouldn't be mutated after the call. a full queue drops the record rather than block
+class _AsyncQueueHandler(QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DROPPED.inc()
+
+
+# one json object per line: the usual fields plus whatever was passed as `extra=` (bet_id, chat_id, ...)
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        doc = {"ts": self.formatTime(record), "level": record.levelname, "logger": record.name,
+               "msg": record.getMessage()}
+        doc.update({k: v for k, v in vars(record).items() if k not in _RECORD_ATTRS})
+        if record.exc_info:
+            doc["exc"] = self.formatException(record.exc_info)
+        return json.dumps(doc, default=str)
+
+
+# "tgbot.apiv2=DEBUG,web3=WARNING" -> {"tgbot.apiv2": 10, "web3": 30}
+def parse_levels(spec: str) -> dict[str, int]:
+    levels = {}
+    for item in filter(None, (s.strip() for s in spec.split(","))):
+        name, _, level = item.partition("=")
+        if not level or not isinstance(logging.getLevelName(level.strip().upper()), int):
+            raise ValueError(f"bad log level spec {item!r}, expected <logger>=<LEVEL>")
+        levels[name.strip()] = logging.getLevelName(level.strip().upper())
+    return levels
+
+
+# routes the root logger through a bounded in-memory queue to a writer thread that owns the actual handlers
+# (stderr and a size-rotated file), so a logging call on the event loop costs a queue put and never file i/o
+# or formatting. returns the listener; it's stopped (and the queue drained) at exit
+def setup_logging(path: str | None = "app.log", level: str = "INFO", levels: str = DEFAULT_LEVELS,
+                  max_bytes: int = 50_000_000, backups: int = 5, fmt: str = "text",
+                  queue_size: int = 10_000, settlement_debug_sample: float = 0.0) -> QueueListener:
+    formatter = JsonFormatter() if fmt == "json" else logging.Formatter(DEFAULT_FORMAT)
+    handlers = [logging.StreamHandler()]
+    if path:
+        handlers.append(RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups, encoding="utf-8"))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    records = queue.Queue(maxsize=queue_size)
+    QUEUED.set_function(records.qsize)
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_AsyncQueueHandler(records))
+    root.setLevel(level.upper())
+    for name, _level in parse_levels(levels).items():
+        logging.getLogger(name).setLevel(_level)
+    SETTLEMENT.rate = settlement_debug_sample
+
+    listener = QueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+
+    def _stop():
+        # QueueListener.stop() isn't idempotent, and the caller may already have stopped it
+        if listener._thread is not None:
+            listener.stop()
+
+    atexit.register(_stop)
+    return listener
+
+
+# debug logging for one hot path, switched on for a random `rate` of its runs: everything logged at debug inside
+# a sampled run() goes out whatever the configured levels, tagged sampled=True, and outside one it's subject to
+# the levels as usual. a whole run is sampled or not, so a sampled settlement round can be read end to end
+class SampledDebug(logging.LoggerAdapter):
+    def __init__(self, name: str, rate: float = 0.0):
+        super().__init__(logging.getLogger(name), {})
+        self.rate = rate
+        self._sampled = contextvars.ContextVar(f"{name}.sampled", default=False)
+
+    @contextmanager
+    def run(self):
+        token = self._sampled.set(self.rate > 0 and random.random() < self.rate)
+        try:
+            yield
+        finally:
+            self._sampled.reset(token)
+
+    def isEnabledFor(self, level: int) -> bool:
+        return self._sampled.get() or self.logger.isEnabledFor(level)
+
+    def process(self, msg, kwargs):
+        if self._sampled.get():
+            kwargs["extra"] = {**(kwargs.get("extra") or {}), "sampled": True}
+        return msg, kwargs
+
+    def log(self, level: int, msg, *args, **kwargs):
+        if self.isEnabledFor(level):
+            msg, kwargs = self.process(msg, kwargs)
+            # straight to _log: Logger.log would check the logger's own level again
+            kwargs.setdefault("stacklevel", 2)
+            self.logger._log(level, msg, args, **kwargs)
+
+
+SETTLEMENT = SampledDebug("tgbot.settlement")
@@ -1,32 +1,32 @@
+import time
+# taken before the imports below (web3, telegram, pymongo), so the startup milestones include them
+_STARTED = time.monotonic()
 import os
-from telegram import Update
-from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler
+import asyncio
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, TypeHandler, CallbackQueryHandler
 from pydantic import ValidationError
 from pathlib import Path
 from dotenv import load_dotenv
 from .apiv2 import ApiV2
+from .outbox import Outbox
+from .shards import Shard
+from .lease import Lease
+from .stats import to_int
+from pymongo.errors import PyMongoError
+from . import metrics, tracing, webhook, logs
 from .schema import User, AcceptBetResponse
 import logging
-from datetime import datetime
 
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+logger = logging.getLogger(__name__)
 
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
 
-# Set up a FileHandler for output to a file
-file_handler = logging.FileHandler('app.log')
-file_handler.setLevel(logging.INFO)  # Set the minimum level for this handler
-file_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-file_handler.setFormatter(file_formatter)
+# records how long after process start `phase` was reached (pvpbet_startup_seconds, and the log)
+def mark_startup(phase: str):
+    _elapsed = time.monotonic() - _STARTED
+    metrics.STARTUP_SECONDS.set(_elapsed, phase=phase)
+    logger.info("startup: %s after %.3fs", phase, _elapsed)
 
-# Add the handlers to the logger
-logger.addHandler(file_handler)
-
-logger.info("logger started")
 
 def wei_to_eth(n: int) -> float:
     return n / 1000000000000000000
@@ -56,7 +56,9 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
            "/verify <signature> to verify your wallet\n/balance- show your balance in the bet contract\n" \
            "/wallet to get your wallet info\n/deactivate to deactivate your account\n" \
            "/accept <bet id> to accept a bet that's been offered in the chat\n" \
-           "/bets to list all bets in the chat\n" + get_bet_args()
+           "/take <token> <over/under> <token price> <time from now> to accept the best open offer that matches\n" \
+           "/bets [offered/active/mine] to list the bets in the chat, a page at a time\n" \
+           "/stats for your wins, losses and PnL\n/leaderboard for the chat's top bettors\n" + get_bet_args()
     await update.message.reply_text(_msg)
 
 
@@ -157,6 +159,38 @@ async def wallet(api: ApiV2, update: Update, context: ContextTypes.DEFAULT_TYPE)
     await context.bot.send_message(chat_id=update.effective_chat.id, text=_msg)
 
 
+# this check is done client-side because in future the token selection flow will be more complex
+# and probably require a back-and forth in the telegram client
+# cmc lookups run in a worker thread so concurrent commands can share/batch requests in the cmc client.
+# returns None (after telling the chat why) if the expression doesn't pick out one token
+async def resolve_token(api: ApiV2, update: Update, context: ContextTypes.DEFAULT_TYPE, _token):
+    chat_id = update.effective_chat.id
+    if type(_token) is int:
+        _token = await asyncio.to_thread(api.get_token_by_id, _token)
+        if _token is None:
+            await context.bot.send_message(chat_id=chat_id, text="invalid token id")
+            return None
+    elif type(_token) is str:
+        _token_candidates = await asyncio.to_thread(api.get_tokens_from_expr, _token)
+        if _token_candidates is None:
+            await context.bot.send_message(chat_id=chat_id, text="invalid token name")
+            return None
+        # if there's only one token that matches the expr, use it
+        if len(_token_candidates) == 1:
+            _token = _token_candidates[0]
+        else:
+            _best_token = min(_token_candidates, key=lambda x: x.rank)
+            # if one token is clearly better than the rest, use it
+            if _best_token.rank < 750:
+                _token = _best_token
+            # otherwise, every token is some random ambiguous shitcoin, so require a name
+            else:
+                _msg = "ambiguous token name, please specify by name (use the final part of the coinmarketcap url)"
+                await context.bot.send_message(chat_id=chat_id, text=_msg)
+                return None
+    return _token
+
+
 # /bet @Bob $10 $SUI over $1.15 12h
 async def bet(api: ApiV2, update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
@@ -185,31 +219,9 @@ async def bet(api: ApiV2, update: Update, context: ContextTypes.DEFAULT_TYPE):
         _price = float(context.args[4])
     _time_expr = context.args[5]
 
-    # this check is done client-side because in future the token selection flow will be more complex
-    # and probably require a back-and forth in the telegram client
-    if type(_token) is int:
-        _token = api.get_token_by_id(_token)
-        if _token is None:
-            await context.bot.send_message(chat_id=chat_id, text="invalid token id")
-            return 0
-    elif type(_token) is str:
-        _token_candidates = api.get_tokens_from_expr(_token)
-        if _token_candidates is None:
-            await context.bot.send_message(chat_id=chat_id, text="invalid token name")
-            return 0
-        # if there's only one token that matches the expr, use it
-        if len(_token_candidates) == 1:
-            _token = _token_candidates[0]
-        else:
-            _best_token = min(_token_candidates, key=lambda x: x.rank)
-            # if one token is clearly better than the rest, use it
-            if _best_token.rank < 750:
-                _token = _best_token
-            # otherwise, every token is some random ambiguous shitcoin, so require a name
-            else:
-                _msg = "ambiguous token name, please specify by name (use the final part of the coinmarketcap url)"
-                await context.bot.send_message(chat_id=chat_id, text=_msg)
-                return 0
+    _token = await resolve_token(api, update, context, _token)
+    if _token is None:
+        return 0
 
     _over = _side == "over"
     # hardcoding bet offer expiration at 5 mins for now to simplify user flow
@@ -239,23 +251,78 @@ async def accept(api: ApiV2, update: Update, context: ContextTypes.DEFAULT_TYPE)
         return 0
 
     bet_req_id: int = int(context.args[0])
-    # TODO: do this async
-    context.bot.send_message(chat_id=chat_id, text="processing bet accept request...")
-
+    await context.bot.send_message(chat_id=chat_id, text="processing bet accept request...")
 
     # CHECKS ARE DONE IN THE API LAYER, so we just yeet that bitch immediately:
-    response: AcceptBetResponse = api.accept_bet(caller_id=update.effective_user.id,
-                                                 chat_id=chat_id, bet_id=bet_req_id)
+    # (in a worker thread: makeBet blocks until mined, and accepts of unrelated bets shouldn't wait on each other,
+    # the api's AcceptCoordinator serializes the ones that do conflict)
+    response: AcceptBetResponse = await asyncio.to_thread(api.accept_bet, caller_id=update.effective_user.id,
+                                                          chat_id=chat_id, bet_id=bet_req_id)
     if response.success:
-        await context.bot.send_message(chat_id=chat_id, text=f"💸 Bet successfully created!💸\n txn hash: {response.tx_hash}")
+        _note = f"\n({response.error_msg})" if response.error_msg else ""
+        await context.bot.send_message(chat_id=chat_id,
+                                       text=f"💸 Bet successfully created!💸\n txn hash: {response.tx_hash}{_note}")
         return 0
     else:
         await context.bot.send_message(chat_id=chat_id, text=response.error_msg)
         return 0
 
 
-# TODO: gets bets. usage: /bets [offered|accepted|all] [user]
-# current: /bets, no args, gets all bets in chat or by user
+# /take BTC under 70000 10d
+# accepts the best offer to anyone in the chat that's on the other side: for "under 70000", an over offer with a
+# strike of 70000 or higher (higher is better for the under side), expiring within half a day of 10d from now
+async def take(api: ApiV2, update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    if len(context.args) != 4 or context.args[1] not in ("over", "under"):
+        _msg = " ❌incorrect command usage... example usage:\n" \
+               "/take BTC under $70000 10d\n" \
+               "takes the best open offer of a bet that BTC will be over $70000 or more in 10 days, " \
+               "with you on the under side"
+        await context.bot.send_message(chat_id=chat_id, text=_msg)
+        return 0
+
+    _side = context.args[1]
+    try:
+        _price = float(context.args[2][1:] if context.args[2][0] == "$" else context.args[2])
+    except ValueError:
+        await context.bot.send_message(chat_id=chat_id, text="invalid price!")
+        return 0
+    _time_expr = context.args[3]
+
+    _token = await resolve_token(api, update, context, context.args[0])
+    if _token is None:
+        return 0
+
+    await context.bot.send_message(chat_id=chat_id, text="looking for a matching offer...")
+    response: AcceptBetResponse = await asyncio.to_thread(api.take_bet, caller_id=update.effective_user.id,
+                                                          chat_id=chat_id, token=_token, over=_side == "over",
+                                                          price=_price, bet_expiration=_time_expr)
+    if response.success:
+        _note = f"\n({response.error_msg})" if response.error_msg else ""
+        await context.bot.send_message(chat_id=chat_id,
+                                       text=f"💸 Bet successfully created!💸\n txn hash: {response.tx_hash}{_note}")
+    else:
+        await context.bot.send_message(chat_id=chat_id, text=response.error_msg)
+    return 0
+
+
+# "accepted" is what the old usage string called active bets
+_BETS_KINDS = {"all": "all", "offered": "offered", "active": "active", "accepted": "active", "mine": "mine"}
+
+
+# prev/next buttons for a /bets page. the callback data carries everything needed to fetch the neighbouring page
+# (filter, whose listing, direction, cursor), well under telegram's 64 byte limit
+def _bets_keyboard(kind: str, user_id: int, page) -> InlineKeyboardMarkup | None:
+    _buttons = []
+    for label, direction, cursor in (("◀ prev", "p", page.prev), ("next ▶", "n", page.next)):
+        if cursor is not None:
+            _data = f"bets:{kind}:{user_id}:{direction}:{':'.join(str(i) for i in cursor)}"
+            _buttons.append(InlineKeyboardButton(label, callback_data=_data))
+    return InlineKeyboardMarkup([_buttons]) if _buttons else None
+
+
+# gets bets, a page at a time. usage: /bets [offered|active|mine|all]
+# in a group: the chat's bets (mine: only the caller's ones in this chat); in a DM: the caller's bets everywhere
 async def bets(api: ApiV2, update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     _user = api.get_user_by_id(update.effective_user.id)
@@ -266,58 +333,162 @@ async def bets(api: ApiV2, update: Update, context: ContextTypes.DEFAULT_TYPE):
                                                              "make sure to run /setup first")
         return 0
 
-    if chat_id == _user.id:
-        _bets = api.get_bets_by_user_id(_user.id)
-    else:
-        _bets = api.get_bets_by_chat_id(chat_id)
-
-    if _bets is not None and len(_bets.active) + len(_bets.pending) > 0:
-        # _text = f"pending: {_bets.pending}\n active: {_bets.active}"
-        _text = "🔎 currently offered:" if len(_bets.pending) > 0 else ""
-        for bet_struct in _bets.pending:
-            _open_to = bet_struct.counterparty if bet_struct.counterparty else "Anyone ‼️"
-            _side = "under" if bet_struct.creator_over else "over"
-            _offer_valid_for = str(bet_struct.valid_till - datetime.now())
-            d1 = f"\nID: {bet_struct.id}\n Open to: {api.get_user_by_id(_open_to).user_name} for {_offer_valid_for}\n"
-            d2 = f"${bet_struct.token.symbol} {_side} ${fmt_amount(bet_struct.price)} in {bet_struct.str_exp}\n"
-            d3 = f"Amount wagered: {fmt_amount(bet_struct.amount)}\n"
-            _text += d1 + d2 + d3
-
-        _text += "⏳ currently active:" if len(_bets.active) > 0 else ""
-        for bet_struct in _bets.active:
-            _over_user = api.get_user_by_id(bet_struct.over_user_id)
-            _under_user = api.get_user_by_id(bet_struct.under_user_id)
-            _symbol = api.get_token_by_id(int(bet_struct.token)).symbol  # TODO: hack, fix this
-            _blocks_left = bet_struct.expiry - api.get_l1_block_number()
-            _time_est = (_blocks_left) * 12
-            _mins = int(_time_est / 60)
-            _hrs = _mins / 60
-            _wks = (_hrs / 24) / 7
-            _time_str = f"~{_wks} weeks" if _wks > 1 else f"~{_hrs} hours" if _hrs > 1 else f"~{_mins} minutes"
-
-            d1 = f"\nID: {bet_struct.id}\n Over: @{_over_user.user_name}\n Under: @{_under_user.user_name}\n"
-            d2 = f"${_symbol} trades at ${wei_to_eth(int(bet_struct.price))}"
-            d3 = f" in {_time_str} ({_blocks_left} blocks)\n"
-            d4 = f"Amount wagered: {fmt_amount(bet_struct.amount)} ETH\n"
-            _text += d1 + d2 + d3 + d4
-        await context.bot.send_message(chat_id=chat_id, text=_text)
+    _kind = _BETS_KINDS.get(context.args[0].lower() if context.args else "all")
+    if _kind is None:
+        await context.bot.send_message(chat_id=chat_id, text="usage: /bets [offered|active|mine|all]")
         return 0
-    else:
+
+    # the page is served from the per-chat/per-user view cache; a cold build does network calls, so thread it
+    _page = await asyncio.to_thread(api.bets_views.page, api.bets_views.key_for(chat_id, _user.id, _kind), _kind)
+    if _page is None:
         await context.bot.send_message(chat_id=chat_id, text="no bets found!")
         return 0
+    await context.bot.send_message(chat_id=chat_id, text=_page.text,
+                                   reply_markup=_bets_keyboard(_kind, _user.id, _page))
+    return 0
+
+
+# a prev/next button under a /bets page: swaps the message for the neighbouring page
+async def bets_page(api: ApiV2, update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    try:
+        _, _kind, _user_id, _direction, *_cursor = query.data.split(":")
+        _user_id, _cursor = int(_user_id), tuple(int(i) for i in _cursor)
+    except ValueError:
+        await query.answer()
+        return 0
+
+    _key = api.bets_views.key_for(query.message.chat.id, _user_id, _kind)
+    _page = await asyncio.to_thread(api.bets_views.page, _key, _kind, _cursor, _direction == "p")
+    await query.answer()
+    if _page is None:
+        await query.edit_message_text(text="no bets found!")
+        return 0
+    await query.edit_message_text(text=_page.text, reply_markup=_bets_keyboard(_kind, _user_id, _page))
+    return 0
+
+
+def _fmt_pnl(wei) -> str:
+    _eth = fmt_amount(to_int(wei))
+    return f"+{_eth}" if _eth > 0 else f"{_eth}"
+
+
+def _fmt_streak(streak: int) -> str:
+    if streak > 0:
+        return f"{streak} win{'s' if streak > 1 else ''}"
+    if streak < 0:
+        return f"{-streak} loss{'es' if streak < -1 else ''}"
+    return "-"
+
+
+# your record: overall in private, in this chat (plus the chat's totals) in a group. both are single reads of
+# aggregates kept up to date at settlement time
+async def stats(api: ApiV2, update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    _user_id = update.effective_user.id
+    _private = chat_id == _user_id
+
+    _stats = await asyncio.to_thread(api.stats.get_user_stats, _user_id, None if _private else chat_id)
+    if _stats is None:
+        _msg = "no settled bets yet!" if _private else "you haven't settled any bets in this chat yet!"
+    else:
+        _msg = f"📊 {update.effective_user.username or _user_id} ({'overall' if _private else 'this chat'}):\n" \
+               f" wins: {_stats['wins']}, losses: {_stats['losses']}\n" \
+               f" volume: {fmt_amount(to_int(_stats['volume']))}ETH\n" \
+               f" net PnL: {_fmt_pnl(_stats['net_pnl'])}ETH\n" \
+               f" streak: {_fmt_streak(_stats['streak'])} (best: {_fmt_streak(_stats['best_streak'])})"
+    if not _private:
+        _chat = await asyncio.to_thread(api.stats.get_chat_stats, chat_id)
+        if _chat is not None:
+            _msg += f"\n\nthis chat: {_chat['bets']} bets settled, {fmt_amount(to_int(_chat['volume']))}ETH " \
+                    f"wagered"
+    await context.bot.send_message(chat_id=chat_id, text=_msg)
+
+
+# top 10 by net pnl, in this chat (or overall, in private)
+async def leaderboard(api: ApiV2, update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    _private = chat_id == update.effective_user.id
+    _rows = await asyncio.to_thread(api.stats.leaderboard, None if _private else chat_id)
+    if not _rows:
+        await context.bot.send_message(chat_id=chat_id, text="no settled bets yet!")
+        return 0
+
+    def _lines():
+        for rank, row in enumerate(_rows, start=1):
+            _user = api.get_user_by_id(row.get("user_id", row["_id"]))
+            _name = f"@{_user.user_name}" if _user is not None else f"user {row.get('user_id', row['_id'])}"
+            yield f"{rank}. {_name} {_fmt_pnl(row['net_pnl'])}ETH ({row['wins']}W/{row['losses']}L)"
+
+    _header = "🏆 leaderboard (net PnL, all chats):" if _private else "🏆 leaderboard (net PnL):"
+    _text = "\n".join([_header, *(await asyncio.to_thread(lambda: list(_lines())))])
+    await context.bot.send_message(chat_id=chat_id, text=_text)
+
+
+# one settlement round at a time per process (the interval job and a takeover run can overlap)
+_settlement_lock = asyncio.Lock()
 
 
 # if user calling this fn from private chat, return the user's bets
-async def settle_bets(api: ApiV2, context: ContextTypes.DEFAULT_TYPE):
+# results are posted to the outbox rather than awaited, so a mass expiry doesn't stall on telegram flood limits.
+# every replica schedules this, but only the settlement lease holder actually settles
+async def settle_bets(api: ApiV2, outbox: Outbox, lease: Lease, context: ContextTypes.DEFAULT_TYPE):
+    if not lease.is_held():
+        logger.info("not the settlement leader, skipping settlement")
+        return
+    if _settlement_lock.locked():
+        logger.info("settlement round already in progress, skipping")
+        return
+    async with _settlement_lock:
+        await _settle_round(api, outbox, lease)
+
+
+async def _settle_round(api: ApiV2, outbox: Outbox, lease: Lease):
     logger.info("settle bets callback running...")
-    settled_bets = api.settle_outstanding()
-    logger.info(f"settled {len(settled_bets)} bets")
+    # in a thread so the lease keeps getting renewed while settlement txns are being mined
+    settled_bets = await asyncio.to_thread(api.settle_outstanding, lease)
+    logger.info("settled %d bets", len(settled_bets))
     for bet_response in settled_bets:
         if bet_response.success_msg:
-            await context.bot.send_message(chat_id=bet_response.bet.chat_created_in,
-                                           text=bet_response.success_msg)
+            outbox.post(bet_response.bet.chat_created_in, bet_response.success_msg)
         if bet_response.error_msg:
-            print(f"ERROR: {bet_response.error_msg}")
+            logger.error("settling bet %s: %s", bet_response.bet.id, bet_response.error_msg)
+
+    # anything that's been unpriceable for the whole invalidation window gets its funds released
+    for invalidate_response in await asyncio.to_thread(api.sweep_stale_bets, lease):
+        if invalidate_response.success_msg:
+            outbox.post(invalidate_response.bet.chat_created_in, invalidate_response.success_msg)
+        if not invalidate_response.success:
+            logger.error("invalidating stale bet %s: %s", invalidate_response.bet.id, invalidate_response.error_msg)
+
+
+# accepts, settlements and invalidations whose txn timed out unmined get finished (or undone) here once the chain
+# says what happened to them, see ApiV2.reconcile_pending. every replica runs this for its own
+async def reconcile_pending(api: ApiV2, outbox: Outbox):
+    try:
+        messages = await asyncio.to_thread(api.reconcile_pending)
+    except Exception as e:
+        logger.error(f"reconciling unmined txns failed: {e}")
+        return
+    for chat_id, msg in messages:
+        outbox.post(chat_id, msg)
+
+
+# returns True if this replica just became the settlement leader
+async def renew_lease(api: ApiV2, lease: Lease) -> bool:
+    was_held = lease.is_held()
+    try:
+        held = await asyncio.to_thread(lease.acquire_or_renew)
+    except PyMongoError as e:
+        # can't reach mongo: the lease lapses locally after its ttl and a replica that can reach it takes over
+        logger.error(f"couldn't renew settlement lease: {e}")
+        return False
+    if held and not was_held:
+        # bets created by the previous leader since we started aren't in our cache yet
+        await asyncio.to_thread(api.reload_bet_cache)
+        return True
+    return False
+
 
 if __name__ == '__main__':
     base_dir = os.path.dirname(os.path.abspath(__file__))
@@ -325,21 +496,112 @@ if __name__ == '__main__':
     print(dotenv_path)
     load_dotenv(dotenv_path=dotenv_path)
 
+    # logging runs through a queue to a writer thread (see logs.py), the file rotates at LOG_MAX_BYTES.
+    # LOG_LEVELS: per-logger levels, e.g. "tgbot.apiv2=DEBUG,httpx=WARNING"; LOG_FORMAT=json for structured lines;
+    # SETTLEMENT_DEBUG_SAMPLE: fraction of settlement rounds logged in full at debug
+    logs.setup_logging(path=os.getenv("LOG_FILE", "app.log"), level=os.getenv("LOG_LEVEL", "INFO"),
+                       levels=os.getenv("LOG_LEVELS", logs.DEFAULT_LEVELS),
+                       max_bytes=int(os.getenv("LOG_MAX_BYTES", "50000000")),
+                       backups=int(os.getenv("LOG_BACKUPS", "5")), fmt=os.getenv("LOG_FORMAT", "text"),
+                       queue_size=int(os.getenv("LOG_QUEUE_SIZE", "10000")),
+                       settlement_debug_sample=float(os.getenv("SETTLEMENT_DEBUG_SAMPLE", "0")))
+    logger.info("logger started")
+    mark_startup("imports")
+
     # apiv2
     CONTRACT_ADDR = os.getenv("CONTRACT_ADDR")
     PK = os.getenv("PRIVATE_KEY")
     RPC_URL = os.getenv("RPC_URL")
     L1_RPC_URL = os.getenv("L1_RPC_URL")
-    backend_api = ApiV2(contract_addr=CONTRACT_ADDR, rpc_url=RPC_URL, pk=PK, l1_rpc_url=L1_RPC_URL)
+    CMC_RATE_PER_MINUTE = int(os.getenv("CMC_RATE_PER_MINUTE", "30"))     # basic plan limit
+    RPC_WRITE_URLS = os.getenv("RPC_WRITE_URLS")    # optional; defaults to every url in RPC_URL
+    # sharded deployment: BOT_SHARDS workers behind `python -m tgbot.shards`, each owning a hash-partition of chats,
+    # all signing through one `python -m tgbot.signer` at SIGNER_ADDR (so workers don't need PRIVATE_KEY)
+    BOT_SHARDS = int(os.getenv("BOT_SHARDS", "1"))
+    SHARD = Shard(int(os.getenv("BOT_SHARD_INDEX", "0")), BOT_SHARDS) if BOT_SHARDS > 1 else None
+    SIGNER_ADDR = os.getenv("SIGNER_ADDR")
+    SIGNER_TOKEN = os.getenv("SIGNER_TOKEN")    # the signer's shared secret, required for a tcp: SIGNER_ADDR
+    if SHARD is not None and not SIGNER_ADDR:
+        raise ValueError("BOT_SHARDS > 1 needs SIGNER_ADDR, workers signing with one key would fight over nonces")
+    if SHARD is not None and os.getenv("BOT_MODE", "polling") != "webhook":
+        raise ValueError("sharded workers only work with BOT_MODE=webhook (updates come from the shard router)")
+    # active_bets writes go through a local journal and are flushed to mongo in bulk; every process needs its own
+    # journal file. DURABLE_WRITES=0 lets accepts/settlement rounds return before their writes are in mongo
+    WRITE_JOURNAL = os.getenv("WRITE_JOURNAL", f"active_bets.{SHARD.index}.journal" if SHARD else "active_bets.journal")
+    # open offers survive restarts through this journal (also one per process)
+    PROPOSAL_JOURNAL = os.getenv("PROPOSAL_JOURNAL", f"proposals.{SHARD.index}.journal" if SHARD else "proposals.journal")
+    backend_api = ApiV2(contract_addr=CONTRACT_ADDR, rpc_url=RPC_URL, pk=PK, l1_rpc_url=L1_RPC_URL,
+                        cmc_rate_per_minute=CMC_RATE_PER_MINUTE, rpc_write_urls=RPC_WRITE_URLS,
+                        signer_addr=SIGNER_ADDR, shard=SHARD, replica_id=os.getenv("REPLICA_ID"),
+                        write_journal=WRITE_JOURNAL,
+                        write_flush_interval=float(os.getenv("WRITE_FLUSH_INTERVAL_SECONDS", "1")),
+                        write_flush_max_ops=int(os.getenv("WRITE_FLUSH_MAX_OPS", "500")),
+                        durable_writes=os.getenv("DURABLE_WRITES", "1") == "1", proposal_journal=PROPOSAL_JOURNAL,
+                        balance_ttl=float(os.getenv("BALANCE_CACHE_TTL_SECONDS", "30")), signer_token=SIGNER_TOKEN,
+                        signer_receipt_timeout=float(os.getenv("SIGNER_RECEIPT_TIMEOUT_SECONDS", "120")))
     del CONTRACT_ADDR, PK, RPC_URL
+    mark_startup("api_ready")
+
+    # prometheus-format metrics, local only (scrape from the same box or tunnel in)
+    METRICS_PORT = int(os.getenv("METRICS_PORT", "9464"))
+    if METRICS_PORT > 0:
+        metrics.start_http_server(METRICS_PORT, addr=os.getenv("METRICS_ADDR", "127.0.0.1"))
+
+    # per-update tracing; commands slower than the threshold get their span tree logged to tgbot.slow_commands
+    tracing.TRACER.configure(slow_threshold=float(os.getenv("SLOW_COMMAND_SECONDS", "5")),
+                             sample_rate=float(os.getenv("TRACE_SAMPLE_RATE", "1.0")))
+
+    # read-only http api over the book and balances (HTTP_API_PORT=0: off), served from the bot's event loop.
+    # fastapi/uvicorn are only imported when it's on, they're a noticeable part of startup otherwise
+    HTTP_API_PORT = int(os.getenv("HTTP_API_PORT", "0"))
+    read_api = None
+    if HTTP_API_PORT > 0:
+        from .http_api import ReadApi
+        read_api = ReadApi(backend_api, host=os.getenv("HTTP_API_ADDR", "127.0.0.1"), port=HTTP_API_PORT,
+                           max_page=int(os.getenv("HTTP_API_MAX_PAGE", "200")))
 
     # tg tgbot setup
     API_KEY = os.getenv("TG_TOKEN")
-    application = ApplicationBuilder().token(API_KEY).concurrent_updates(True).build()
-
+    # settlement runs on exactly one replica (per shard): whoever holds this lease. a standby picks it up within
+    # LEASE_TTL_SECONDS of the leader dying, or immediately if the leader shuts down cleanly
+    LEASE_TTL_SECONDS = float(os.getenv("LEASE_TTL_SECONDS", "10"))
+    settlement_lease = Lease(backend_api.leases_db, f"settlement:{SHARD.index}" if SHARD else "settlement",
+                             ttl=LEASE_TTL_SECONDS)
+
+    async def on_start(_application):
+        if read_api is not None:
+            read_api.start()
+
+    # give queued settlement notifications a chance to go out before the bot stops, then hand over leadership
+    async def on_stop(_application):
+        if read_api is not None:
+            await read_api.stop()
+        await outbox.flush()
+        await asyncio.to_thread(settlement_lease.release)
+        await asyncio.to_thread(backend_api.bet_writes.close)
+        backend_api.proposals.close()
+        await asyncio.to_thread(backend_api.changes.stop)
+
+    # BOT_WORKERS: how many updates are handled at once (either mode)
+    # TG_BASE_URL: bot api base url, e.g. a local tgbot.fake_telegram for testing
+    builder = ApplicationBuilder().token(API_KEY).concurrent_updates(int(os.getenv("BOT_WORKERS", "256")))
+    if os.getenv("TG_BASE_URL"):
+        builder = builder.base_url(os.getenv("TG_BASE_URL"))
+    application = builder.post_init(on_start).post_stop(on_stop).build()
+
+    # settlement notifications: coalesced per chat over OUTBOX_WINDOW_SECONDS and paced under telegram's limits
+    outbox = Outbox(application.bot, window=float(os.getenv("OUTBOX_WINDOW_SECONDS", "2")))
 
     async def settle_bets_callback(context: ContextTypes.DEFAULT_TYPE):
-        await settle_bets(backend_api, context=context)
+        await settle_bets(backend_api, outbox, settlement_lease, context=context)
+
+    async def reconcile_pending_callback(context: ContextTypes.DEFAULT_TYPE):
+        await reconcile_pending(backend_api, outbox)
+
+    async def renew_lease_callback(context: ContextTypes.DEFAULT_TYPE):
+        if await renew_lease(backend_api, settlement_lease):
+            # new leader: work off whatever backlog the old one left right away instead of at the next interval
+            context.job_queue.run_once(settle_bets_callback, 0)
 
     async def wallet_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await wallet(backend_api, update=update, context=context)
@@ -362,32 +624,74 @@ if __name__ == '__main__':
     async def bets_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await bets(backend_api, update=update, context=context)
 
+    async def bets_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        await bets_page(backend_api, update=update, context=context)
+
     async def accept_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await accept(backend_api, update=update, context=context)
 
+    async def take_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        await take(backend_api, update=update, context=context)
+
+    async def stats_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        await stats(backend_api, update=update, context=context)
+
+    async def leaderboard_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        await leaderboard(backend_api, update=update, context=context)
+
+    # the first update to reach the handlers marks the end of startup (see tgbot/bench_startup.py)
+    _first_update = []
+
+    async def first_update_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if not _first_update:
+            _first_update.append(update.update_id)
+            mark_startup("first_update")
+
+    application.add_handler(TypeHandler(Update, first_update_callback, block=False), group=-1)
+
     job_queue = application.job_queue
+    job_queue.run_repeating(renew_lease_callback, interval=LEASE_TTL_SECONDS / 3, first=0)
     job_queue.run_repeating(settle_bets_callback, interval=300)
-
-    start_handler = CommandHandler('start', start)
-    bet_handler = CommandHandler('bet', bet_callback)
-    bets_handler = CommandHandler('bets', bets_callback)
-    balance_handler = CommandHandler('balance', balance_callback)
-    setup_handler = CommandHandler('setup', setup_callback)
-    verify_handler = CommandHandler('verify', verify_callback)
-    deactivate_handler = CommandHandler('deactivate', deactivate_callback)
-    accept_handler = CommandHandler('accept', accept_callback)
-    wallet_handler = CommandHandler('wallet', wallet_callback)
+    job_queue.run_repeating(reconcile_pending_callback, interval=60, first=0)
+
+    start_handler = CommandHandler('start', tracing.traced('start', start))
+    bet_handler = CommandHandler('bet', tracing.traced('bet', bet_callback))
+    bets_handler = CommandHandler('bets', tracing.traced('bets', bets_callback))
+    bets_page_handler = CallbackQueryHandler(tracing.traced('bets_page', bets_page_callback), pattern="^bets:")
+    balance_handler = CommandHandler('balance', tracing.traced('balance', balance_callback))
+    setup_handler = CommandHandler('setup', tracing.traced('setup', setup_callback))
+    verify_handler = CommandHandler('verify', tracing.traced('verify', verify_callback))
+    deactivate_handler = CommandHandler('deactivate', tracing.traced('deactivate', deactivate_callback))
+    accept_handler = CommandHandler('accept', tracing.traced('accept', accept_callback))
+    take_handler = CommandHandler('take', tracing.traced('take', take_callback))
+    wallet_handler = CommandHandler('wallet', tracing.traced('wallet', wallet_callback))
+    stats_handler = CommandHandler('stats', tracing.traced('stats', stats_callback))
+    leaderboard_handler = CommandHandler('leaderboard', tracing.traced('leaderboard', leaderboard_callback))
     application.add_handler(wallet_handler)
     application.add_handler(deactivate_handler)
     application.add_handler(start_handler)
     application.add_handler(bet_handler)
     application.add_handler(bets_handler)
+    application.add_handler(bets_page_handler)
     application.add_handler(balance_handler)
     application.add_handler(verify_handler)
     application.add_handler(setup_handler)
     application.add_handler(accept_handler)
+    application.add_handler(take_handler)
+    application.add_handler(stats_handler)
+    application.add_handler(leaderboard_handler)
 
     # test_handler = CommandHandler('test', test)
     # application.add_handler(test_handler)
 
-    application.run_polling()
+    # BOT_MODE=webhook: telegram pushes updates to our receiver instead of us long-polling for them
+    if os.getenv("BOT_MODE", "polling") == "webhook":
+        webhook.run_webhook(application, listen=os.getenv("WEBHOOK_LISTEN", "127.0.0.1"),
+                            port=int(os.getenv("WEBHOOK_PORT", "8443")),
+                            path=os.getenv("WEBHOOK_PATH", "/telegram"),
+                            webhook_url=os.getenv("WEBHOOK_URL"),
+                            secret=os.getenv("WEBHOOK_SECRET"),
+                            max_pending=int(os.getenv("WEBHOOK_MAX_PENDING", "1000")),
+                            shard=SHARD)
+    else:
+        application.run_polling()
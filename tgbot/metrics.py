@@ -0,0 +1,314 @@
+import time
+import threading
+import logging
+from functools import wraps
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from . import tracing
+
+logger = logging.getLogger(__name__)
+
+# seconds; tuned for "telegram user is waiting" latencies, not for microbenchmarks
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# blocks between a bet's expiry and the block it was actually settled in
+BLOCK_LAG_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+
+def _fmt_labels(labelnames: tuple, labelvalues: tuple, extra: dict | None = None) -> str:
+    pairs = list(zip(labelnames, labelvalues))
+    if extra:
+        pairs += list(extra.items())
+    if not pairs:
+        return ""
+    _escaped = [(k, str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')) for k, v in pairs]
+    return "{" + ",".join(f'{k}="{v}"' for k, v in _escaped) + "}"
+
+
+def _fmt_value(v: float) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    if float(v).is_integer():
+        return str(int(v))
+    return repr(float(v))
+
+
+# base class for all metric types: holds one child value per distinct label combination
+class _Metric:
+    type_name = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"metric {self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(labels[n] for n in self.labelnames)
+
+    def _samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        lines += self._samples()
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        if amount < 0:
+            raise ValueError("counters can only go up")
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self) -> list[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_fmt_labels(self.labelnames, k)} {_fmt_value(v)}" for k, v in items]
+
+
+# gauges can either be set directly or backed by a callback that is evaluated at scrape time,
+# which is how the book size etc. are exported without touching the hot path
+class Gauge(_Metric):
+    type_name = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        super().__init__(name, documentation, labelnames)
+        self._functions = {}
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, fn, **labels):
+        self._functions[self._key(labels)] = fn
+
+    def _samples(self) -> list[str]:
+        with self._lock:
+            values = dict(self._values)
+        for key, fn in self._functions.items():
+            try:
+                _v = fn()
+            except Exception:
+                logger.exception(f"gauge callback for {self.name} failed")
+                continue
+            if _v is not None:
+                values[key] = _v
+        return [f"{self.name}{_fmt_labels(self.labelnames, k)} {_fmt_value(v)}" for k, v in values.items()]
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, _sum, _count = self._values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            for i, upper in enumerate(self.buckets):
+                if value <= upper:
+                    counts[i] += 1
+            self._values[key] = (counts, _sum + value, _count + 1)
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self) -> list[str]:
+        with self._lock:
+            items = [(k, (list(c), s, n)) for k, (c, s, n) in self._values.items()]
+        lines = []
+        for key, (counts, _sum, _count) in items:
+            for upper, c in zip(self.buckets, counts):
+                lines.append(f"{self.name}_bucket{_fmt_labels(self.labelnames, key, {'le': _fmt_value(upper)})} {c}")
+            lines.append(f"{self.name}_bucket{_fmt_labels(self.labelnames, key, {'le': '+Inf'})} {_count}")
+            lines.append(f"{self.name}_sum{_fmt_labels(self.labelnames, key)} {_fmt_value(_sum)}")
+            lines.append(f"{self.name}_count{_fmt_labels(self.labelnames, key)} {_count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric):
+                    raise ValueError(f"metric {metric.name} already registered as {existing.type_name}")
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: tuple = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple = (),
+                  buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(m.render() for m in metrics) + "\n"
+
+
+REGISTRY = Registry()
+
+#### METRICS ####
+API_CALL_SECONDS = REGISTRY.histogram("pvpbet_api_call_seconds", "latency of ApiV2 public methods",
+                                      ("method",))
+API_CALL_ERRORS = REGISTRY.counter("pvpbet_api_call_errors_total", "ApiV2 public methods that raised",
+                                   ("method",))
+OUTBOUND_SECONDS = REGISTRY.histogram("pvpbet_outbound_seconds", "latency of outbound calls",
+                                      ("target", "op"))
+OUTBOUND_ERRORS = REGISTRY.counter("pvpbet_outbound_errors_total", "outbound calls that raised or returned an error",
+                                   ("target", "op"))
+CMC_CREDITS = REGISTRY.counter("pvpbet_cmc_credits_total", "coinmarketcap api credits consumed", ("endpoint",))
+TXNS = REGISTRY.counter("pvpbet_transactions_total", "bookie transactions by outcome", ("fn", "status"))
+BOOK_SIZE = REGISTRY.gauge("pvpbet_book_size", "active (on-chain) bets tracked in the bet cache")
+PENDING_PROPOSALS = REGISTRY.gauge("pvpbet_pending_proposals", "open bet proposals waiting to be accepted")
+OLDEST_UNSETTLED_EXPIRY = REGISTRY.gauge("pvpbet_oldest_unsettled_expiry_block",
+                                         "expiry block of the next bet due for settlement")
+CACHE_LOOKUPS = REGISTRY.counter("pvpbet_cache_lookups_total", "in-process cache lookups by result (hit/miss)",
+                                 ("cache", "result"))
+SETTLEMENT_LAG_BLOCKS = REGISTRY.histogram("pvpbet_settlement_lag_blocks",
+                                           "blocks between bet expiry and successful settlement",
+                                           buckets=BLOCK_LAG_BUCKETS)
+STARTUP_SECONDS = REGISTRY.gauge("pvpbet_startup_seconds", "seconds from process start to each startup milestone",
+                                 ("phase",))
+
+
+# times a block of code that leaves the process; errors are counted and re-raised
+@contextmanager
+def outbound(target: str, op: str):
+    start = time.perf_counter()
+    try:
+        with tracing.span(f"{target}:{op}"):
+            yield
+    except Exception:
+        OUTBOUND_ERRORS.inc(target=target, op=op)
+        raise
+    finally:
+        OUTBOUND_SECONDS.observe(time.perf_counter() - start, target=target, op=op)
+
+
+def timed_method(fn):
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            with tracing.span(f"api:{fn.__name__}"):
+                return fn(*args, **kwargs)
+        except Exception:
+            API_CALL_ERRORS.inc(method=fn.__name__)
+            raise
+        finally:
+            API_CALL_SECONDS.observe(time.perf_counter() - start, method=fn.__name__)
+    wrapper.__timed__ = True
+    return wrapper
+
+
+# class decorator: wraps every public instance method (staticmethods are pure parsing helpers, skip them)
+def instrument_public_methods(cls):
+    for name, attr in list(vars(cls).items()):
+        if name.startswith("_") or not callable(attr) or isinstance(attr, (staticmethod, classmethod, type)):
+            continue
+        if getattr(attr, "__timed__", False):
+            continue
+        setattr(cls, name, timed_method(attr))
+    return cls
+
+
+# web3 (v6) middleware: every L2 json-rpc request goes through here, so this covers eth_call, sends, receipts...
+def web3_metrics_middleware(make_request, w3):
+    def middleware(method, params):
+        with outbound("l2_rpc", method):
+            response = make_request(method, params)
+        if isinstance(response, dict) and response.get("error") is not None:
+            OUTBOUND_ERRORS.inc(target="l2_rpc", op=method)
+        return response
+    return middleware
+
+
+# pymongo command listener, registered via MongoClient(event_listeners=[...])
+# imported lazily so this module stays usable without pymongo installed
+def mongo_command_listener():
+    from pymongo import monitoring
+
+    class _MongoMetricsListener(monitoring.CommandListener):
+        def started(self, event):
+            pass
+
+        def succeeded(self, event):
+            OUTBOUND_SECONDS.observe(event.duration_micros / 1e6, target="mongo", op=event.command_name)
+            tracing.record(f"mongo:{event.command_name}", event.duration_micros / 1e6)
+
+        def failed(self, event):
+            OUTBOUND_SECONDS.observe(event.duration_micros / 1e6, target="mongo", op=event.command_name)
+            tracing.record(f"mongo:{event.command_name}", event.duration_micros / 1e6, failed=True)
+            OUTBOUND_ERRORS.inc(target="mongo", op=event.command_name)
+
+    return _MongoMetricsListener()
+
+
+#### EXPORT ####
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/metrics", "/"):
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = self.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scrapes every few seconds would drown the app log otherwise
+        pass
+
+
+# serves the prometheus text format on a daemon thread; binds to localhost by default on purpose
+def start_http_server(port: int, addr: str = "127.0.0.1", registry: Registry = REGISTRY) -> ThreadingHTTPServer:
+    handler = type("MetricsHandler", (_MetricsHandler,), {"registry": registry})
+    server = ThreadingHTTPServer((addr, port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True)
+    thread.start()
+    logger.info(f"metrics endpoint listening on http://{addr}:{port}/metrics")
+    return server
@@ -0,0 +1,77 @@
+import heapq
+import itertools
+from bisect import bisect_right, insort
+from datetime import datetime
+from .schema import BetProposal
+
+# a day of blocks (12s each, same as ApiV2.parse_date_expr)
+DEFAULT_BUCKET_BLOCKS = 7200
+
+
+# the open offers anyone can take (counterparty=None), grouped into books by chat, token, the side the creator
+# took and expiry bucket. each book is a list kept sorted best-first for a taker, so the best compatible offer is
+# a bisect away no matter how deep the book is. a taker matches offers expiring within half a bucket either side
+# of the expiry they asked for, which touches at most two adjacent buckets; those are merged best-first:
+#   creator took over  -> taker gets under -> a higher strike is better, sorted by -price
+#   creator took under -> taker gets over  -> a lower strike is better, sorted by price
+# ties go to the older offer. not thread-safe, ProposalStore keeps it under its lock
+class OrderBook:
+    def __init__(self, bucket_blocks: int = DEFAULT_BUCKET_BLOCKS):
+        self.bucket_blocks = bucket_blocks
+        self.window = bucket_blocks // 2
+        self._books = {}            # (chat id, token id, creator_over, bucket) -> [(sort key, seq, proposal id)]
+        self._entries = {}          # proposal id -> (book key, entry), for O(log n) lookup on removal
+        self._seq = itertools.count()
+
+    def _key(self, chat_id: int, token_id: int, creator_over: bool, expiry: int) -> tuple:
+        return chat_id, token_id, creator_over, expiry // self.bucket_blocks
+
+    @staticmethod
+    def _sort_key(creator_over: bool, price: int) -> int:
+        return -price if creator_over else price
+
+    def add(self, p: BetProposal):
+        if p.counterparty is not None or p.id in self._entries:
+            return
+        key = self._key(p.chat_created_in, p.token.id, p.creator_over, p.expiry)
+        entry = (self._sort_key(p.creator_over, p.price), next(self._seq), p.id)
+        insort(self._books.setdefault(key, []), entry)
+        self._entries[p.id] = (key, entry)
+
+    def remove(self, proposal_id: int):
+        key, entry = self._entries.pop(proposal_id, (None, None))
+        if key is None:
+            return
+        book = self._books[key]
+        i = bisect_right(book, entry) - 1
+        if i >= 0 and book[i] == entry:
+            del book[i]
+        if not book:
+            del self._books[key]
+
+    # ids of up to `limit` offers a taker could accept, best first: offers of `token_id` in `chat_id` on the other
+    # side of `taker_over`, expiring within `window` blocks of `expiry`, with a strike at least as good as
+    # `limit_price` (>= it for an under taker, <= for an over taker). skips the taker's own and lapsed offers
+    def best(self, proposals: dict, chat_id: int, token_id: int, taker_over: bool, expiry: int, limit_price: int,
+             taker_id: int | None = None, limit: int = 5) -> list[int]:
+        creator_over = not taker_over
+        _limit_key = (self._sort_key(creator_over, limit_price), float("inf"))
+        _buckets = range((expiry - self.window) // self.bucket_blocks, (expiry + self.window) // self.bucket_blocks + 1)
+        candidates = []
+        for bucket in _buckets:
+            book = self._books.get((chat_id, token_id, creator_over, bucket), [])
+            # everything before the cutoff has a strike at least as good as the limit
+            candidates.append(itertools.islice(book, bisect_right(book, _limit_key)))
+        now = datetime.now()
+        found = []
+        for _, _, proposal_id in heapq.merge(*candidates):
+            p = proposals[proposal_id]
+            if p.created_by == taker_id or p.valid_till < now or abs(p.expiry - expiry) > self.window:
+                continue
+            found.append(proposal_id)
+            if len(found) == limit:
+                break
+        return found
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,135 @@
+import asyncio
+import logging
+from collections import defaultdict
+from telegram.error import RetryAfter, ChatMigrated, Forbidden, BadRequest, NetworkError
+from . import metrics
+from .cmc import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+QUEUED = metrics.REGISTRY.gauge("pvpbet_outbox_queued_messages", "notifications waiting to be sent")
+SENT = metrics.REGISTRY.counter("pvpbet_outbox_sends_total", "outbox send attempts by result", ("result",))
+COALESCED = metrics.REGISTRY.counter("pvpbet_outbox_coalesced_total",
+                                     "notifications that were merged into another chat message")
+
+MAX_MESSAGE_LEN = 4096              # telegram's limit on message text
+
+
+# splits a message that's too long on its own into sendable pieces, preferring line breaks
+def _split_long(text: str, limit: int) -> list[str]:
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        cut = cut if cut > 0 else limit
+        parts.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    return parts + [text] if text else parts
+
+
+# packs notifications into as few messages as possible without splitting any that fit on their own
+def digest(texts: list[str], limit: int = MAX_MESSAGE_LEN, sep: str = "\n\n") -> list[str]:
+    chunks = []
+    current = ""
+    for text in texts:
+        for part in _split_long(text, limit):
+            if current and len(current) + len(sep) + len(part) <= limit:
+                current += sep + part
+            else:
+                if current:
+                    chunks.append(current)
+                current = part
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+# fire-and-forget notifications for chats. post() never blocks: messages for a chat are collected for `window`
+# seconds and go out as one digest, paced by a per-chat and a global token bucket (telegram allows ~20 msgs/min
+# into a group and ~30 msgs/s overall). flood-wait errors pause only the affected chat's task, so settlement
+# can keep posting results while telegram catches up
+class Outbox:
+    def __init__(self, bot, window: float = 2.0, chat_rate_per_minute: float = 20, chat_burst: int = 3,
+                 global_rate_per_second: float = 25, max_retries: int = 5):
+        self.bot = bot
+        self.window = window
+        self.chat_rate_per_minute = chat_rate_per_minute
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.global_bucket = TokenBucket(global_rate_per_second * 60, burst=int(global_rate_per_second))
+        self._chat_buckets = {}
+        self._pending = defaultdict(list)       # chat id -> texts not yet picked up by the chat's task
+        self._tasks = {}                        # chat id -> task draining that chat
+
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate_per_minute, burst=self.chat_burst)
+        return bucket
+
+    # must be called from the event loop thread
+    def post(self, chat_id: int, text: str):
+        if not text:
+            return
+        self._pending[chat_id].append(text)
+        QUEUED.inc()
+        if chat_id not in self._tasks:
+            self._tasks[chat_id] = asyncio.get_running_loop().create_task(self._drain_chat(chat_id))
+
+    async def _drain_chat(self, chat_id: int):
+        target = chat_id
+        try:
+            while self._pending.get(chat_id):
+                # let the rest of this burst (e.g. the rest of a settlement batch) land before sending
+                await asyncio.sleep(self.window)
+                texts = self._pending.pop(chat_id, [])
+                QUEUED.dec(len(texts))
+                if len(texts) > 1:
+                    COALESCED.inc(len(texts) - 1)
+                for chunk in digest(texts):
+                    target = await self._send(target, chunk)
+        except Exception:
+            logger.exception(f"outbox task for chat {chat_id} died")
+        finally:
+            self._tasks.pop(chat_id, None)
+            # anything posted while the last send was in flight needs a new task
+            if self._pending.get(chat_id):
+                self._tasks[chat_id] = asyncio.get_running_loop().create_task(self._drain_chat(chat_id))
+
+    async def _wait_for(self, bucket: TokenBucket):
+        while wait := bucket.try_acquire():
+            await asyncio.sleep(wait)
+
+    # returns the chat id the message ended up in (changes if the group got upgraded to a supergroup)
+    async def _send(self, chat_id: int, text: str) -> int:
+        for attempt in range(self.max_retries + 1):
+            await self._wait_for(self._bucket(chat_id))
+            await self._wait_for(self.global_bucket)
+            try:
+                with metrics.outbound("telegram", "send_message"):
+                    await self.bot.send_message(chat_id=chat_id, text=text)
+                SENT.inc(result="sent")
+                return chat_id
+            except RetryAfter as e:
+                SENT.inc(result="flood_wait")
+                logger.warning(f"flood wait for chat {chat_id}: retrying in {e.retry_after}s")
+                self._bucket(chat_id).pause(e.retry_after)
+            except ChatMigrated as e:
+                logger.info(f"chat {chat_id} migrated to {e.new_chat_id}, resending there")
+                chat_id = e.new_chat_id
+            except (Forbidden, BadRequest) as e:
+                # kicked from the chat, chat deleted, ...: retrying won't help
+                SENT.inc(result="dropped")
+                logger.error(f"dropping message to chat {chat_id}: {e}")
+                return chat_id
+            except NetworkError as e:
+                SENT.inc(result="network_error")
+                logger.warning(f"send to chat {chat_id} failed ({e}), attempt {attempt + 1}/{self.max_retries + 1}")
+                await asyncio.sleep(min(2 ** attempt, 30))
+        SENT.inc(result="dropped")
+        logger.error(f"giving up on message to chat {chat_id} after {self.max_retries + 1} attempts")
+        return chat_id
+
+    # waits until everything posted so far has been sent (or given up on); for shutdown and tests
+    async def flush(self):
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks.values()), return_exceptions=True)
@@ -0,0 +1,40 @@
+import logging
+from datetime import datetime
+from .txtracker import TxPending
+
+logger = logging.getLogger(__name__)
+
+
+# txns that were sent but not seen mined before the tracker gave up on them (TxPending). each one is journaled with
+# whatever its bookkeeping needs, and ApiV2.reconcile_pending finishes that once a receipt shows up, or undoes the
+# claim once the nonce is known to have gone to something else:
+#   {_id: <first hash>, owner, fn: "makeBet", nonce, hashes, sent_at, proposal_id, bet: {Bet fields minus id/hash}}
+#   {_id: <first hash>, owner, fn: "settleBet" | "settleBets", nonce, hashes, sent_at,
+#    bets: [{bet: {...}, over_wins, token: {...}, settle_price}]}
+#   {_id: <first hash>, owner, fn: "invalidateStaleBet", nonce, hashes, sent_at, bets: [{bet: {...}}]}
+# `owner` is the process that journaled it (replica + shard): its in-memory proposals and bet book are what the
+# bookkeeping touches, so only it reconciles them
+class PendingTxns:
+    def __init__(self, collection, owner: str):
+        self.collection = collection
+        self.owner = owner
+
+    def add(self, pending: TxPending, fn_name: str, **payload):
+        doc = {"_id": pending.hashes[0], "owner": self.owner, "fn": fn_name, "nonce": pending.nonce,
+               "hashes": pending.hashes, "sent_at": datetime.utcnow(), **payload}
+        self.collection.replace_one({"_id": doc["_id"]}, doc, upsert=True)
+        logger.warning(f"journaled unmined {fn_name} txn {doc['_id']} (nonce {pending.nonce})")
+
+    # oldest first, so reconciled bookkeeping happens in the order the txns were sent
+    def mine(self) -> list[dict]:
+        return list(self.collection.find({"owner": self.owner}).sort("sent_at", 1))
+
+    def resolve(self, doc_id: str):
+        self.collection.delete_one({"_id": doc_id})
+
+    # bet ids whose settlement or invalidation is waiting on a journaled txn; they stay out of the book until it's
+    # reconciled
+    def settling_ids(self) -> set[int]:
+        return {b["bet"]["id"] for doc in self.collection.find({"owner": self.owner, "bets": {"$exists": True}},
+                                                               {"bets.bet.id": 1})
+                for b in doc["bets"]}
@@ -0,0 +1,209 @@
+import os
+import json
+import logging
+import itertools
+import threading
+from datetime import datetime
+from pathlib import Path
+from .schema import BetProposal
+from .orderbook import OrderBook
+
+logger = logging.getLogger(__name__)
+
+
+# open bet proposals, indexed by id, chat and user, and persisted in an append-only journal so a restart or deploy
+# doesn't drop every open offer. one json record per line:
+#   {"op": "create", "p": {...}}             offered (or offered again after a failed accept)
+#   {"op": "claimed", "id": 3, "user": 42}   taken off the open list, makeBet about to be sent
+#   {"op": "accepted", "id": 3}              makeBet mined, the offer is now a bet
+#   {"op": "released", "id": 3}              makeBet reverted, back on the open list
+#   {"op": "expired" | "removed", "id": 3}   gone without becoming a bet
+# once the journal has grown to compact_every records (and mostly dead ones), it's rewritten with just the live
+# proposals. journal_path=None keeps everything in memory, like before.
+# open offers to anyone are also kept in an OrderBook, for /take
+class ProposalStore:
+    def __init__(self, journal_path: str | None = None, compact_every: int = 1000):
+        self.journal_path = Path(journal_path) if journal_path else None
+        self.compact_every = compact_every
+        self._lock = threading.RLock()
+        self._open = {}                 # id -> BetProposal, in offer order
+        self._claimed = {}              # id -> (BetProposal, claiming user id)
+        self._by_chat = {}              # chat id -> {proposal id: None}, dicts as insertion-ordered sets
+        self._by_user = {}              # user id -> {proposal id: None}, as creator or named counterparty
+        self.book = OrderBook()
+        self.version = 0                # bumped whenever the open list changes, see snapshot()
+        self._journal = None
+        self._records = 0               # records in the journal file
+
+    #### INDEXES ####
+    # these only touch memory; callers hold _lock
+
+    def _index(self, p: BetProposal):
+        self._open[p.id] = p
+        self.version += 1
+        self._by_chat.setdefault(p.chat_created_in, {})[p.id] = None
+        for user_id in {p.created_by, p.counterparty} - {None}:
+            self._by_user.setdefault(user_id, {})[p.id] = None
+        self.book.add(p)
+
+    def _unindex(self, proposal_id: int) -> BetProposal | None:
+        p = self._open.pop(proposal_id, None)
+        if p is None:
+            return None
+        self.version += 1
+        self.book.remove(p.id)
+        self._by_chat[p.chat_created_in].pop(p.id, None)
+        if not self._by_chat[p.chat_created_in]:
+            del self._by_chat[p.chat_created_in]
+        for user_id in {p.created_by, p.counterparty} - {None}:
+            self._by_user[user_id].pop(p.id, None)
+            if not self._by_user[user_id]:
+                del self._by_user[user_id]
+        return p
+
+    def _apply(self, record: dict):
+        match record["op"]:
+            case "create":
+                self._index(BetProposal.parse_obj(record["p"]))
+            case "claimed":
+                p = self._unindex(record["id"])
+                if p is not None:
+                    self._claimed[p.id] = (p, record["user"])
+            case "released":
+                claim = self._claimed.pop(record["id"], None)
+                if claim is not None:
+                    self._index(claim[0])
+            case "accepted" | "expired" | "removed":
+                self._claimed.pop(record["id"], None)
+                self._unindex(record["id"])
+
+    #### JOURNAL ####
+
+    def _append(self, record: dict):
+        self._apply(record)
+        if self.journal_path is None:
+            return
+        if self._journal is None:
+            self._journal = open(self.journal_path, "a", encoding="utf-8")
+        self._journal.write(json.dumps(record) + "\n")
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        self._records += 1
+        if self._records >= self.compact_every and self._records > 2 * (len(self._open) + len(self._claimed)):
+            self.compact()
+
+    @staticmethod
+    def _create_record(p: BetProposal) -> dict:
+        return {"op": "create", "p": json.loads(p.json())}
+
+    # rewrites the journal as one create (+ claimed) per live proposal; atomic, a crash leaves the old one
+    def compact(self):
+        if self.journal_path is None:
+            return
+        with self._lock:
+            records = [self._create_record(p) for p in self._open.values()]
+            for p, user_id in self._claimed.values():
+                records += [self._create_record(p), {"op": "claimed", "id": p.id, "user": user_id}]
+            tmp = self.journal_path.with_name(self.journal_path.name + ".tmp")
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.writelines(json.dumps(r) + "\n" for r in records)
+                f.flush()
+                os.fsync(f.fileno())
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+            os.replace(tmp, self.journal_path)
+            logger.info(f"compacted proposal journal from {self._records} to {len(records)} records")
+            self._records = len(records)
+
+    # one pass over the journal into the indexes. offers whose accept was in flight when the last process died
+    # are dropped: their makeBet may well have been mined, and reopening them could make the same bet twice
+    def load(self) -> int:
+        if self.journal_path is None or not self.journal_path.exists():
+            return 0
+        with self._lock, open(self.journal_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    self._apply(json.loads(line))
+                except ValueError:
+                    logger.warning(f"skipping unreadable proposal journal line: {line!r}")
+                self._records += 1
+            for proposal_id, (p, user_id) in list(self._claimed.items()):
+                logger.warning(f"dropping proposal {proposal_id}, user {user_id} was accepting it during shutdown")
+                self._claimed.pop(proposal_id)
+            for p in [p for p in self._open.values() if p.valid_till < datetime.now()]:
+                self._unindex(p.id)
+            self.compact()
+            logger.info(f"loaded {len(self._open)} open bet proposals from {self.journal_path}")
+            return len(self._open)
+
+    def close(self):
+        with self._lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+
+    #### API ####
+
+    # make(id) -> BetProposal, called with the lowest free id while holding the lock, so two can't share one
+    def create(self, make) -> BetProposal:
+        with self._lock:
+            _id = next(i for i in itertools.count() if i not in self._open and i not in self._claimed)
+            p = make(_id)
+            self._append(self._create_record(p))
+            return p
+
+    def get(self, proposal_id: int) -> BetProposal | None:
+        with self._lock:
+            return self._open.get(proposal_id)
+
+    def by_chat(self, chat_id: int) -> list[BetProposal]:
+        with self._lock:
+            return [self._open[i] for i in self._by_chat.get(chat_id, ())]
+
+    def by_user(self, user_id: int) -> list[BetProposal]:
+        with self._lock:
+            return [self._open[i] for i in self._by_user.get(user_id, ())]
+
+    # (version, every open proposal), consistent with each other: readers that derive something from the list can
+    # keep it until the version moves
+    def snapshot(self) -> tuple[int, list[BetProposal]]:
+        with self._lock:
+            return self.version, list(self._open.values())
+
+    # best open offers for a taker, see OrderBook.best
+    def matches(self, chat_id: int, token_id: int, taker_over: bool, expiry: int, limit_price: int,
+                taker_id: int | None = None, limit: int = 5) -> list[int]:
+        with self._lock:
+            return self.book.best(self._open, chat_id, token_id, taker_over, expiry, limit_price, taker_id, limit)
+
+    # takes an open proposal off the list for an accept; returns it, or None if it wasn't open
+    def claim(self, proposal_id: int, user_id: int) -> BetProposal | None:
+        with self._lock:
+            p = self._open.get(proposal_id)
+            if p is not None:
+                self._append({"op": "claimed", "id": proposal_id, "user": user_id})
+            return p
+
+    def accepted(self, proposal_id: int):
+        with self._lock:
+            self._append({"op": "accepted", "id": proposal_id})
+
+    # puts a claimed proposal back on the open list; returns it, or None if it wasn't claimed (load() drops claims)
+    def release(self, proposal_id: int) -> BetProposal | None:
+        with self._lock:
+            claim = self._claimed.get(proposal_id)
+            if claim is not None:
+                self._append({"op": "released", "id": proposal_id})
+            return claim[0] if claim is not None else None
+
+    # drops an open (or claimed) proposal; returns it, or None if there was nothing to drop
+    def remove(self, proposal_id: int, reason: str = "removed") -> BetProposal | None:
+        with self._lock:
+            p = self._open.get(proposal_id) or self._claimed.get(proposal_id, (None,))[0]
+            if p is not None:
+                self._append({"op": reason, "id": proposal_id})
+            return p
+
+    def __len__(self):
+        return len(self._open)
@@ -0,0 +1,227 @@
+import time
+import json
+import threading
+import logging
+import itertools
+import requests
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout, wait, FIRST_COMPLETED
+from web3.providers.base import JSONBaseProvider
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+ENDPOINT_LATENCY = metrics.REGISTRY.gauge("pvpbet_rpc_endpoint_latency_seconds", "ewma latency per rpc endpoint",
+                                          ("chain", "host"))
+ENDPOINT_HEALTHY = metrics.REGISTRY.gauge("pvpbet_rpc_endpoint_healthy", "1 if the endpoint is in rotation",
+                                          ("chain", "host"))
+HEDGED_REQUESTS = metrics.REGISTRY.counter("pvpbet_rpc_hedged_requests_total",
+                                           "reads that were duplicated to a second endpoint, by which one answered",
+                                           ("chain", "winner"))
+
+# things that change state, or whose answer has to agree with the node we send txns to (nonces)
+WRITE_METHODS = {"eth_sendRawTransaction", "eth_sendTransaction", "eth_getTransactionCount"}
+# pure reads that are safe to fire at two endpoints at once
+HEDGEABLE_METHODS = {"eth_blockNumber", "eth_call", "eth_chainId", "eth_getBalance", "eth_getBlockByNumber",
+                     "eth_gasPrice", "eth_maxPriorityFeePerGas", "eth_estimateGas"}
+
+
+# web3 hands us params that may still contain bytes/HexBytes/AttributeDicts
+def _json_default(o):
+    if isinstance(o, (bytes, bytearray)):
+        h = o.hex()
+        return h if h.startswith("0x") else "0x" + h
+    if hasattr(o, "keys"):
+        return dict(o)
+    raise TypeError(f"can't serialize {type(o)}")
+
+
+class RpcEndpointError(Exception):
+    pass
+
+
+class Endpoint:
+    def __init__(self, url: str, chain: str, writer: bool, alpha: float = 0.2):
+        self.url = url
+        self.chain = chain
+        self.host = urlparse(url).hostname or url   # never export the full url, it usually has an api key in it
+        self.writer = writer
+        self.alpha = alpha
+        self.latency = 0.1          # ewma, seconds; optimistic start so new endpoints get tried
+        self.error_rate = 0.0       # ewma of failures
+        self.consecutive_failures = 0
+        self.healthy = True
+        self.block_number = None
+        self.session = requests.Session()
+
+    def record(self, elapsed: float | None):
+        if elapsed is None:
+            self.error_rate = (1 - self.alpha) * self.error_rate + self.alpha
+            self.consecutive_failures += 1
+        else:
+            self.latency = (1 - self.alpha) * self.latency + self.alpha * elapsed
+            self.error_rate = (1 - self.alpha) * self.error_rate
+            self.consecutive_failures = 0
+        ENDPOINT_LATENCY.set(self.latency, chain=self.chain, host=self.host)
+
+    # lower is better; errors count for a lot more than a few ms
+    @property
+    def score(self) -> float:
+        return self.latency * (1 + 10 * self.error_rate)
+
+    def __repr__(self):
+        return f"Endpoint({self.chain}:{self.host}, {self.latency * 1000:.0f}ms, err={self.error_rate:.2f})"
+
+
+# a set of json-rpc endpoints for one chain. reads go to the fastest healthy endpoint (hedged to the second
+# fastest if the first is slow), writes go to the designated writers, and anything failing at the transport
+# level fails over to the next candidate
+class ProviderPool:
+    _ids = itertools.count()
+
+    def __init__(self, urls: list[str], chain: str, write_urls: list[str] | None = None, timeout: float = 10.0,
+                 hedge_after: float = 0.25, health_interval: float = 15.0, max_block_lag: int = 5,
+                 unhealthy_after: int = 3):
+        if not urls:
+            raise ValueError(f"no rpc urls configured for {chain}")
+        write_urls = write_urls or urls
+        self.chain = chain
+        self.endpoints = [Endpoint(u, chain, u in write_urls) for u in urls]
+        self.endpoints += [Endpoint(u, chain, True) for u in write_urls if u not in urls]
+        self.timeout = timeout
+        self.hedge_after = hedge_after
+        self.health_interval = health_interval
+        self.max_block_lag = max_block_lag
+        self.unhealthy_after = unhealthy_after
+        self._executor = ThreadPoolExecutor(max_workers=4 * len(self.endpoints), thread_name_prefix=f"rpc-{chain}")
+        self._health_thread = None
+        for e in self.endpoints:
+            ENDPOINT_HEALTHY.set(1, chain=chain, host=e.host)
+
+    #### ROUTING ####
+    def _candidates(self, writers_only: bool = False) -> list[Endpoint]:
+        pool = [e for e in self.endpoints if e.writer] if writers_only else self.endpoints
+        healthy = [e for e in pool if e.healthy]
+        # if everything looks dead, try everything rather than nothing
+        return sorted(healthy or pool, key=lambda e: e.score)
+
+    def _post(self, endpoint: Endpoint, payload):
+        start = time.perf_counter()
+        try:
+            response = endpoint.session.post(endpoint.url, data=json.dumps(payload, default=_json_default),
+                                             headers={"Content-Type": "application/json"}, timeout=self.timeout)
+            if response.status_code == 429 or response.status_code >= 500:
+                raise RpcEndpointError(f"{endpoint} returned http {response.status_code}")
+            result = response.json()
+        except (requests.RequestException, ValueError, RpcEndpointError) as e:
+            endpoint.record(None)
+            if endpoint.consecutive_failures >= self.unhealthy_after and endpoint.healthy:
+                logger.warning(f"taking {endpoint} out of rotation after {endpoint.consecutive_failures} failures")
+                self._set_healthy(endpoint, False)
+            raise RpcEndpointError(f"{endpoint}: {e}") from e
+        endpoint.record(time.perf_counter() - start)
+        return result
+
+    def _failover(self, payload, candidates: list[Endpoint]):
+        last_error = None
+        for endpoint in candidates:
+            try:
+                return self._post(endpoint, payload)
+            except RpcEndpointError as e:
+                logger.debug(f"rpc failover: {e}")
+                last_error = e
+        raise last_error
+
+    def _hedged(self, payload, candidates: list[Endpoint]):
+        primary = candidates[0]
+        first = self._executor.submit(self._post, primary, payload)
+        # hedge once the primary is clearly slower than it usually is
+        try:
+            return first.result(timeout=max(self.hedge_after, 2 * primary.latency))
+        except FutureTimeout:
+            pass
+        except RpcEndpointError:
+            return self._failover(payload, candidates[1:]) if len(candidates) > 1 else first.result()
+        if len(candidates) < 2:
+            return first.result()
+
+        second = self._executor.submit(self._post, candidates[1], payload)
+        pending = {first: primary, second: candidates[1]}
+        while pending:
+            done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+            for fut in done:
+                endpoint = pending.pop(fut)
+                if fut.exception() is None:
+                    HEDGED_REQUESTS.inc(chain=self.chain, winner="primary" if endpoint is primary else "hedge")
+                    return fut.result()
+        # both failed, give the rest a go
+        return self._failover(payload, candidates[2:]) if len(candidates) > 2 else first.result()
+
+    # sends a json-rpc payload (single request dict, or a batch list) and returns the decoded response
+    def request_raw(self, payload, method: str | None = None):
+        if method in WRITE_METHODS:
+            return self._failover(payload, self._candidates(writers_only=True))
+        candidates = self._candidates()
+        if method in HEDGEABLE_METHODS:
+            return self._hedged(payload, candidates)
+        return self._failover(payload, candidates)
+
+    def request(self, method: str, params) -> dict:
+        payload = {"jsonrpc": "2.0", "method": method, "params": params, "id": next(self._ids)}
+        return self.request_raw(payload, method)
+
+    #### HEALTH ####
+    def _set_healthy(self, endpoint: Endpoint, healthy: bool):
+        endpoint.healthy = healthy
+        ENDPOINT_HEALTHY.set(1 if healthy else 0, chain=self.chain, host=endpoint.host)
+
+    # probes every endpoint with eth_blockNumber; dead or lagging endpoints leave the rotation until they recover
+    def health_check(self):
+        payload = {"jsonrpc": "2.0", "method": "eth_blockNumber", "params": [], "id": 0}
+        futures = {self._executor.submit(self._post, e, payload): e for e in self.endpoints}
+        for fut, endpoint in futures.items():
+            try:
+                endpoint.block_number = int(fut.result().get("result"), 16)
+            except (RpcEndpointError, TypeError, ValueError, AttributeError):
+                endpoint.block_number = None
+        head = max((e.block_number for e in self.endpoints if e.block_number is not None), default=None)
+        for endpoint in self.endpoints:
+            ok = endpoint.block_number is not None and head - endpoint.block_number <= self.max_block_lag
+            if ok != endpoint.healthy:
+                logger.warning(f"{endpoint} is now {'healthy' if ok else 'unhealthy'} "
+                               f"(block {endpoint.block_number}, head {head})")
+            self._set_healthy(endpoint, ok)
+        return head
+
+    def start_health_checks(self):
+        if self._health_thread is not None or len(self.endpoints) < 2:
+            return
+
+        def _loop():
+            while True:
+                time.sleep(self.health_interval)
+                try:
+                    self.health_check()
+                except Exception:
+                    logger.exception(f"{self.chain} rpc health check failed")
+
+        self._health_thread = threading.Thread(target=_loop, name=f"rpc-health-{self.chain}", daemon=True)
+        self._health_thread.start()
+
+
+# lets web3 use a ProviderPool as if it were a single HTTPProvider
+class PooledProvider(JSONBaseProvider):
+    def __init__(self, pool: ProviderPool):
+        super().__init__()
+        self.pool = pool
+
+    def make_request(self, method, params):
+        return self.pool.request(method, params)
+
+    def is_connected(self, show_traceback: bool = False) -> bool:
+        try:
+            return self.pool.request("web3_clientVersion", []).get("result") is not None
+        except RpcEndpointError:
+            if show_traceback:
+                raise
+            return False
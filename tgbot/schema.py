@@ -72,3 +72,34 @@ class SettleBetResponse(BaseModel):
     error_msg: str | None
     success_msg: str | None = None
     tx_hash: str | None = None
+    over_wins: bool | None = None       # only set when this call is the one that settled it
+    settle_price: float | None = None   # in $
+    pending: bool = False               # the txn went out but wasn't seen mined, see ApiV2.reconcile_pending
+
+
+# what's left of a bet once it's settled, kept in the settled_bets archive
+class SettledBet(BaseModel):
+    bet: Bet
+    over_wins: bool
+    settle_price: float                 # in $
+    tx_hash: str
+    rake: str                           # in WEI, what the contract kept
+    settled_at: datetime
+
+    @property
+    def winner_id(self) -> int:
+        return self.bet.over_user_id if self.over_wins else self.bet.under_user_id
+
+    @property
+    def loser_id(self) -> int:
+        return self.bet.under_user_id if self.over_wins else self.bet.over_user_id
+
+
+# and a third one
+class InvalidateBetResponse(BaseModel):
+    success: bool
+    bet: Bet
+    error_msg: str | None = None
+    success_msg: str | None = None
+    tx_hash: str | None = None
+    pending: bool = False               # the txn went out but wasn't seen mined, see ApiV2.reconcile_pending
@@ -0,0 +1,119 @@
+import os
+import zlib
+import hmac
+import asyncio
+import logging
+from pathlib import Path
+from aiohttp import web, ClientSession, ClientTimeout, ClientError
+from dotenv import load_dotenv
+from telegram import Bot, Update
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+ROUTED = metrics.REGISTRY.counter("pvpbet_router_updates_total", "updates forwarded by the router, by shard and status",
+                                  ("shard", "status"))
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+# every update type that happens in a chat; anything else (inline queries, ...) is routed by the sender
+_CHAT_KEYS = ("message", "edited_message", "channel_post", "edited_channel_post", "my_chat_member", "chat_member",
+              "chat_join_request")
+
+
+# which worker owns a chat. crc32 rather than hash() so every process (and every restart) agrees
+def shard_of(chat_id: int, count: int) -> int:
+    return zlib.crc32(str(chat_id).encode()) % count
+
+
+class Shard:
+    def __init__(self, index: int, count: int):
+        if not 0 <= index < count:
+            raise ValueError(f"shard index {index} out of range for {count} shards")
+        self.index = index
+        self.count = count
+
+    def owns(self, chat_id: int | None) -> bool:
+        # updates with no chat are handled by shard 0
+        return shard_of(chat_id, self.count) == self.index if chat_id is not None else self.index == 0
+
+    def __repr__(self):
+        return f"Shard({self.index}/{self.count})"
+
+
+# chat id for a raw update dict, without paying for Update.de_json on the router's hot path
+def chat_id_of(update: dict) -> int | None:
+    for key in _CHAT_KEYS:
+        if key in update:
+            return update[key].get("chat", {}).get("id")
+    if "callback_query" in update:
+        message = update["callback_query"].get("message")
+        if message is not None:
+            return message.get("chat", {}).get("id")
+        return update["callback_query"].get("from", {}).get("id")
+    for value in update.values():
+        if isinstance(value, dict) and "from" in value:
+            return value["from"].get("id")
+    return None
+
+
+# the public webhook: reads just enough of each update to pick the owning worker and forwards it verbatim.
+# the worker's own receiver (webhook.make_app with a Shard) checks the secret again and rejects misrouted chats
+def make_router(worker_urls: list[str], path: str, secret: str | None = None, timeout: float = 10.0) -> web.Application:
+    app = web.Application()
+
+    async def _session(_app):
+        _app["session"] = ClientSession(timeout=ClientTimeout(total=timeout))
+        yield
+        await _app["session"].close()
+
+    async def route(request: web.Request) -> web.Response:
+        if secret and not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), secret):
+            return web.Response(status=403)
+        body = await request.read()
+        try:
+            update = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        chat_id = chat_id_of(update)
+        shard = shard_of(chat_id, len(worker_urls)) if chat_id is not None else 0
+        headers = {"Content-Type": "application/json"}
+        if secret:
+            headers[SECRET_HEADER] = secret
+        try:
+            async with request.app["session"].post(worker_urls[shard], data=body, headers=headers) as response:
+                ROUTED.inc(shard=str(shard), status=str(response.status))
+                # pass the worker's answer through: a 503 (worker overloaded) makes telegram retry later
+                return web.Response(status=response.status)
+        except (ClientError, asyncio.TimeoutError) as e:
+            ROUTED.inc(shard=str(shard), status="unreachable")
+            logger.error(f"shard {shard} ({worker_urls[shard]}) unreachable: {e}")
+            return web.Response(status=502)
+
+    app.cleanup_ctx.append(_session)
+    app.router.add_post(path, route)
+    return app
+
+
+async def _register(token: str, webhook_url: str, secret: str | None):
+    async with Bot(token) as bot:
+        await bot.set_webhook(webhook_url, secret_token=secret, allowed_updates=Update.ALL_TYPES)
+    logger.info(f"webhook registered at {webhook_url}")
+
+
+# runs the router in front of BOT_SHARDS workers (see main.py); SHARD_URLS[i] is worker i's webhook receiver
+if __name__ == '__main__':
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    load_dotenv(dotenv_path=Path(base_dir).parent / '.env')
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    SHARD_URLS = [u.strip() for u in os.getenv("SHARD_URLS").split(",") if u.strip()]
+    WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+    if os.getenv("WEBHOOK_URL"):
+        asyncio.run(_register(os.getenv("TG_TOKEN"), os.getenv("WEBHOOK_URL"), WEBHOOK_SECRET))
+
+    ROUTER_METRICS_PORT = int(os.getenv("ROUTER_METRICS_PORT", "9466"))
+    if ROUTER_METRICS_PORT > 0:
+        metrics.start_http_server(ROUTER_METRICS_PORT)
+    web.run_app(make_router(SHARD_URLS, os.getenv("WEBHOOK_PATH", "/telegram"), WEBHOOK_SECRET),
+                host=os.getenv("ROUTER_LISTEN", "127.0.0.1"), port=int(os.getenv("ROUTER_PORT", "8443")),
+                access_log=None)
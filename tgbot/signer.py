@@ -0,0 +1,250 @@
+import os
+import hmac
+import json
+import socket
+import threading
+import logging
+import socketserver
+from pathlib import Path
+from dotenv import load_dotenv
+from web3 import Web3
+from web3.exceptions import TimeExhausted, TransactionNotFound
+from . import metrics, abigen
+from .fees import FeeOracle
+from .txtracker import TxTracker, TxPending
+from .rpc_pool import ProviderPool, PooledProvider, _json_default
+from .lease import LeaseLost
+
+logger = logging.getLogger(__name__)
+
+# the bookie key lives in exactly one process. bot workers hand it unsigned txns over a local socket and get back
+# the hash of whichever version got mined, so nonces are assigned (and stuck txns bumped) in a single place no
+# matter how many workers there are.
+#
+# protocol: one json object per line, request/response, any number of requests per connection
+#   {"op": "address"}                                  -> {"ok": true, "result": "0x..."}
+#   {"op": "send", "txn": {...}, "fn": "makeBet"}      -> {"ok": true, "result": "0x<tx hash>"}
+#   {"op": "send_many", "txns": [...], "fn": "..."}    -> {"ok": true, "result": [<entry>, ...]}
+#     one entry per txn: "0x<tx hash>", null if it was never sent, {"pending": "<msg>", "nonce": 7, "hashes": [...]}
+#     if it wasn't seen mined
+#   failures                                           -> {"ok": false, "error": "<exception type>", "msg": "..."}
+#   a txn not mined in time                            -> {..., "error": "TxPending", "nonce": 7, "hashes": [...]}
+# sends may carry "fence": [lease name, fencing token]; anything older than the newest token seen for that lease
+# is refused, so a settlement leader that lost its lease (gc pause, partition, ...) can't get txns signed.
+# with a shared secret (SIGNER_TOKEN) every request has to carry it as "token"; a tcp signer won't start without
+# one, since anything on the host can connect to it (the unix socket is 0600)
+
+# the only bookie calls the signer will sign
+SIGNABLE_FNS = ("makeBet", "settleBet", "settleBets", "invalidateStaleBet")
+
+
+# "unix:/run/pvpbet/signer.sock" or "tcp:127.0.0.1:7545"
+def _parse_addr(addr: str):
+    kind, _, rest = addr.partition(":")
+    if kind == "unix":
+        return socket.AF_UNIX, rest
+    if kind == "tcp":
+        host, _, port = rest.rpartition(":")
+        if host not in ("127.0.0.1", "localhost", "::1"):
+            raise ValueError(f"refusing to expose the signer on non-local address {host}")
+        return socket.AF_INET, (host, int(port))
+    raise ValueError(f"invalid signer address {addr}, expected unix:<path> or tcp:<host>:<port>")
+
+
+class SigningService:
+    def __init__(self, w3, account, contract_addr: str, tracker: TxTracker, bindings=None, token: str | None = None):
+        self.w3 = w3
+        self.account = account
+        self.contract_addr = Web3.to_checksum_address(contract_addr)
+        self.tracker = tracker
+        self.token = token
+        bindings = bindings or abigen.load()
+        self.selectors = {bindings.SELECTORS[fn]: fn for fn in SIGNABLE_FNS}
+        self._fences = {}               # lease name -> highest fencing token seen
+        self._fences_lock = threading.Lock()
+
+    def _check_fence(self, fence):
+        if fence is None:
+            return
+        name, token = fence
+        with self._fences_lock:
+            newest = self._fences.get(name, token)
+            if token < newest:
+                raise LeaseLost(f"stale fencing token {token} for {name} (newest is {newest})")
+            self._fences[name] = token
+
+    # the signer only ever signs the bookie's own calls into the bookie, from the bookie account; anything else is
+    # a bug or worse
+    def _check(self, txn: dict) -> dict:
+        if Web3.to_checksum_address(txn.get("to", "0x" + "0" * 40)) != self.contract_addr:
+            raise PermissionError(f"refusing to sign txn to {txn.get('to')}, only {self.contract_addr} is allowed")
+        if "from" in txn and Web3.to_checksum_address(txn["from"]) != self.account.address:
+            raise PermissionError(f"txn is from {txn['from']}, not the signing account")
+        _selector = str(txn.get("data", ""))[:10].lower()
+        if _selector not in self.selectors:
+            raise PermissionError(f"refusing to sign calldata with selector {_selector!r}, only "
+                                  f"{', '.join(SIGNABLE_FNS)} are allowed")
+        return txn
+
+    def _check_token(self, request: dict):
+        if self.token is not None and not hmac.compare_digest(str(request.get("token", "")), self.token):
+            raise PermissionError("missing or wrong signer token")
+
+    def handle(self, request: dict):
+        self._check_token(request)
+        match request.get("op"):
+            case "address":
+                return self.account.address
+            case "send":
+                self._check_fence(request.get("fence"))
+                receipt = self.tracker.send(self._check(request["txn"]), request.get("fn", "unknown"))
+                return receipt.get("transactionHash").hex()
+            case "send_many":
+                self._check_fence(request.get("fence"))
+                txns = [self._check(txn) for txn in request["txns"]]
+                return [self._send_many_entry(r) for r in self.tracker.send_many(txns, request.get("fn", "unknown"))]
+            case op:
+                raise ValueError(f"unknown op {op}")
+
+    @staticmethod
+    def _send_many_entry(outcome):
+        if outcome is None:
+            return None
+        if isinstance(outcome, TxPending):
+            return {"pending": str(outcome), "nonce": outcome.nonce, "hashes": outcome.hashes}
+        return outcome.get("transactionHash").hex()
+
+    def _handler(self):
+        service = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    try:
+                        response = {"ok": True, "result": service.handle(json.loads(line))}
+                    except Exception as e:
+                        logger.warning(f"signer request failed: {type(e).__name__}: {e}")
+                        response = {"ok": False, "error": type(e).__name__, "msg": str(e)}
+                        if isinstance(e, TxPending):
+                            response.update(nonce=e.nonce, hashes=e.hashes)
+                    self.wfile.write((json.dumps(response, default=_json_default) + "\n").encode("utf-8"))
+                    self.wfile.flush()
+
+        return Handler
+
+    # one thread per connection: a send blocks until its txn is mined, and others shouldn't queue behind it
+    def serve_forever(self, addr: str):
+        family, address = _parse_addr(addr)
+        if family != socket.AF_UNIX and self.token is None:
+            raise ValueError("a tcp signer needs a shared secret (SIGNER_TOKEN), or use a unix: address")
+        if family == socket.AF_UNIX:
+            Path(address).unlink(missing_ok=True)
+            server = socketserver.ThreadingUnixStreamServer(address, self._handler())
+            os.chmod(address, 0o600)
+        else:
+            server = socketserver.ThreadingTCPServer(address, self._handler())
+        server.daemon_threads = True
+        logger.info(f"signing service for {self.account.address} listening on {addr}")
+        server.serve_forever()
+
+
+class SignerError(Exception):
+    pass
+
+
+# what ApiV2 uses instead of a local account + TxTracker when SIGNER_ADDR is set. duck-types both: `.address`
+# for building txns, send()/send_many() returning receipts (fetched from our own rpc once the signer says mined)
+class SignerClient:
+    def __init__(self, addr: str, w3, timeout: float = 900.0, token: str | None = None,
+                 receipt_timeout: float = 120.0):
+        self.addr = addr
+        self.w3 = w3
+        self.timeout = timeout          # longer than TxTracker's own deadline, so that one fires first
+        self.token = token
+        self.receipt_timeout = receipt_timeout
+        self.address = self._call({"op": "address"})
+
+    def _call(self, request: dict):
+        family, address = _parse_addr(self.addr)
+        with metrics.outbound("signer", request["op"]), socket.socket(family, socket.SOCK_STREAM) as sock:
+            sock.settimeout(self.timeout)
+            sock.connect(address)
+            if self.token is not None:
+                request = {**request, "token": self.token}
+            with sock.makefile("rwb") as f:
+                f.write((json.dumps(request, default=_json_default) + "\n").encode("utf-8"))
+                f.flush()
+                line = f.readline()
+        if not line:
+            raise SignerError("signing service closed the connection")
+        response = json.loads(line)
+        if response["ok"]:
+            return response["result"]
+        # keep the exception types callers already handle for local sends
+        if response["error"] == "TxPending":
+            raise TxPending(response["msg"], response["nonce"], response["hashes"])
+        if response["error"] == "TimeExhausted":
+            raise TimeExhausted(response["msg"])
+        if response["error"] == "ValueError":
+            raise ValueError(response["msg"])
+        if response["error"] == "LeaseLost":
+            raise LeaseLost(response["msg"])
+        raise SignerError(f"{response['error']}: {response['msg']}")
+
+    def _receipt(self, tx_hash: str | None):
+        if tx_hash is None:
+            return None
+        # our rpc may be a block behind the signer's. if it's further behind than that, the txn is mined all the same:
+        # callers get its hash (see TxPending) and pick the receipt up later
+        try:
+            return self.w3.eth.wait_for_transaction_receipt(tx_hash, timeout=self.receipt_timeout)
+        except TimeExhausted:
+            try:
+                _nonce = self.w3.eth.get_transaction(tx_hash)["nonce"]
+            except TransactionNotFound:
+                _nonce = None
+            raise TxPending(f"signer says {tx_hash} is mined, our rpc has no receipt after {self.receipt_timeout}s",
+                            _nonce, [tx_hash])
+
+    # fence: (lease name, fencing token) for txns only the lease holder may send
+    def send(self, txn: dict, fn_name: str = "unknown", fence: tuple[str, int] | None = None):
+        return self._receipt(self._call({"op": "send", "txn": txn, "fn": fn_name, "fence": fence}))
+
+    # same per-txn outcomes as TxTracker.send_many: receipt, None or TxPending
+    def send_many(self, txns: list[dict], fn_name: str = "unknown", fence: tuple[str, int] | None = None) -> list:
+        if not txns:
+            return []
+        return [self._outcome(entry) for entry in self._call({"op": "send_many", "txns": txns, "fn": fn_name,
+                                                              "fence": fence})]
+
+    def _outcome(self, entry):
+        if isinstance(entry, dict):
+            return TxPending(entry["pending"], entry["nonce"], entry["hashes"])
+        try:
+            return self._receipt(entry)
+        except TxPending as e:
+            return e
+
+
+if __name__ == '__main__':
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    load_dotenv(dotenv_path=Path(base_dir).parent / '.env')
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    _rpc_urls = [u.strip() for u in os.getenv("RPC_URL").split(",") if u.strip()]
+    _write_urls = [u.strip() for u in os.getenv("RPC_WRITE_URLS", "").split(",") if u.strip()] or None
+    pool = ProviderPool(_rpc_urls, "l2", write_urls=_write_urls)
+    w3 = Web3(PooledProvider(pool))
+    w3.middleware_onion.add(metrics.web3_metrics_middleware, "metrics")
+    if not w3.is_connected():
+        raise ConnectionError("Failed to connect to web3 provider.")
+    pool.start_health_checks()
+
+    account = w3.eth.account.from_key(os.getenv("PRIVATE_KEY"))
+    service = SigningService(w3, account, os.getenv("CONTRACT_ADDR"), TxTracker(w3, account, FeeOracle(w3)),
+                             token=os.getenv("SIGNER_TOKEN"))
+
+    SIGNER_METRICS_PORT = int(os.getenv("SIGNER_METRICS_PORT", "9465"))
+    if SIGNER_METRICS_PORT > 0:
+        metrics.start_http_server(SIGNER_METRICS_PORT)
+    service.serve_forever(os.getenv("SIGNER_ADDR", "unix:/tmp/pvpbet-signer.sock"))
@@ -0,0 +1,130 @@
+import logging
+from bson import ObjectId
+from bson.decimal128 import Decimal128
+from pymongo import InsertOne, UpdateOne, DESCENDING
+from pymongo.errors import BulkWriteError
+from .schema import SettledBet
+
+logger = logging.getLogger(__name__)
+
+_ZERO = Decimal128("0")
+
+
+# wei amounts add up past int64, so the aggregates keep them as decimal128
+def _d(wei: int) -> Decimal128:
+    return Decimal128(str(wei))
+
+
+def to_int(value) -> int:
+    if isinstance(value, Decimal128):
+        return int(value.to_decimal())
+    return int(value or 0)
+
+
+def _add(field: str, amount):
+    return {"$add": [{"$ifNull": [f"${field}", _ZERO if isinstance(amount, Decimal128) else 0]}, amount]}
+
+
+# one pipeline update per (bet, participant): counters and wei totals go up, the streak either extends or flips.
+# streak > 0 is a run of wins, < 0 a run of losses
+def _outcome_update(won: bool, amount: int, pnl: int, extra: dict) -> list[dict]:
+    _streak = {"$ifNull": ["$streak", 0]}
+    return [
+        {"$set": {
+            **extra,
+            "wins": _add("wins", int(won)),
+            "losses": _add("losses", int(not won)),
+            "volume": _add("volume", _d(amount)),
+            "net_pnl": _add("net_pnl", _d(pnl)),
+            "streak": {"$add": [{"$max": [_streak, 0]}, 1]} if won else {"$subtract": [{"$min": [_streak, 0]}, 1]},
+        }},
+        {"$set": {
+            "best_streak": {"$max": [{"$ifNull": ["$best_streak", 0]}, "$streak"]},
+            "worst_streak": {"$min": [{"$ifNull": ["$worst_streak", 0]}, "$streak"]},
+        }},
+    ]
+
+
+# the settled bet archive plus aggregates kept up to date as bets settle, so /stats and /leaderboard are single
+# indexed reads instead of scans over history:
+#   settled_bets      one document per settled bet (SettledBet), unique on bet id
+#   user_stats        _id: user id -> wins, losses, volume, net_pnl, streak, best/worst_streak
+#   chat_user_stats   _id: "<chat>:<user>", the same per user within one chat (leaderboards)
+#   chat_stats        _id: chat id -> bets, volume, rake
+# each archived bet carries a `counted` field: false when archived, then claimed (set to a token unique to one
+# record() call) before any aggregate is touched, then true once the aggregates include it. only the bets a call
+# claimed get counted, so recording the same settlement twice (a retried round, a takeover, two at once) counts it
+# at most once, and a round that died between archiving and claiming gets counted by the next attempt. one that
+# died between claiming and finishing stays claimed and isn't retried: a bet missing from the stats beats one
+# counted twice
+class StatsBook:
+    def __init__(self, db):
+        self.settled_bets = db.settled_bets
+        self.user_stats = db.user_stats
+        self.chat_user_stats = db.chat_user_stats
+        self.chat_stats = db.chat_stats
+
+    # returns how many of `settled` this call counted
+    def record(self, settled: list[SettledBet]) -> int:
+        if not settled:
+            return 0
+        docs = [{**s.dict(exclude={"bet"}), **s.bet.dict(), "counted": False} for s in settled]
+        try:
+            self.settled_bets.bulk_write([InsertOne(doc) for doc in docs], ordered=False)
+        except BulkWriteError as e:
+            _dupes = {err["index"] for err in e.details.get("writeErrors", []) if err.get("code") == 11000}
+            _others = [err for err in e.details.get("writeErrors", []) if err.get("code") != 11000]
+            if _others:
+                raise
+            logger.info(f"{len(_dupes)} settled bets were already archived")
+
+        _ids = [s.bet.id for s in settled]
+        _claim = ObjectId()
+        self.settled_bets.update_many({"id": {"$in": _ids}, "counted": False}, {"$set": {"counted": _claim}})
+        _claimed = {doc["id"] for doc in self.settled_bets.find({"id": {"$in": _ids}, "counted": _claim}, {"id": 1})}
+        new = [s for s in settled if s.bet.id in _claimed]
+        if len(new) < len(settled):
+            logger.info(f"{len(settled) - len(new)} settled bets were already counted (or are being counted)")
+        if not new:
+            return 0
+
+        user_ops, chat_user_ops, chat_totals = [], [], {}
+        for s in new:
+            amount = int(s.bet.amount)
+            rake = int(s.rake)
+            chat_id = s.bet.chat_created_in
+            for user_id, won in ((s.winner_id, True), (s.loser_id, False)):
+                pnl = amount - rake if won else -amount
+                user_ops.append(UpdateOne({"_id": user_id}, _outcome_update(won, amount, pnl, {}), upsert=True))
+                chat_user_ops.append(UpdateOne({"_id": f"{chat_id}:{user_id}"},
+                                               _outcome_update(won, amount, pnl, {"chat_id": chat_id,
+                                                                                  "user_id": user_id}),
+                                               upsert=True))
+            _bets, _volume, _rake = chat_totals.get(chat_id, (0, 0, 0))
+            chat_totals[chat_id] = (_bets + 1, _volume + 2 * amount, _rake + rake)
+
+        # ordered, so a user's streak sees their bets in settlement order
+        self.user_stats.bulk_write(user_ops, ordered=True)
+        self.chat_user_stats.bulk_write(chat_user_ops, ordered=True)
+        self.chat_stats.bulk_write([UpdateOne({"_id": chat_id},
+                                              {"$inc": {"bets": n, "volume": _d(volume), "rake": _d(rake)}},
+                                              upsert=True)
+                                    for chat_id, (n, volume, rake) in chat_totals.items()], ordered=False)
+        self.settled_bets.update_many({"id": {"$in": _ids}, "counted": _claim}, {"$set": {"counted": True}})
+        return len(new)
+
+    def get_user_stats(self, user_id: int, chat_id: int | None = None) -> dict | None:
+        if chat_id is None:
+            return self.user_stats.find_one({"_id": user_id})
+        return self.chat_user_stats.find_one({"_id": f"{chat_id}:{user_id}"})
+
+    def get_chat_stats(self, chat_id: int) -> dict | None:
+        return self.chat_stats.find_one({"_id": chat_id})
+
+    # top users by net pnl, in one chat or overall
+    def leaderboard(self, chat_id: int | None = None, limit: int = 10) -> list[dict]:
+        if chat_id is None:
+            cursor = self.user_stats.find({}).sort("net_pnl", DESCENDING)
+        else:
+            cursor = self.chat_user_stats.find({"chat_id": chat_id}).sort("net_pnl", DESCENDING)
+        return list(cursor.limit(limit))
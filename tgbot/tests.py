@@ -1,10 +1,34 @@
 import web3.testing
 
 from .apiv2 import ApiV2
-from .schema import User, Bet, Token
+from .schema import User, Bet, Token, SettledBet, BetProposal
+from .indexes import uses_index, winning_plan_stages, ensure_indexes, USERNAME_COLLATION
 import requests
 import json
 import os
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+from telegram import Bot
+from telegram.ext import ApplicationBuilder, CommandHandler
+from . import webhook, metrics
+from .fake_telegram import FakeTelegram
+from .outbox import Outbox, digest, MAX_MESSAGE_LEN
+from .signer import SigningService, SignerClient, SignerError
+from .txtracker import TxPending
+from .shards import Shard, shard_of
+from .lease import Lease, LeaseLost
+from .journal import WriteBehind
+from .proposals import ProposalStore
+from .stats import StatsBook, to_int
+from .views import BetsViewCache
+from .http_api import make_app
+from .rpc_pool import ProviderPool, HEDGED_REQUESTS
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from fastapi.testclient import TestClient
+from .schema import BetList
+import threading
+import time
+from datetime import datetime, timedelta
 from pathlib import Path
 from dotenv import load_dotenv
 
@@ -117,6 +141,136 @@ def test_accept_bets():
                                  chat_id=bet_request.chat_created_in, bet_id=bet_request.id))
 
 
+def test_concurrent_accepts():
+    print("======== TESTING CONCURRENT ACCEPTS =========")
+    # an open offer in a throwaway chat, accepted twice at the same time: exactly one accept may go through
+    _req = api.request_bet(3, alice.id, True, "10m", "$10", "15m", 420.69, api.get_token_by_id(1)).bet_proposal
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        results = list(pool.map(lambda _: api.accept_bet(caller_id=bob.id, chat_id=3, bet_id=_req.id), range(2)))
+    print(results)
+    assert sum(r.success for r in results) <= 1
+    assert api.get_bet_proposal_by_id(_req.id) is None or not any(r.success for r in results)
+    # the shared proposal object must not have been claimed by whoever accepted it
+    assert _req.counterparty is None
+
+
+# sends the txn for real and waits for it, then reports it as unmined like TxTracker does when it gives up
+def _mined_late(txn, account, fn_name="unknown", fence=None):
+    receipt = ApiV2.transact(api, txn, account, fn_name, fence)
+    _hash = receipt.get("transactionHash").hex()
+    raise TxPending(f"{fn_name} not mined", api.w3.eth.get_transaction(_hash)["nonce"], [_hash])
+
+
+def test_accept_checks_creator_funds():
+    print("======== TESTING ACCEPT WITH AN UNDERFUNDED CREATOR =========")
+    # alice's funds are gone by the time bob accepts: turned away before any makeBet, and the offer stays open
+    _req = api.request_bet(5, alice.id, True, "10m", "$10", "15m", 420.69, api.get_token_by_id(1)).bet_proposal
+    _sent = []
+    api.get_user_balance_by_id = lambda user_id: (0, 0) if user_id == alice.id \
+        else ApiV2.get_user_balance_by_id(api, user_id)
+    api.transact = lambda *args, **kwargs: _sent.append(args)
+    try:
+        resp = api.accept_bet(caller_id=bob.id, chat_id=5, bet_id=_req.id)
+    finally:
+        for patched in ("get_user_balance_by_id", "transact"):
+            api.__dict__.pop(patched, None)
+    print(resp)
+    assert not resp.success and "creator" in resp.error_msg
+    assert _sent == []
+    assert api.get_bet_proposal_by_id(_req.id) is not None
+    api.rm_bet_request(_req.id)
+
+
+def test_unmined_accept_reconciles():
+    print("======== TESTING UNMINED ACCEPT RECONCILIATION =========")
+    # a makeBet the tracker gave up on: the offer stays claimed, and the bet reaches the book once reconciled
+    _req = api.request_bet(4, alice.id, True, "10m", "$10", "15m", 420.69, api.get_token_by_id(1)).bet_proposal
+    api.transact = _mined_late
+    try:
+        resp = api.accept_bet(caller_id=bob.id, chat_id=4, bet_id=_req.id)
+    finally:
+        api.__dict__.pop("transact", None)
+    print(resp)
+    assert not resp.success and resp.tx_hash is not None
+    assert api.get_bet_proposal_by_id(_req.id) is None
+    assert api.get_bets_by_chat_id(4).active == []
+
+    messages = api.reconcile_pending()
+    print(messages)
+    assert [chat_id for chat_id, _ in messages] == [4]
+    assert [b.creation_hash for b in api.get_bets_by_chat_id(4).active] == [resp.tx_hash]
+    assert api.reconcile_pending() == []
+
+
+def test_unmined_settlement_reconciles():
+    print("======== TESTING UNMINED SETTLEMENT RECONCILIATION =========")
+    # a settleBets the tracker gave up on: the bet is neither re-queued nor dropped until reconcile sees the receipt
+    btc = Token(id=1, symbol="BTC", name="bitcoin", rank=1)
+    bet = api.bet_cache.pop_due(api.get_l1_block_number())
+    assert bet is not None
+    api._price_bet = lambda _bet: (True, btc, 80_000.0)
+    api.transact = _mined_late
+    try:
+        [resp] = api.settle_bets_batch([bet])
+    finally:
+        for patched in ("_price_bet", "transact"):
+            api.__dict__.pop(patched, None)
+    assert resp.pending and not resp.success
+    assert bet.id in api._unconfirmed and not api.bet_cache.has(bet.id)
+
+    messages = api.reconcile_pending()
+    print(messages)
+    assert [chat_id for chat_id, _ in messages] == [bet.chat_created_in]
+    assert bet.id not in api._unconfirmed and not api.bet_cache.has(bet.id)
+    assert api.active_bets_db.find_one({"id": bet.id}) is None
+
+
+def test_unmined_invalidation_reconciles():
+    print("======== TESTING UNMINED STALE BET INVALIDATION =========")
+    advance_block(api.invalidation_window)
+    stale = api.bet_cache.get_bets_due_before(api.get_l1_block_number() - api.invalidation_window)[:2]
+    assert len(stale) == 2
+    _unpriceable = api._unpriceable
+    api._unpriceable = {bet.id for bet in stale}
+
+    # the send blowing up as a whole: nothing is dropped, every bet comes back failed and is retried next sweep
+    def _raise(*args, **kwargs):
+        raise TxPending("invalidateStaleBet not mined", None, ["0x" + "00" * 32])
+
+    api.transact_many = _raise
+    try:
+        responses = api.sweep_stale_bets()
+    finally:
+        api.__dict__.pop("transact_many", None)
+    assert [r.success or r.pending for r in responses] == [False, False]
+    assert all(api.bet_cache.has(bet.id) for bet in stale)
+
+    # the last invalidation of the batch timing out unmined: the mined one still drops its bet, the stuck one is
+    # journaled and only dropped once reconcile sees its receipt
+    def _last_mined_late(txns, account, fn_name="unknown", fence=None):
+        outcomes = ApiV2.transact_many(api, txns, account, fn_name, fence)
+        _hash = outcomes[-1].get("transactionHash").hex()
+        return outcomes[:-1] + [TxPending(f"{fn_name} not mined", api.w3.eth.get_transaction(_hash)["nonce"],
+                                          [_hash])]
+
+    api.transact_many = _last_mined_late
+    try:
+        responses = {r.bet.id: r for r in api.sweep_stale_bets()}
+    finally:
+        api.__dict__.pop("transact_many", None)
+        api._unpriceable = _unpriceable
+    mined, stuck = stale
+    assert responses[mined.id].success and not api.bet_cache.has(mined.id)
+    assert responses[stuck.id].pending and not responses[stuck.id].success
+    assert stuck.id in api._unconfirmed and not api.bet_cache.has(stuck.id)
+
+    messages = api.reconcile_pending()
+    print(messages)
+    assert [chat_id for chat_id, _ in messages] == [stuck.chat_created_in]
+    assert stuck.id not in api._unconfirmed and not api.bet_cache.has(stuck.id)
+    assert api.active_bets_db.find_one({"id": stuck.id}) is None
+
+
 def log_bet_cache():
     print("======== LOGGING BET CACHE EXPIRATION STATUS =========")
     buf = []
@@ -174,13 +328,673 @@ def test_cmc_API():
     test_by_expr("bitcoin")
 
 
+# every query shape on the hot path has to be served by an index, not a collection scan
+def test_index_plans():
+    print("======== TESTING QUERY PLANS =========")
+    plans = {
+        "users by id": api.user_db.find({"id": alice.id}).explain(),
+        "users by username": api.user_db.find({"user_name": "alice"}).collation(USERNAME_COLLATION).explain(),
+        "users by wallet+verified": api.user_db.find({"wallet_addr": alice.wallet_addr, "verified": True}).explain(),
+        "active bets by id": api.active_bets_db.find({"id": 0}).explain(),
+        "active bets by chat": api.active_bets_db.find({"chat_created_in": 1}).explain(),
+        "active bets by over user": api.active_bets_db.find({"over_user_id": alice.id}).explain(),
+        "active bets by under user": api.active_bets_db.find({"under_user_id": alice.id}).explain(),
+    }
+    for name, explain in plans.items():
+        print(f"{name}: {winning_plan_stages(explain)}")
+        assert uses_index(explain), f"{name} is not using an index!"
+
+    # case-normalized lookup should resolve regardless of how the handle was typed
+    assert api.get_user_by_username("@aLiCe") is not None
+
+
+def test_webhook_roundtrip():
+    print("======== TESTING WEBHOOK MODE =========")
+    # real receiver and dispatch, fake telegram on both ends: updates in via the webhook, replies out via the api
+    fake = FakeTelegram(port=18081).start()
+    application = ApplicationBuilder().token("123:fake").base_url(fake.base_url).concurrent_updates(8).build()
+
+    async def _start(update, context):
+        await update.message.reply_text(f"hi {update.effective_user.username}")
+
+    application.add_handler(CommandHandler('start', _start))
+
+    async def _run():
+        stop = asyncio.Event()
+        server = asyncio.create_task(webhook.serve(application, "127.0.0.1", 18443, "/telegram",
+                                                   webhook_url="http://127.0.0.1:18443/telegram", secret="s3cret",
+                                                   stop=stop))
+        while not (fake.webhook_url and application.running):
+            await asyncio.sleep(0.05)
+        responses = await asyncio.gather(*[asyncio.to_thread(fake.push_command, "/start", -1, i, f"user{i}")
+                                           for i in range(8)])
+        assert all(r.status_code == 200 for r in responses)
+        replies = await asyncio.to_thread(fake.wait_for_messages, 8)
+        assert len(replies) == 8 and all(r["chat_id"] == -1 for r in replies)
+
+        fake.secret = "wrong"
+        assert (await asyncio.to_thread(fake.push_command, "/start", -1, 1)).status_code == 403
+        stop.set()
+        await server
+
+    asyncio.run(_run())
+    fake.stop()
+
+
+def test_outbox():
+    print("======== TESTING OUTBOX =========")
+    # digests fill up to telegram's limit without splitting a notification that fits on its own
+    assert digest(["a" * 3000, "b" * 1000, "c" * 100]) == ["a" * 3000 + "\n\n" + "b" * 1000, "c" * 100]
+    assert [len(chunk) for chunk in digest(["x" * (MAX_MESSAGE_LEN + 10)])] == [MAX_MESSAGE_LEN, 10]
+
+    fake = FakeTelegram(port=18082).start()
+    bot = Bot("123:fake", base_url=fake.base_url)
+
+    async def _run():
+        outbox = Outbox(bot, window=0.2)
+        # a settlement batch for one chat goes out as a single digest, once telegram's flood wait is over
+        fake.fail_next("sendMessage", 429, "Too Many Requests: retry after 1", retry_after=1)
+        _started = time.monotonic()
+        texts = [f"bet (id:{i}) settled" for i in range(5)]
+        for text in texts:
+            outbox.post(-1, text)
+        assert time.monotonic() - _started < 0.1
+        await asyncio.sleep(0.5)
+        assert len(fake.failed) == 1 and fake.sent == []
+
+        # the flood wait only holds back its own chat, and posting doesn't wait on it
+        outbox.post(-2, "other chat")
+        await asyncio.sleep(0.4)
+        assert [(m["chat_id"], m["text"]) for m in fake.sent] == [(-2, "other chat")]
+
+        await outbox.flush()
+        assert time.monotonic() - _started >= 1
+        assert [(m["chat_id"], m["text"]) for m in fake.sent] == [(-2, "other chat"), (-1, "\n\n".join(texts))]
+
+        # a group upgraded to a supergroup: resent to the new chat id
+        fake.fail_next("sendMessage", 400, "Bad Request: group chat was upgraded to a supergroup chat",
+                       migrate_to_chat_id=-1003)
+        outbox.post(-3, "hello")
+        await outbox.flush()
+        assert [(m["chat_id"], m["text"]) for m in fake.sent[2:]] == [(-1003, "hello")]
+
+    asyncio.run(_run())
+    fake.stop()
+
+
+# a json-rpc endpoint that can be made slow, broken or behind the chain head
+class _FakeRpc:
+    def __init__(self, port: int, block: int = 100):
+        self.url = f"http://127.0.0.1:{port}"
+        self.block = block
+        self.status = 200
+        self.delay = 0.0
+        self.seen = []                  # methods of every request received
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                fake.seen.append(request["method"])
+                time.sleep(fake.delay)
+                _result = hex(fake.block) if request["method"] == "eth_blockNumber" else "0x1"
+                payload = json.dumps({"jsonrpc": "2.0", "id": request["id"], "result": _result}).encode("utf-8")
+                self.send_response(fake.status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self._server.shutdown()
+
+
+def test_provider_pool():
+    print("======== TESTING RPC PROVIDER POOL =========")
+    bad, good = _FakeRpc(18545), _FakeRpc(18546)
+    pool = ProviderPool([bad.url, good.url], "test", timeout=2.0, hedge_after=0.1)
+    _bad, _good = pool.endpoints
+
+    def _prefer_bad():
+        _bad.latency, _bad.error_rate, _good.latency, _good.error_rate = 0.01, 0.0, 0.05, 0.0
+        assert pool._candidates() == [_bad, _good]
+
+    # an endpoint answering 5xx: reads fail over to the healthy one, and three failures in a row take it out of
+    # rotation
+    bad.status = 502
+    for i in range(pool.unhealthy_after):
+        assert _bad.healthy
+        _prefer_bad()
+        assert pool.request("eth_getLogs", [{}])["result"] == "0x1"
+    assert not _bad.healthy and pool._candidates() == [_good]
+    assert bad.seen == good.seen == ["eth_getLogs"] * pool.unhealthy_after
+
+    # a hanging one: a read is hedged to the other endpoint, which answers first
+    bad.status, bad.delay = 200, 1.0
+    pool._set_healthy(_bad, True)
+    _prefer_bad()
+    bad.seen.clear()
+    good.seen.clear()
+    _hedged_before = HEDGED_REQUESTS.get(chain="test", winner="hedge")
+    _started = time.monotonic()
+    assert pool.request("eth_blockNumber", [])["result"] == hex(100)
+    assert time.monotonic() - _started < bad.delay
+    assert HEDGED_REQUESTS.get(chain="test", winner="hedge") == _hedged_before + 1
+    assert bad.seen == good.seen == ["eth_blockNumber"]
+
+    # txns and nonce reads wait for the slow endpoint, they're never sent twice
+    for method in ("eth_sendRawTransaction", "eth_getTransactionCount"):
+        time.sleep(bad.delay)
+        _prefer_bad()
+        bad.seen.clear()
+        good.seen.clear()
+        _started = time.monotonic()
+        pool.request(method, [])
+        assert time.monotonic() - _started >= bad.delay
+        assert bad.seen == [method] and good.seen == []
+
+    # an endpoint lagging the head by more than max_block_lag leaves the rotation until it catches up
+    bad.delay = 0.0
+    bad.block = good.block - pool.max_block_lag - 1
+    assert pool.health_check() == good.block
+    assert not _bad.healthy and _good.healthy
+    bad.block = good.block - pool.max_block_lag
+    pool.health_check()
+    assert _bad.healthy
+
+    bad.stop()
+    good.stop()
+
+
+def test_signer_roundtrip():
+    print("======== TESTING SIGNING SERVICE =========")
+    service = SigningService(api.w3, api.account, CONTRACT_ADDR, api._tracker(api.account))
+    threading.Thread(target=service.serve_forever, args=("unix:/tmp/pvpbet-test-signer.sock",), daemon=True).start()
+    time.sleep(0.5)
+    client = SignerClient("unix:/tmp/pvpbet-test-signer.sock", api.w3)
+    assert client.address == api.account.address
+
+    # the signer only signs calls into the bookie
+    try:
+        client.send({"to": bob.wallet_addr, "value": 1, "gas": 21_000, "gasPrice": api.w3.eth.gas_price,
+                     "chainId": api.w3.eth.chain_id})
+        assert False, "signer signed a txn to a random address"
+    except SignerError as e:
+        print(f"refused as expected: {e}")
+
+    # ...and only the bookie's own calls: a withdraw() from the bookie account is refused
+    try:
+        client.send({"to": CONTRACT_ADDR, "data": api.txs.calldata("withdraw", 1), "gas": 100_000,
+                     "gasPrice": api.w3.eth.gas_price, "chainId": api.w3.eth.chain_id})
+        assert False, "signer signed a call outside the whitelist"
+    except SignerError as e:
+        print(f"refused as expected: {e}")
+
+    # over tcp it needs its shared secret, and every request has to carry it
+    try:
+        service.serve_forever("tcp:127.0.0.1:7546")
+        assert False, "tcp signer started without a token"
+    except ValueError:
+        pass
+    guarded = SigningService(api.w3, api.account, CONTRACT_ADDR, api._tracker(api.account), token="s3cret")
+    threading.Thread(target=guarded.serve_forever, args=("tcp:127.0.0.1:7546",), daemon=True).start()
+    time.sleep(0.5)
+    assert SignerClient("tcp:127.0.0.1:7546", api.w3, token="s3cret").address == api.account.address
+    try:
+        SignerClient("tcp:127.0.0.1:7546", api.w3, token="wrong")
+        assert False, "signer answered a request with the wrong token"
+    except SignerError as e:
+        print(f"refused as expected: {e}")
+
+    # every chat lands on exactly one shard, the same one every time
+    shards = [Shard(i, 4) for i in range(4)]
+    for chat_id in (1, 2, -1001234567890, 42):
+        assert sum(s.owns(chat_id) for s in shards) == 1
+        assert shard_of(chat_id, 4) == shard_of(chat_id, 4)
+
+
+def test_settlement_lease():
+    print("======== TESTING SETTLEMENT LEASE =========")
+    api.leases_db.delete_one({"_id": "test-settlement"})
+    leader = Lease(api.leases_db, "test-settlement", ttl=1, holder="leader")
+    standby = Lease(api.leases_db, "test-settlement", ttl=1, holder="standby")
+
+    assert leader.acquire_or_renew()
+    assert not standby.acquire_or_renew()
+    first_token = leader.verify()
+    assert leader.acquire_or_renew() and leader.token == first_token      # renewing keeps the token
+
+    # leader stops renewing (dies); standby takes over once the ttl is up, with a higher fencing token
+    time.sleep(1.5)
+    assert standby.acquire_or_renew()
+    assert standby.token > first_token
+    try:
+        leader.verify()
+        assert False, "stale leader still thinks it holds the lease"
+    except LeaseLost as e:
+        print(f"old leader fenced off as expected: {e}")
+
+    # the signing service refuses the old leader's token once it has seen the new one
+    service = SigningService(api.w3, api.account, CONTRACT_ADDR, api._tracker(api.account))
+    service._check_fence(("test-settlement", standby.token))
+    try:
+        service._check_fence(("test-settlement", first_token))
+        assert False, "signer accepted a stale fencing token"
+    except LeaseLost:
+        pass
+
+    # clean shutdown hands over immediately
+    standby.release()
+    assert leader.acquire_or_renew()
+    leader.release()
+
+
+# writes made straight to mongo stand in for another replica's; they must reach this process's caches
+def test_change_feed():
+    print("======== TESTING CHANGE FEED =========")
+    if not api.users.enabled:
+        print("mongo isn't a replica set, no change streams; skipping")
+        return
+
+    def wait_for(cond, timeout=5.0):
+        deadline = time.monotonic() + timeout
+        while not cond():
+            assert time.monotonic() < deadline, "change event never applied"
+            time.sleep(0.05)
+
+    assert api.get_user_by_id(alice.id).user_name == "Alice"         # now cached
+    api.user_db.update_one({"id": alice.id}, {"$set": {"verified": False}})
+    wait_for(lambda: api.get_user_by_id(alice.id).verified is False)
+    api.user_db.update_one({"id": alice.id}, {"$set": {"verified": True}})
+    wait_for(lambda: api.get_user_by_id(alice.id).verified is True)
+
+    # "no such user" answers are cached too, until someone creates that user
+    assert api.get_user_by_username("carol") is None
+    api.user_db.insert_one(User(user_name="Carol", id=3, wallet_addr=w3_alice.address).dict())
+    wait_for(lambda: api.get_user_by_username("carol") is not None)
+    api.user_db.delete_one({"id": 3})
+    wait_for(lambda: api.get_user_by_id(3) is None)
+
+    # another replica's bet shows up in the book, and leaves it when that replica settles it
+    bet = Bet(id=10**9, chat_created_in=1, created_at=int(time.time()), over_user_id=alice.id,
+              under_user_id=bob.id, token="1", amount="1", price="1", expiry=10**12, creation_hash="0x00")
+    api.active_bets_db.insert_one(bet.dict())
+    wait_for(lambda: api.bet_cache.has(bet.id))
+    api.active_bets_db.delete_one({"id": bet.id})
+    wait_for(lambda: not api.bet_cache.has(bet.id))
+
+    # the resume token is checkpointed, so a restart picks up from here
+    api.changes._checkpoint(force=True)
+    assert api.changes.tokens.find_one({"_id": api.changes.name}) is not None
+
+
+def test_write_behind():
+    print("======== TESTING WRITE-BEHIND =========")
+    scratch = api.active_bets_db.database.write_behind_test
+    scratch.delete_many({})
+    journal = Path(base_dir) / "write_behind_test.journal"
+    writes = WriteBehind(scratch, str(journal))
+    writes.upsert({"id": 1, "v": 1})
+    writes.upsert({"id": 2, "v": 1})
+    writes.delete(1)
+    assert scratch.count_documents({}) == 0             # nothing reaches mongo before the flush
+    assert writes.flush()
+    assert [d["id"] for d in scratch.find()] == [2]
+
+    # "crash" with a write journaled but not flushed; the next process replays it
+    writes.upsert({"id": 3, "v": 1})
+    writes._journal.close()
+    assert WriteBehind(scratch, str(journal)).replay() == 1
+    assert scratch.count_documents({"id": 3}) == 1
+    assert not journal.exists()
+
+    # the same, but another replica settled (archived and deleted) the bet while we were down: not resurrected
+    archive = api.active_bets_db.database.write_behind_test_archive
+    archive.delete_many({})
+    writes = WriteBehind(scratch, str(journal), archive=archive)
+    writes.upsert({"id": 4, "v": 1})
+    writes._journal.close()
+    archive.insert_one({"id": 4})
+    assert WriteBehind(scratch, str(journal), archive=archive).replay() == 1
+    assert scratch.count_documents({"id": 4}) == 0
+    scratch.drop()
+    archive.drop()
+
+
+def test_proposals_survive_restart():
+    print("======== TESTING PROPOSAL JOURNAL =========")
+    journal = Path(base_dir) / "proposals_test.journal"
+    journal.unlink(missing_ok=True)
+    store = ProposalStore(str(journal))
+    offers = api.get_bet_proposals_by_chat_id(2)
+    for offer in offers:
+        store.create(lambda _id, _offer=offer: _offer.copy(update={"id": _id}))
+    store.claim(0, bob.id)                              # mid-accept when the process "dies"
+    store.close()
+
+    restarted = ProposalStore(str(journal))
+    assert restarted.load() == len(offers) - 1
+    assert restarted.get(0) is None and len(restarted.by_chat(2)) == len(offers) - 1
+    restarted.close()
+    journal.unlink()
+
+
+def test_settled_stats():
+    print("======== TESTING SETTLED BET STATS =========")
+    scratch = api.active_bets_db.database.client["stats_test"]
+    scratch.client.drop_database("stats_test")
+    ensure_indexes(scratch)
+    book = StatsBook(scratch)
+
+    def settled(bet_id, over_wins, amount=10**18):
+        bet = Bet(id=bet_id, chat_created_in=1, created_at=int(time.time()), over_user_id=alice.id,
+                  under_user_id=bob.id, token="1", amount=str(amount), price="1", expiry=1, creation_hash="0x00")
+        return SettledBet(bet=bet, over_wins=over_wins, settle_price=1.0, tx_hash="0x00", settled_at=datetime.utcnow(),
+                          rake=str(4 * amount // 100))
+
+    round_1 = [settled(1, True), settled(2, True), settled(3, False)]
+    assert book.record(round_1) == 3
+    assert book.record(round_1) == 0                    # a retried round isn't counted twice
+
+    _alice = book.get_user_stats(alice.id)
+    assert (_alice["wins"], _alice["losses"], _alice["streak"], _alice["best_streak"]) == (2, 1, -1, 2)
+    assert to_int(_alice["net_pnl"]) == 2 * (10**18 - 4 * 10**16) - 10**18
+    assert to_int(_alice["volume"]) == 3 * 10**18              # > int64 once summed, hence decimal128
+    assert book.get_user_stats(bob.id, chat_id=1)["streak"] == 1
+    assert to_int(book.get_chat_stats(1)["rake"]) == 3 * 4 * 10**16
+    assert [row["user_id"] for row in book.leaderboard(chat_id=1)] == [alice.id, bob.id]
+
+    # a round dying after the aggregates are written but before the bets are marked counted: the retry must not
+    # count them again
+    _chat_stats = book.chat_stats
+
+    class _Dies:
+        def bulk_write(self, *args, **kwargs):
+            _chat_stats.bulk_write(*args, **kwargs)
+            raise ConnectionError("died after the aggregates")
+
+    book.chat_stats = _Dies()
+    try:
+        book.record([settled(4, True)])
+        assert False, "record swallowed the error"
+    except ConnectionError:
+        pass
+    book.chat_stats = _chat_stats
+    assert book.record([settled(4, True)]) == 0
+    _alice = book.get_user_stats(alice.id)
+    assert (_alice["wins"], _alice["losses"]) == (3, 1)
+    assert book.get_chat_stats(1)["bets"] == 4
+    scratch.client.drop_database("stats_test")
+
+
+def test_order_book():
+    print("======== TESTING PROPOSAL ORDER BOOK =========")
+    store = ProposalStore()
+    btc = Token(id=1, symbol="BTC", name="bitcoin", rank=1)
+
+    def offer(creator, over, price, expiry=7200 * 10 + 100, counterparty=None, valid_for=timedelta(minutes=5)):
+        return store.create(lambda _id: BetProposal(
+            id=_id, chat_created_in=1, created_at=datetime.now(), valid_till=datetime.now() + valid_for,
+            created_by=creator, counterparty=counterparty, creator_over=over, amount=10**18, expiry=expiry,
+            price=price, token=btc, str_exp="10d"))
+
+    low = offer(alice.id, True, 69_000)
+    high = offer(alice.id, True, 72_000)
+    mid = offer(alice.id, True, 71_000)
+    offer(alice.id, True, 75_000, counterparty=bob.id)              # named counterparty: not in the book
+    offer(alice.id, True, 74_000, valid_for=timedelta(minutes=-1))  # lapsed
+    offer(alice.id, True, 73_000, expiry=7200 * 30)                 # expires 20 days later
+    under = offer(alice.id, False, 60_000)                          # same side as the taker
+    _expiry = 7200 * 10 + 2000
+
+    # an under taker wants the highest over strike at or above their limit
+    assert store.matches(1, btc.id, False, _expiry, 70_000, taker_id=bob.id) == [high.id, mid.id]
+    assert store.matches(1, btc.id, False, _expiry, 60_000, taker_id=bob.id) == [high.id, mid.id, low.id]
+    assert store.matches(1, btc.id, False, _expiry, 70_000, taker_id=alice.id) == []      # own offers
+    assert store.matches(2, btc.id, False, _expiry, 70_000, taker_id=bob.id) == []        # other chat
+    # an over taker wants the lowest under strike at or below theirs
+    assert store.matches(1, btc.id, True, _expiry, 65_000, taker_id=bob.id) == [under.id]
+    assert store.matches(1, btc.id, True, _expiry, 55_000, taker_id=bob.id) == []
+
+    # offers are matched by distance in blocks, not by which day bucket they fall in: one expiring just before a
+    # bucket boundary matches a taker asking for just after it, merged best-first with the taker's own bucket
+    _boundary = 7200 * 12
+    before = offer(alice.id, True, 70_500, expiry=_boundary - 10)
+    after = offer(alice.id, True, 71_500, expiry=_boundary + 3000)
+    offer(alice.id, True, 79_000, expiry=_boundary - 8000)         # more than half a day off
+    assert store.matches(1, btc.id, False, _boundary + 10, 70_000, taker_id=bob.id) == [after.id, before.id]
+    assert store.matches(1, btc.id, False, _boundary - 3000, 70_000, taker_id=bob.id) == [before.id]
+
+    store.claim(high.id, bob.id)
+    assert store.matches(1, btc.id, False, _expiry, 70_000, taker_id=bob.id) == [mid.id]
+    store.release(high.id)
+    assert store.matches(1, btc.id, False, _expiry, 70_000, taker_id=bob.id) == [high.id, mid.id]
+    store.remove(mid.id)
+    assert store.matches(1, btc.id, False, _expiry, 70_000, taker_id=bob.id) == [high.id]
+
+
+def test_txbuilder():
+    print("======== TESTING RAW TXN BUILDER =========")
+    _addr = api.account.address
+    _args = [_addr, _addr, "1", 10**17, 70_000 * 10**18, 19_000_000]
+    assert api.txs.make_bet(*_args) == api.contract_instance.encodeABI(fn_name="makeBet", args=_args)
+    assert api.txs.settle_bet(7, True) == api.contract_instance.encodeABI(fn_name="settleBet", args=[7, True])
+    assert api.txs.settle_bets([7, 8], [True, False]) == \
+        api.contract_instance.encodeABI(fn_name="settleBets", args=[[7, 8], [True, False]])
+    txn = api.txs.build(api.txs.settle_bet(7, True), "settleBet", api.settle_gas)
+    assert txn["chainId"] == api.w3.eth.chain_id and txn["to"] == api.contract_instance.address
+
+
+def test_bets_pages():
+    print("======== TESTING PAGINATED /bets =========")
+    btc = Token(id=1, symbol="BTC", name="bitcoin", rank=1)
+    _chat = -100        # a group chat, so its id can't be mistaken for a user's (DM) one
+    _pending = [BetProposal(id=i, chat_created_in=_chat, created_at=datetime.now(),
+                            valid_till=datetime.now() + timedelta(minutes=5), created_by=alice.id if i % 2 else bob.id,
+                            counterparty=None, creator_over=True, amount=10**18, expiry=1000 - i % 7, price=70_000,
+                            token=btc, str_exp="10d") for i in range(1, 31)]
+    _active = [Bet(id=i, chat_created_in=_chat, created_at=0, over_user_id=alice.id, under_user_id=bob.id,
+                   amount=str(10**18), expiry=2000 + i, price=str(70_000 * 10**18), token="1", creation_hash="0x")
+               for i in range(1, 6)]
+    _lookups = []
+
+    # the bits of ApiV2 the view cache reads, over a fixed book
+    class _Book:
+        def get_bets_by_chat_id(self, chat_id):
+            return BetList(pending=list(_pending), active=list(_active))
+
+        def get_bets_by_user_id(self, user_id):
+            return BetList(pending=[p for p in _pending if p.created_by == user_id],
+                           active=[b for b in _active if user_id in (b.over_user_id, b.under_user_id)])
+
+        def get_user_by_id(self, user_id):
+            _lookups.append(user_id)
+            return api.get_user_by_id(user_id)
+
+        def get_token_by_id(self, token_id):
+            return btc
+
+        def get_l1_block_number(self):
+            return 1500
+
+    def _ids(page):
+        return [int(line[4:]) for line in page.text.splitlines() if line.startswith("ID: ")]
+
+    views = BetsViewCache(_Book())
+    _key = views.key_for(_chat, alice.id, "all")
+
+    # walking forward visits everything once, in (section, expiry, id) order, rendering only what's shown
+    _seen, _cursor = [], None
+    while True:
+        page = views.page(_key, cursor=_cursor, size=8)
+        _seen += _ids(page)
+        if page.next is None:
+            break
+        _cursor = page.next
+    assert len(_seen) == 35 and len(set(_seen[:30])) == 30
+    assert _seen[:30] == [p.id for p in sorted(_pending, key=lambda p: (p.expiry, p.id))]
+    assert _seen[30:] == [1, 2, 3, 4, 5]
+    # names are only looked up for the active bets (open offers have no counterparty), once each
+    assert len(_lookups) == 2 * 5
+    views.page(_key, cursor=_cursor, size=8)
+    assert len(_lookups) == 2 * 5
+
+    # and back again from the last page
+    back = views.page(_key, cursor=page.prev, backwards=True, size=8)
+    assert back.next is not None and back.prev is not None
+
+    # a new offer sorting before the cursor doesn't shift what "next" means
+    first = views.page(_key, size=8)
+    _second = _ids(views.page(_key, cursor=first.next, size=8))
+    _pending.append(_pending[0].copy(update={"id": 99, "expiry": 1}))
+    views.invalidate(_chat, (alice.id, bob.id))
+    assert _ids(views.page(_key, cursor=first.next, size=8)) == _second
+    assert _ids(views.page(_key, size=8))[0] == 99
+
+    # filters
+    assert "⏳" not in views.page(_key, "offered", size=100).text
+    assert "🔎" not in views.page(_key, "active", size=100).text
+    _mine = views.page(views.key_for(_chat, bob.id, "mine"), "mine", size=100)
+    assert len(_ids(_mine)) == 15 + 5
+    assert views.page(views.key_for(-200, bob.id, "mine"), "mine") is None
+
+
+def test_http_api():
+    print("======== TESTING HTTP READ API =========")
+    client = TestClient(make_app(api))
+
+    # walking the book by cursor sees every active bet once, in (expiry, id) order
+    _seen, _cursor = [], None
+    while True:
+        r = client.get("/v1/bets", params={"limit": 2, **({"cursor": _cursor} if _cursor else {})})
+        assert r.status_code == 200
+        _seen += [(b["expiry"], b["id"]) for b in r.json()["items"]]
+        _cursor = r.json()["next_cursor"]
+        if _cursor is None:
+            break
+    assert _seen == sorted(_seen) and len(_seen) == len(api.bet_cache)
+
+    # unchanged book: 304; after a change the old etag doesn't match any more
+    r = client.get("/v1/proposals", params={"chat_id": 1})
+    assert client.get("/v1/proposals", params={"chat_id": 1},
+                      headers={"If-None-Match": r.headers["etag"]}).status_code == 304
+    api.proposals.remove(api.proposals.create(lambda _id: BetProposal(
+        id=_id, chat_created_in=1, created_at=datetime.now(), valid_till=datetime.now() + timedelta(minutes=5),
+        created_by=alice.id, counterparty=None, creator_over=True, amount=10**18, expiry=7200, price=70_000 * 10**18,
+        token=Token(id=1, symbol="BTC", name="bitcoin", rank=1), str_exp="1d")).id)
+    assert client.get("/v1/proposals", params={"chat_id": 1},
+                      headers={"If-None-Match": r.headers["etag"]}).status_code == 200
+
+    _positions = client.get(f"/v1/users/{alice.id}/positions").json()
+    assert all(alice.id in (b["over_user_id"], b["under_user_id"]) for b in _positions["active"])
+    _balance = client.get(f"/v1/users/{alice.id}/balance").json()
+    assert (int(_balance["spendable"]), int(_balance["locked"])) == api.get_user_balance_by_id(alice.id)
+    assert client.get("/v1/users/-1/balance").status_code == 404
+    assert client.get("/v1/bets", params={"cursor": "nope"}).status_code == 400
+
+
+def test_metrics():
+    print("======== TESTING METRICS =========")
+    registry = metrics.Registry()
+    calls = registry.counter("t_calls_total", "calls", ("method",))
+    depth = registry.gauge("t_depth", "depth")
+    latency = registry.histogram("t_latency_seconds", "latency", ("op",), buckets=(0.1, 1.0))
+
+    # labels have to match the declared names exactly
+    for bad in ({}, {"fn": "x"}, {"method": "x", "extra": "y"}):
+        try:
+            calls.inc(**bad)
+            assert False, f"accepted labels {bad}"
+        except ValueError:
+            pass
+    try:
+        calls.inc(-1, method="x")
+        assert False, "counter went down"
+    except ValueError:
+        pass
+    assert registry.counter("t_calls_total", "calls", ("method",)) is calls
+    try:
+        registry.gauge("t_calls_total", "calls")
+        assert False, "registered a gauge over a counter"
+    except ValueError:
+        pass
+
+    calls.inc(method="bet")
+    calls.inc(2, method='say "hi"\n')
+    depth.set_function(lambda: 7)
+    for v in (0.05, 0.1, 0.5, 3):
+        latency.observe(v, op="rpc")
+    assert calls.get(method="bet") == 1
+
+    text = registry.render()
+    assert text.endswith("\n")
+    lines = text.splitlines()
+    assert "# HELP t_calls_total calls" in lines and "# TYPE t_calls_total counter" in lines
+    assert 't_calls_total{method="bet"} 1' in lines
+    assert 't_calls_total{method="say \\"hi\\"\\n"} 2' in lines
+    assert "# TYPE t_depth gauge" in lines and "t_depth 7" in lines
+    # buckets are cumulative, +Inf equals the count; 0.1 falls in the 0.1 bucket (le is inclusive)
+    assert "# TYPE t_latency_seconds histogram" in lines
+    assert 't_latency_seconds_bucket{op="rpc",le="0.1"} 2' in lines
+    assert 't_latency_seconds_bucket{op="rpc",le="1"} 3' in lines
+    assert 't_latency_seconds_bucket{op="rpc",le="+Inf"} 4' in lines
+    assert 't_latency_seconds_sum{op="rpc"} 3.65' in lines
+    assert 't_latency_seconds_count{op="rpc"} 4' in lines
+
+
+# a settlement round that blows up must leave every popped bet in the book, due for the next round
+def test_settle_failure_requeues():
+    print("======== TESTING SETTLEMENT FAILURE RE-QUEUE =========")
+    bet = Bet(id=10**9, chat_created_in=1, created_at=0, over_user_id=alice.id, under_user_id=bob.id,
+              amount=str(10**17), expiry=0, price=str(70_000 * 10**18), token="1", creation_hash="0x")
+    btc = Token(id=1, symbol="BTC", name="bitcoin", rank=1)
+
+    def _due():
+        return bet.id in [b.id for b in api.bet_cache.get_bets_due_before(api.get_l1_block_number())]
+
+    def _raise(*args, **kwargs):
+        raise ValueError("boom")
+
+    api.bet_cache.push(bet)
+    try:
+        # the whole batch raising
+        api.settle_bets_batch = _raise
+        try:
+            api.settle_outstanding()
+            assert False, "settle_outstanding swallowed the error"
+        except ValueError:
+            pass
+        del api.settle_bets_batch
+        assert _due()
+
+        # a txn send failing partway through the batch
+        api._price_bet = lambda _bet: (True, btc, 80_000.0)
+        api._settle_chunks = _raise
+        responses = api.settle_outstanding()
+        assert [r.success for r in responses if r.bet.id == bet.id] == [False]
+        assert _due()
+    finally:
+        for patched in ("settle_bets_batch", "_price_bet", "_settle_chunks"):
+            api.__dict__.pop(patched, None)
+        api.bet_cache.remove(bet.id)
+
+
 def test_create_duplicate_users():
     test_create_users()
     test_create_users()
 
 
 # test_verify_raw_signature()
+test_metrics()
 test_create_users()
+test_index_plans()
 test_verify_users()
 simulate_user_deposits()
 test_get_balances()
@@ -188,10 +1002,29 @@ test_request_bets()
 test_get_bets_by_chat_id(1)
 test_get_bets_by_user_id()
 test_accept_bets()
+test_concurrent_accepts()
+test_accept_checks_creator_funds()
+test_unmined_accept_reconciles()
 test_get_bets_by_chat_id(1)
 log_bet_cache()
 advance_block(55)
+test_unmined_settlement_reconciles()
+test_unmined_invalidation_reconciles()
 test_settle_bets()
+test_settle_failure_requeues()
 log_bet_cache()
 test_create_duplicate_users()
+test_webhook_roundtrip()
+test_outbox()
+test_provider_pool()
+test_signer_roundtrip()
+test_settlement_lease()
+test_change_feed()
+test_write_behind()
+test_proposals_survive_restart()
+test_order_book()
+test_settled_stats()
+test_txbuilder()
+test_bets_pages()
+test_http_api()
 # test_cmc_API()
@@ -0,0 +1,154 @@
+import json
+import time
+import random
+import logging
+import contextvars
+from functools import wraps
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+slow_logger = logging.getLogger("tgbot.slow_commands")
+
+# the span that new child spans attach to; None means "not inside a sampled trace" and every
+# span() call short-circuits, which is what keeps unsampled updates close to free
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    __slots__ = ("name", "attrs", "start", "end", "children", "trace", "error")
+
+    def __init__(self, name: str, trace, attrs: dict | None = None):
+        self.name = name
+        self.attrs = attrs or {}
+        self.trace = trace
+        self.start = time.perf_counter()
+        self.end = None
+        self.children = []
+        self.error = None
+
+    @property
+    def duration(self) -> float:
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+    def to_dict(self, origin: float) -> dict:
+        d = {"name": self.name,
+             "start_ms": round((self.start - origin) * 1000, 3),
+             "duration_ms": round(self.duration * 1000, 3)}
+        if self.attrs:
+            d["attrs"] = self.attrs
+        if self.error:
+            d["error"] = self.error
+        if self.children:
+            d["children"] = [c.to_dict(origin) for c in self.children]
+        return d
+
+
+class Trace:
+    def __init__(self, max_spans: int):
+        self.max_spans = max_spans
+        self.span_count = 0
+        self.dropped = 0
+
+
+class Tracer:
+    def __init__(self, slow_threshold: float = 5.0, sample_rate: float = 1.0, max_spans: int = 500):
+        self.slow_threshold = slow_threshold
+        self.sample_rate = sample_rate
+        self.max_spans = max_spans
+
+    def configure(self, slow_threshold: float | None = None, sample_rate: float | None = None,
+                  max_spans: int | None = None):
+        if slow_threshold is not None:
+            self.slow_threshold = slow_threshold
+        if sample_rate is not None:
+            self.sample_rate = sample_rate
+        if max_spans is not None:
+            self.max_spans = max_spans
+
+    # wraps a python-telegram-bot callback. every update gets timed; sampled updates also get a span tree
+    def traced(self, command: str, callback):
+        @wraps(callback)
+        async def wrapper(update, context):
+            sampled = random.random() < self.sample_rate
+            root = Span(f"/{command}", Trace(self.max_spans)) if sampled else None
+            token = _current_span.set(root) if sampled else None
+            start = time.perf_counter()
+            try:
+                return await callback(update, context)
+            except Exception as e:
+                if root is not None:
+                    root.error = repr(e)
+                raise
+            finally:
+                elapsed = time.perf_counter() - start
+                if root is not None:
+                    root.end = time.perf_counter()
+                    _current_span.reset(token)
+                if elapsed >= self.slow_threshold:
+                    self._emit_slow(command, update, elapsed, root)
+        return wrapper
+
+    def _emit_slow(self, command: str, update, elapsed: float, root: Span | None):
+        record = {
+            "event": "slow_command",
+            "command": command,
+            "duration_ms": round(elapsed * 1000, 3),
+            "threshold_ms": round(self.slow_threshold * 1000, 3),
+            "chat_id": getattr(getattr(update, "effective_chat", None), "id", None),
+            "user_id": getattr(getattr(update, "effective_user", None), "id", None),
+            "update_id": getattr(update, "update_id", None),
+            "sampled": root is not None,
+        }
+        if root is not None:
+            record["spans"] = root.to_dict(root.start)
+            record["dropped_spans"] = root.trace.dropped
+        slow_logger.warning(json.dumps(record, default=str))
+
+
+TRACER = Tracer()
+
+
+# opens a child span under whatever span is current. no-op outside a sampled trace
+@contextmanager
+def span(name: str, **attrs):
+    parent = _current_span.get()
+    if parent is None:
+        yield None
+        return
+    trace = parent.trace
+    if trace.span_count >= trace.max_spans:
+        trace.dropped += 1
+        yield None
+        return
+    trace.span_count += 1
+    child = Span(name, trace, attrs)
+    parent.children.append(child)
+    token = _current_span.set(child)
+    try:
+        yield child
+    except Exception as e:
+        child.error = repr(e)
+        raise
+    finally:
+        child.end = time.perf_counter()
+        _current_span.reset(token)
+
+
+# attaches an already-finished span, for callers that only learn the duration after the fact (mongo listener)
+def record(name: str, duration: float, **attrs):
+    parent = _current_span.get()
+    if parent is None:
+        return
+    trace = parent.trace
+    if trace.span_count >= trace.max_spans:
+        trace.dropped += 1
+        return
+    trace.span_count += 1
+    child = Span(name, trace, attrs)
+    child.end = time.perf_counter()
+    child.start = child.end - duration
+    parent.children.append(child)
+
+
+def traced(command: str, callback):
+    return TRACER.traced(command, callback)
@@ -0,0 +1,73 @@
+import logging
+from eth_abi import encode
+
+logger = logging.getLogger(__name__)
+
+
+# top-level argument types of a canonical signature: "f(address,(uint256,bool)[],string)" ->
+# ["address", "(uint256,bool)[]", "string"]
+def arg_types(signature: str) -> list[str]:
+    inner = signature[signature.index("(") + 1:-1]
+    types, depth, start = [], 0, 0
+    for i, c in enumerate(inner):
+        if c == "(":
+            depth += 1
+        elif c == ")":
+            depth -= 1
+        elif c == "," and depth == 0:
+            types.append(inner[start:i])
+            start = i + 1
+    if inner:
+        types.append(inner[start:])
+    return types
+
+
+# bookie txns without contract_instance.functions.X(...).build_transaction(): calldata is the cached 4-byte
+# selector + eth_abi encoding of the args (no abi lookup or argument matching per call), chain id is read once,
+# gas limits and fees come from the FeeOracle caches, and the nonce is assigned later by the TxTracker. so on the
+# hot path building a txn is pure cpu; the only network calls left are the oracle's periodic cache refreshes
+class TxBuilder:
+    def __init__(self, w3, fees, bindings, contract_addr: str, sender: str, chain_id: int):
+        self.w3 = w3
+        self.fees = fees
+        self.to = contract_addr
+        self.sender = sender
+        self.chain_id = chain_id
+        # fn name -> (selector, arg types), resolved once
+        self._fns = {name: (bytes.fromhex(bindings.SELECTORS[name][2:]), arg_types(sig))
+                     for name, sig in bindings.SIGNATURES.items()}
+
+    def calldata(self, fn_name: str, *args) -> str:
+        selector, types = self._fns[fn_name]
+        return "0x" + (selector + encode(types, args)).hex()
+
+    # fn makeBet(address _over, address _under, string calldata _sym, uint256 _amt, uint256 _price, uint256 _exp)
+    def make_bet(self, over: str, under: str, sym: str, amt: int, price: int, exp: int) -> str:
+        return self.calldata("makeBet", over, under, sym, amt, price, exp)
+
+    # fn settleBet(uint256 bet_id, bool over_wins)
+    def settle_bet(self, bet_id: int, over_wins: bool) -> str:
+        return self.calldata("settleBet", bet_id, over_wins)
+
+    # fn settleBets(uint256[] bet_ids, bool[] over_wins)
+    def settle_bets(self, bet_ids: list[int], over_wins: list[bool]) -> str:
+        return self.calldata("settleBets", bet_ids, over_wins)
+
+    # fn invalidateStaleBet(uint256 bet_id)
+    def invalidate_stale_bet(self, bet_id: int) -> str:
+        return self.calldata("invalidateStaleBet", bet_id)
+
+    # a complete txn for the contract, minus the nonce. gas_key groups calls for the cached gas estimate, the same
+    # keys FeeOracle.tx_params is used with. batch calls pass their item count (and a per-item margin), see
+    # FeeOracle.batch_gas_limit
+    def build(self, data: str, gas_key: str, fallback_gas: int, value: int = 0, items: int | None = None,
+              item_margin: int = 0) -> dict:
+        _call = {"from": self.sender, "to": self.to, "data": data, "value": value}
+        if items is None:
+            _gas = self.fees.gas_limit(gas_key, lambda: self.w3.eth.estimate_gas(_call), fallback_gas)
+        else:
+            _gas = self.fees.batch_gas_limit(gas_key, items, lambda: self.w3.eth.estimate_gas(_call), fallback_gas,
+                                             item_margin)
+        txn = {"chainId": self.chain_id, **_call, "gas": _gas}
+        txn.update(self.fees.fee_params())
+        return txn
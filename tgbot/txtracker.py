@@ -0,0 +1,175 @@
+import time
+import threading
+import logging
+from web3.exceptions import TransactionNotFound, TimeExhausted
+from . import metrics, tracing
+
+logger = logging.getLogger(__name__)
+
+IN_FLIGHT = metrics.REGISTRY.gauge("pvpbet_txns_in_flight", "bookie txns sent but not yet mined")
+
+
+# no version of a txn was seen mined before the deadline. it may still land, so callers that need to know keep
+# the nonce and every hash broadcast for it (hex, oldest first) and look again later, see pending.PendingTxns
+class TxPending(TimeExhausted):
+    def __init__(self, msg: str, nonce: int | None, hashes: list[str]):
+        super().__init__(msg)
+        self.nonce = nonce
+        self.hashes = hashes
+
+
+class InFlightTx:
+    def __init__(self, nonce: int, fn_name: str, txn: dict):
+        self.nonce = nonce
+        self.fn_name = fn_name
+        self.txn = txn
+        self.hashes = []            # every version we broadcast for this nonce, oldest first
+        self.last_sent = 0.0
+        self.bumps = 0
+
+    def __repr__(self):
+        return f"InFlightTx(nonce={self.nonce}, fn={self.fn_name}, versions={len(self.hashes)}, bumps={self.bumps})"
+
+
+# owns the nonce sequence for one signing account and babysits every txn until one version of it is mined.
+# a txn not mined within `stuck_after` seconds is re-signed with bumped fees under the same nonce; whichever
+# version lands is the receipt returned to the caller, so bookkeeping always uses the real hash/logs
+class TxTracker:
+    def __init__(self, w3, account, fees, stuck_after: float = 30.0, poll_interval: float = 1.0,
+                 bump_ratio: float = 1.125, max_bumps: int = 5, timeout: float = 600.0):
+        self.w3 = w3
+        self.account = account
+        self.fees = fees
+        self.stuck_after = stuck_after
+        self.poll_interval = poll_interval
+        self.bump_ratio = bump_ratio        # nodes want >= 10% on both fee fields to accept a replacement
+        self.max_bumps = max_bumps
+        self.timeout = timeout
+        self.in_flight = {}
+        self._lock = threading.Lock()
+        self._next_nonce = None
+
+    #### NONCES ####
+    def _reserve_nonces(self, n: int) -> int:
+        with self._lock:
+            if self._next_nonce is None:
+                self._next_nonce = self.w3.eth.get_transaction_count(self.account.address, "pending")
+            nonce = self._next_nonce
+            self._next_nonce += n
+            return nonce
+
+    # after a send blows up we can't know whether the node saw it, so re-read the nonce from the chain next time
+    def _resync_nonces(self):
+        with self._lock:
+            self._next_nonce = None
+
+    #### SENDING ####
+    def _bumped(self, txn: dict) -> dict:
+        current = self.fees.fee_params()
+        bumped = dict(txn)
+        for field in ("maxFeePerGas", "maxPriorityFeePerGas", "gasPrice"):
+            if field in txn:
+                bumped[field] = max(int(txn[field] * self.bump_ratio) + 1, current.get(field, 0))
+        if "maxFeePerGas" in bumped and bumped["maxPriorityFeePerGas"] > bumped["maxFeePerGas"]:
+            bumped["maxFeePerGas"] = bumped["maxPriorityFeePerGas"]
+        return bumped
+
+    def _broadcast(self, tx: InFlightTx):
+        with tracing.span("sign_transaction"):
+            signed_txn = self.account.sign_transaction(tx.txn)
+        try:
+            tx_hash = self.w3.eth.send_raw_transaction(signed_txn.rawTransaction)
+        except ValueError as e:
+            _msg = str(e).lower()
+            # an earlier version already got mined/is already in the pool, keep watching what we have
+            if "nonce too low" in _msg or "already known" in _msg:
+                logger.info(f"{tx} rebroadcast rejected ({e}), waiting on earlier versions")
+                tx.last_sent = time.monotonic()
+                return
+            raise
+        tx.hashes.append(tx_hash)
+        tx.last_sent = time.monotonic()
+        metrics.TXNS.inc(fn=tx.fn_name, status="sent" if len(tx.hashes) == 1 else "replaced")
+
+    def _submit(self, txn: dict, fn_name: str, nonce: int) -> InFlightTx:
+        txn = dict(txn)
+        txn["nonce"] = nonce
+        tx = InFlightTx(nonce, fn_name, txn)
+        try:
+            self._broadcast(tx)
+            if not tx.hashes:
+                raise ValueError(f"nonce {nonce} is already used, local nonce sequence is stale")
+        except Exception:
+            self._resync_nonces()
+            raise
+        with self._lock:
+            self.in_flight[nonce] = tx
+            IN_FLIGHT.set(len(self.in_flight))
+        return tx
+
+    # blocks until one version of the txn is mined and returns that version's receipt
+    def _wait(self, tx: InFlightTx):
+        deadline = time.monotonic() + self.timeout
+        try:
+            with tracing.span("wait_for_transaction_receipt", fn=tx.fn_name, nonce=tx.nonce):
+                while True:
+                    for tx_hash in reversed(tx.hashes):
+                        try:
+                            receipt = self.w3.eth.get_transaction_receipt(tx_hash)
+                        except TransactionNotFound:
+                            continue
+                        if receipt is not None:
+                            if len(tx.hashes) > 1:
+                                logger.info(f"{tx} landed as {tx_hash.hex()}")
+                            metrics.TXNS.inc(fn=tx.fn_name, status="mined" if receipt.status else "reverted")
+                            return receipt
+
+                    now = time.monotonic()
+                    if now > deadline:
+                        raise TxPending(f"{tx} not mined after {self.timeout}s", tx.nonce,
+                                        [h.hex() for h in tx.hashes])
+                    if now - tx.last_sent > self.stuck_after and tx.bumps < self.max_bumps:
+                        tx.txn = self._bumped(tx.txn)
+                        tx.bumps += 1
+                        logger.warning(f"{tx} stuck for {self.stuck_after}s, resubmitting with bumped fees")
+                        try:
+                            self._broadcast(tx)
+                        except ValueError as e:
+                            # e.g. "replacement transaction underpriced": the next round bumps again
+                            logger.warning(f"replacement for {tx} rejected: {e}")
+                            tx.last_sent = now
+                    time.sleep(self.poll_interval)
+        finally:
+            with self._lock:
+                self.in_flight.pop(tx.nonce, None)
+                IN_FLIGHT.set(len(self.in_flight))
+
+    def send(self, txn: dict, fn_name: str = "unknown"):
+        nonce = self._reserve_nonces(1)
+        tx = self._submit(txn, fn_name, nonce)
+        return self._wait(tx)
+
+    # pipelined: all txns get consecutive nonces and are broadcast before waiting on any of them.
+    # one outcome per txn, in order: its receipt, None if it was never sent (a broadcast failed midway), or the
+    # TxPending for it if it was sent but not seen mined. one stuck nonce doesn't hide the receipts of the others
+    def send_many(self, txns: list[dict], fn_name: str = "unknown") -> list:
+        if not txns:
+            return []
+        first = self._reserve_nonces(len(txns))
+        submitted = []
+        try:
+            for i, txn in enumerate(txns):
+                submitted.append(self._submit(txn, fn_name, first + i))
+        except Exception as e:
+            logger.error(f"pipelined send failed after {len(submitted)}/{len(txns)} txns: {e}")
+        return [self._outcome(tx) for tx in submitted] + [None] * (len(txns) - len(submitted))
+
+    def _outcome(self, tx: InFlightTx):
+        try:
+            return self._wait(tx)
+        except TxPending as e:
+            return e
+        except Exception as e:
+            # e.g. the rpc went away while polling for receipts: the txn is out there all the same
+            logger.error(f"lost track of {tx}: {e}")
+            return TxPending(f"{tx} not seen mined: {e}", tx.nonce, [h.hex() for h in tx.hashes])
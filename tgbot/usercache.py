@@ -0,0 +1,120 @@
+import logging
+import threading
+from collections import OrderedDict
+from pydantic import ValidationError
+from .schema import User
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+# users by telegram id and by (case-insensitive) username, including "no such user" answers. there's no ttl:
+# entries are dropped by our own writes and by the change feed when another process writes (see changefeed.py).
+# without a change feed (`enabled = False`) every lookup goes to mongo, so a stale hit is never possible
+class UserCache:
+    def __init__(self, max_size: int = 10_000):
+        self.max_size = max_size
+        self.enabled = True
+        self._lock = threading.Lock()
+        self._by_id = OrderedDict()     # id -> (User | None, mongo _id | None), lru order
+        self._ids_by_name = {}          # lowercased user_name -> id | None
+        self._ids_by_oid = {}           # mongo _id -> id, so delete events (which only carry _id) can be mapped
+        self._epoch = 0                 # bumped on every invalidation; a load that raced one isn't stored
+
+    @staticmethod
+    def _parse(doc: dict | None) -> User | None:
+        if doc is None:
+            return None
+        try:
+            return User(**doc)
+        except (ValidationError, TypeError):
+            logger.warning(f"invalid user document in db: {doc}")
+            return None
+
+    def _store(self, epoch: int, user_id: int | None, user: User | None, doc: dict | None, name: str | None = None):
+        with self._lock:
+            if epoch != self._epoch:
+                return
+            if user_id is not None:
+                _oid = doc.get("_id") if doc is not None else None
+                self._by_id[user_id] = (user, _oid)
+                self._by_id.move_to_end(user_id)
+                if _oid is not None:
+                    self._ids_by_oid[_oid] = user_id
+                if user is not None:
+                    self._ids_by_name[user.user_name.lower()] = user_id
+            if name is not None:
+                self._ids_by_name[name.lower()] = user_id
+            while len(self._by_id) > self.max_size:
+                self._forget(*self._by_id.popitem(last=False))
+            # "no such user" answers aren't in the lru, bound them separately
+            if len(self._ids_by_name) > 2 * self.max_size:
+                self._ids_by_name = {n: i for n, i in self._ids_by_name.items() if i is not None}
+
+    # drops the secondary entries pointing at a user that's leaving _by_id. caller holds the lock
+    def _forget(self, user_id: int, entry: tuple):
+        user, _oid = entry
+        self._ids_by_oid.pop(_oid, None)
+        if user is not None and self._ids_by_name.get(user.user_name.lower()) == user_id:
+            del self._ids_by_name[user.user_name.lower()]
+
+    # load(user_id) -> raw mongo doc or None
+    def get_by_id(self, user_id: int, load) -> User | None:
+        if self.enabled:
+            with self._lock:
+                if user_id in self._by_id:
+                    metrics.CACHE_LOOKUPS.inc(cache="users", result="hit")
+                    user, _ = self._by_id[user_id]
+                    self._by_id.move_to_end(user_id)
+                    return user.copy() if user is not None else None
+                epoch = self._epoch
+        metrics.CACHE_LOOKUPS.inc(cache="users", result="miss")
+        doc = load(user_id)
+        user = self._parse(doc)
+        if self.enabled:
+            self._store(epoch, user_id, user, doc)
+        return user.copy() if user is not None else None
+
+    # load(user_name) -> raw mongo doc or None. telegram usernames are [a-z0-9_] up to case, so lower() keys
+    # agree with the case-insensitive collation mongo matches them with
+    def get_by_name(self, user_name: str, load) -> User | None:
+        if self.enabled:
+            with self._lock:
+                _key = user_name.lower()
+                if _key in self._ids_by_name:
+                    user_id = self._ids_by_name[_key]
+                    if user_id is None:
+                        metrics.CACHE_LOOKUPS.inc(cache="users", result="hit")
+                        return None
+                    if user_id in self._by_id:
+                        metrics.CACHE_LOOKUPS.inc(cache="users", result="hit")
+                        user, _ = self._by_id[user_id]
+                        return user.copy() if user is not None else None
+                epoch = self._epoch
+        metrics.CACHE_LOOKUPS.inc(cache="users", result="miss")
+        doc = load(user_name)
+        user = self._parse(doc)
+        if self.enabled:
+            self._store(epoch, user.id if user is not None else None, user, doc, name=user_name)
+        return user.copy() if user is not None else None
+
+    def id_for_oid(self, oid) -> int | None:
+        with self._lock:
+            return self._ids_by_oid.get(oid)
+
+    # user_name: the name from the changed document, if known, so a cached "no such user" for it goes too
+    def invalidate(self, user_id: int, user_name: str | None = None):
+        with self._lock:
+            self._epoch += 1
+            entry = self._by_id.pop(user_id, None)
+            if entry is not None:
+                self._forget(user_id, entry)
+            if user_name is not None:
+                self._ids_by_name.pop(user_name.lower(), None)
+
+    def clear(self):
+        with self._lock:
+            self._epoch += 1
+            self._by_id.clear()
+            self._ids_by_name.clear()
+            self._ids_by_oid.clear()
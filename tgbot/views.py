@@ -0,0 +1,236 @@
+import time
+import threading
+import logging
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def _fmt_amount(n: str | int) -> float:
+    return round(int(n) / 1000000000000000000, 4)
+
+
+def _fmt_time_left(blocks_left: int) -> str:
+    _time_est = blocks_left * 12
+    _mins = int(_time_est / 60)
+    _hrs = _mins / 60
+    _wks = (_hrs / 24) / 7
+    return f"~{_wks} weeks" if _wks > 1 else f"~{_hrs} hours" if _hrs > 1 else f"~{_mins} minutes"
+
+
+PAGE_SIZE = 8
+FILTERS = ("all", "offered", "active", "mine")
+
+_OFFERED, _ACTIVE = 0, 1
+
+
+# a /bets listing as entries sorted by (section, expiry block, id), offers first. that key is the cursor pages are
+# addressed by: it's stable across rebuilds, so "next after X" still means the same thing when the book changes in
+# between. entries are only rendered when a page with them on it is asked for; the parts that never change (names,
+# symbols, amounts) are kept per entry after that, the time-remaining bits are filled in at read time
+class _View:
+    __slots__ = ("keys", "items", "rendered", "first_valid_till", "user_ids")
+
+    def __init__(self):
+        self.keys = []                  # sorted (section, expiry block, id)
+        self.items = {}                 # key -> BetProposal / Bet
+        self.rendered = {}              # key -> (text before the time left, text after)
+        self.first_valid_till = None    # soonest offer deadline, the view is stale after that
+        self.user_ids = set()           # every user whose name can appear in the view
+
+    # [lo, hi) of the keys matching a filter; both sections are contiguous, so it's a bisect, not a scan
+    def span(self, kind: str) -> tuple[int, int]:
+        _split = bisect_left(self.keys, (_ACTIVE,))
+        if kind == "offered":
+            return 0, _split
+        if kind == "active":
+            return _split, len(self.keys)
+        return 0, len(self.keys)
+
+
+# one page of a listing. prev/next are the cursors to pass back in to get the neighbouring pages (None at the ends)
+class Page:
+    __slots__ = ("text", "prev", "next")
+
+    def __init__(self, text: str, prev: tuple | None, next: tuple | None):
+        self.text = text
+        self.prev = prev
+        self.next = next
+
+
+# materialized /bets listings per group chat, per user (DMs) and per user within a group chat (/bets mine).
+# entries only get dropped by the events that can change them (proposal created/accepted/expired/removed, bet
+# settled, user renamed/removed), and a cache hit does zero network calls apart from the shared, cached block head
+# and the name lookups for entries shown for the first time
+class BetsViewCache:
+    def __init__(self, api, block_head_ttl: float = 12.0):
+        self.api = api
+        self.block_head_ttl = block_head_ttl
+        self._lock = threading.Lock()
+        self._views = {}
+        self._versions = {}
+        self._block_head = None
+        self._block_head_at = 0.0
+
+    # one l1 block is ~12s, so there's no point asking more often than that
+    def block_head(self) -> int | None:
+        now = time.monotonic()
+        if self._block_head is None or now - self._block_head_at > self.block_head_ttl:
+            _head = self.api.get_l1_block_number()
+            if _head is not None:
+                self._block_head, self._block_head_at = _head, now
+        return self._block_head
+
+    #### INVALIDATION ####
+    def _drop(self, key):
+        self._views.pop(key, None)
+        self._versions[key] = self._versions.get(key, 0) + 1
+
+    def invalidate(self, chat_id: int | None = None, user_ids=()):
+        with self._lock:
+            if chat_id is not None:
+                self._drop(("chat", chat_id))
+            for user_id in user_ids:
+                if user_id is not None:
+                    self._drop(("user", user_id))
+                    if chat_id is not None:
+                        self._drop(("mine", user_id, chat_id))
+
+    # a user changing their name/wallet affects every view that mentions them
+    def invalidate_user(self, user_id: int):
+        with self._lock:
+            for key in [k for k, v in self._views.items() if user_id in v.user_ids]:
+                self._drop(key)
+            self._drop(("user", user_id))
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._views):
+                self._drop(key)
+
+    #### RENDERING ####
+    # the view key for a /bets call: in a DM it's always the caller's bets across chats
+    @staticmethod
+    def key_for(chat_id: int, user_id: int, kind: str) -> tuple:
+        if chat_id == user_id:
+            return "user", user_id
+        if kind == "mine":
+            return "mine", user_id, chat_id
+        return "chat", chat_id
+
+    # the page of `key` after `cursor` (or before it, if `backwards`), the first page without one. costs two
+    # bisects plus rendering at most `size` entries, however big the listing is. None if nothing matches the filter
+    def page(self, key, kind: str = "all", cursor: tuple | None = None, backwards: bool = False,
+             size: int = PAGE_SIZE) -> Page | None:
+        view = self._view(key)
+        lo, hi = view.span(kind)
+        if lo == hi:
+            return None
+        if cursor is None:
+            start = lo
+        elif backwards:
+            start = max(lo, bisect_left(view.keys, cursor, lo, hi) - size)
+        else:
+            start = bisect_right(view.keys, cursor, lo, hi)
+        # a cursor past the end (the last entries went away since it was handed out): show the last page instead
+        if start >= hi:
+            start = max(lo, hi - size)
+        end = min(hi, start + size)
+
+        _text = self._render(view, view.keys[start:end])
+        _text += f"\n({start - lo + 1}-{end - lo} of {hi - lo})"
+        return Page(_text, view.keys[start] if start > lo else None, view.keys[end - 1] if end < hi else None)
+
+    def _view(self, key) -> _View:
+        view = self._views.get(key)
+        # an expired offer means the listing changed, rebuild (which also purges it from the pending list)
+        if view is not None and view.first_valid_till is not None and view.first_valid_till < datetime.now():
+            logger.debug("bets view %s has an expired offer, rebuilding", key)
+            view = None
+        if view is None:
+            metrics.CACHE_LOOKUPS.inc(cache="bets_view", result="miss")
+            return self._build(key)
+        metrics.CACHE_LOOKUPS.inc(cache="bets_view", result="hit")
+        return view
+
+    def _render(self, view: _View, keys: list) -> str:
+        now = datetime.now()
+        _head_block = None
+        _text, _section = "", None
+        for key in keys:
+            if key[0] != _section:
+                _section = key[0]
+                _text += "🔎 currently offered:" if _section == _OFFERED else "⏳ currently active:"
+                if _section == _ACTIVE:
+                    _head_block = self.block_head()
+            head, tail = view.rendered.get(key) or self._render_entry(view, key)
+            if _section == _OFFERED:
+                _text += head + str(view.items[key].valid_till - now) + tail
+            elif _head_block is None:
+                _text += head + " (time left unknown)\n" + tail
+            else:
+                _blocks_left = key[1] - _head_block
+                _text += head + f" in {_fmt_time_left(_blocks_left)} ({_blocks_left} blocks)\n" + tail
+        return _text
+
+    def _render_entry(self, view: _View, key) -> tuple[str, str]:
+        bet_struct = view.items[key]
+        if key[0] == _OFFERED:
+            _open_to = self._name(bet_struct.counterparty) if bet_struct.counterparty is not None else "Anyone ‼️"
+            _side = "under" if bet_struct.creator_over else "over"
+            head = f"\nID: {bet_struct.id}\n Open to: {_open_to} for "
+            d2 = f"${bet_struct.token.symbol} {_side} ${_fmt_amount(bet_struct.price)} in {bet_struct.str_exp}\n"
+            d3 = f"Amount wagered: {_fmt_amount(bet_struct.amount)}\n"
+            rendered = (head, "\n" + d2 + d3)
+        else:
+            _token = self.api.get_token_by_id(int(bet_struct.token))
+            _symbol = _token.symbol if _token is not None else bet_struct.token
+            d1 = f"\nID: {bet_struct.id}\n Over: @{self._name(bet_struct.over_user_id)}\n" \
+                 f" Under: @{self._name(bet_struct.under_user_id)}\n"
+            d2 = f"${_symbol} trades at ${int(bet_struct.price) / 1000000000000000000}"
+            d4 = f"Amount wagered: {_fmt_amount(bet_struct.amount)} ETH\n"
+            rendered = (d1 + d2, d4)
+        view.rendered[key] = rendered
+        return rendered
+
+    def _name(self, user_id: int) -> str:
+        _user = self.api.get_user_by_id(user_id)
+        return _user.user_name if _user is not None else str(user_id)
+
+    # sorts the chat's/user's bets into a view; no rendering, so a cold build is proportional to the listing only
+    # through the index lookups and one sort
+    def _build(self, key) -> _View:
+        with self._lock:
+            version = self._versions.get(key, 0)
+
+        if key[0] == "chat":
+            _bets = self.api.get_bets_by_chat_id(key[1])
+        else:
+            _bets = self.api.get_bets_by_user_id(key[1])
+        _chat_id = key[2] if key[0] == "mine" else None
+        view = _View()
+
+        _now = datetime.now()
+        for bet_struct in _bets.pending:
+            if bet_struct.valid_till < _now or _chat_id not in (None, bet_struct.chat_created_in):
+                continue
+            view.items[(_OFFERED, bet_struct.expiry, bet_struct.id)] = bet_struct
+            view.user_ids.update((bet_struct.created_by, bet_struct.counterparty))
+            if view.first_valid_till is None or bet_struct.valid_till < view.first_valid_till:
+                view.first_valid_till = bet_struct.valid_till
+
+        for bet_struct in _bets.active:
+            if _chat_id not in (None, bet_struct.chat_created_in):
+                continue
+            view.items[(_ACTIVE, bet_struct.expiry, bet_struct.id)] = bet_struct
+            view.user_ids.update((bet_struct.over_user_id, bet_struct.under_user_id))
+        view.user_ids.discard(None)
+        view.keys = sorted(view.items)
+
+        # only publish if nothing invalidated this key while we were building it
+        with self._lock:
+            if self._versions.get(key, 0) == version:
+                self._views[key] = view
+        return view
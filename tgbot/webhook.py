@@ -0,0 +1,97 @@
+import asyncio
+import hmac
+import signal
+import logging
+from aiohttp import web
+from telegram import Update
+from . import metrics
+from .shards import Shard, chat_id_of
+
+logger = logging.getLogger(__name__)
+
+RECEIVED = metrics.REGISTRY.counter("pvpbet_webhook_updates_total", "webhook posts by outcome", ("result",))
+QUEUE_DEPTH = metrics.REGISTRY.gauge("pvpbet_webhook_queue_depth", "updates received but not yet dispatched")
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+# the receiver only validates and enqueues, so telegram gets its 200 right away; the application's own update
+# loop takes updates off `update_queue` and runs the handlers, up to `concurrent_updates` at a time.
+# with a shard, updates for chats owned by another worker are refused (the router sent them to the wrong place)
+def make_app(application, path: str, secret: str | None = None, max_pending: int = 1000,
+             shard: Shard | None = None) -> web.Application:
+    QUEUE_DEPTH.set_function(application.update_queue.qsize)
+
+    async def receive(request: web.Request) -> web.Response:
+        if secret and not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), secret):
+            RECEIVED.inc(result="forbidden")
+            return web.Response(status=403)
+        # shed load rather than queue forever; telegram keeps the update and retries later
+        if application.update_queue.qsize() >= max_pending:
+            RECEIVED.inc(result="shed")
+            return web.Response(status=503)
+        try:
+            data = await request.json()
+            if shard is not None and not shard.owns(chat_id_of(data)):
+                RECEIVED.inc(result="misrouted")
+                logger.error(f"{shard} got an update for chat {chat_id_of(data)}, which it doesn't own")
+                return web.Response(status=421)
+            update = Update.de_json(data, application.bot)
+        except (ValueError, TypeError, KeyError, AttributeError) as e:
+            RECEIVED.inc(result="bad_request")
+            logger.warning(f"rejected malformed webhook update: {e}")
+            return web.Response(status=400)
+        await application.update_queue.put(update)
+        RECEIVED.inc(result="queued")
+        return web.Response()
+
+    async def healthz(_request: web.Request) -> web.Response:
+        return web.Response(text="ok" if application.running else "starting", status=200 if application.running else 503)
+
+    app = web.Application()
+    app.router.add_post(path, receive)
+    app.router.add_get("/healthz", healthz)
+    return app
+
+
+# same lifecycle as Application.run_polling (initialize, post_init, start, ..., post_stop, shutdown, post_shutdown),
+# with our receiver in place of the polling Updater. runs until SIGINT/SIGTERM or until `stop` is set
+async def serve(application, listen: str, port: int, path: str, webhook_url: str | None = None,
+                secret: str | None = None, max_pending: int = 1000, shard: Shard | None = None,
+                stop: asyncio.Event | None = None):
+    stop = stop or asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+
+    runner = web.AppRunner(make_app(application, path, secret, max_pending, shard), access_log=None)
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    try:
+        # several instances behind a load balancer all register the same public url, so this is idempotent
+        if webhook_url:
+            await application.bot.set_webhook(webhook_url, secret_token=secret, allowed_updates=Update.ALL_TYPES)
+            logger.info(f"webhook registered at {webhook_url}")
+        await application.start()
+        await runner.setup()
+        await web.TCPSite(runner, listen, port).start()
+        logger.info(f"webhook receiver listening on http://{listen}:{port}{path}")
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+        if application.running:
+            await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+def run_webhook(application, listen: str, port: int, path: str, webhook_url: str | None = None,
+                secret: str | None = None, max_pending: int = 1000, shard: Shard | None = None):
+    asyncio.run(serve(application, listen, port, path, webhook_url, secret, max_pending, shard))